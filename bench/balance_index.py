@@ -0,0 +1,72 @@
+## balance index benchmark ##
+# custody balances where most accounts sit at the same value, times updates
+# moving accounts in and out of that crowd and checks the queries against a
+# plain sort of the balances
+#
+#   python bench/balance_index.py --entities 100000 --updates 1000
+
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lib.balance_index import BalanceIndex
+from lib.cash import LOCATION_CUSTODY, CashMetrics
+
+DEFAULT_ENTITIES = 100000
+DEFAULT_UPDATES = 1000
+CURRENCY = "USDT"
+
+
+def check(index, balances):
+    expected = sorted(
+        ((balance, entityId) for entityId, balance in balances.items()), reverse=True
+    )
+    top = [(entityId, balance) for balance, entityId in expected[:10]]
+    if index.top(CURRENCY, 10) != top:
+        raise Exception(f"top mismatch: {index.top(CURRENCY, 10)} != {top}")
+
+    above = [(entityId, balance) for balance, entityId in expected if balance > 0]
+    if index.above(CURRENCY, 0) != above:
+        raise Exception("above mismatch")
+    if index.size(CURRENCY) != len(balances):
+        raise Exception("size mismatch")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Balance index benchmark")
+    parser.add_argument("--entities", type=int, default=DEFAULT_ENTITIES)
+    parser.add_argument("--updates", type=int, default=DEFAULT_UPDATES)
+    args = parser.parse_args()
+
+    cashMetrics = CashMetrics()
+    userMap = {entityId: {CURRENCY: Decimal(0)} for entityId in range(args.entities)}
+    cashMetrics.metricsMap[LOCATION_CUSTODY].userMap = userMap
+
+    start = time.perf_counter()
+    index = BalanceIndex(cashMetrics)
+    print(f"built {args.entities} entries in {time.perf_counter() - start:.3f}s")
+
+    balances = {entityId: cash[CURRENCY] for entityId, cash in userMap.items()}
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        entityId = rng.randrange(args.entities)
+        # half the moves go back to the crowd at 0
+        balance = Decimal(rng.randrange(1, 1000)) if rng.random() < 0.5 else Decimal(0)
+        index.set(CURRENCY, entityId, balance)
+        balances[entityId] = balance
+    elapsed = time.perf_counter() - start
+    print(f"{args.updates} updates in {elapsed:.3f}s ({elapsed / args.updates * 1e6:.1f}us each)")
+
+    check(index, balances)
+    print("queries match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+## event loop benchmark ##
+# a local stub server streams notifications over a websocket, the client
+# side reads them through AdminApiConnection.readLoop (json decode and
+# handler dispatch included) on each loop backend and reports messages/sec
+# and the latency of dispatching each notification to its handler
+#
+#   python bench/loop.py --messages 200000
+#   python bench/loop.py --backends asyncio
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lib import event_loop
+from lib.api_connection import AdminApiConnection
+from lib.cash import CashMetrics
+
+DEFAULT_MESSAGES = 100000
+DEFAULT_PORT = 8765
+
+LOCATIONS = ["hot_wallet", "warm_wallet", "clearing_account", "pending_withdraw"]
+CURRENCIES = ["USDT", "LBTC"]
+
+
+def makeFrame(index):
+    if index % 10 == 0:
+        notif = {"notification": "withdraw_queue_size", "data": {"size": index % 97}}
+    else:
+        notif = {
+            "notification": "cash_metrics",
+            "data": {
+                "location": LOCATIONS[index % len(LOCATIONS)],
+                "balances": [
+                    {"ccy": ccy, "balance": str(index + offset)}
+                    for offset, ccy in enumerate(CURRENCIES)
+                ],
+            },
+        }
+    return json.dumps(notif)
+
+
+## stub server, runs in its own process on the stock loop ##
+async def serve(port, count):
+    import websockets
+
+    async def handler(websocket):
+        for index in range(count):
+            await websocket.send(makeFrame(index))
+        await websocket.wait_closed()
+
+    async with websockets.serve(handler, "127.0.0.1", port):
+        print("ready", flush=True)
+        await asyncio.Future()
+
+
+## client side ##
+class BenchListener(object):
+    def __init__(self, count):
+        self.count = count
+        self.handled = 0
+        self.latencies = []
+        self.cashMetrics = CashMetrics()
+        self.done = asyncio.Event()
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        self.handled += 1
+        if self.handled >= self.count:
+            self.done.set()
+
+    async def handleCashMetricsUpdate(self, data):
+        self.cashMetrics.update(data)
+
+    async def handleLiquidBalanceUpdate(self, data):
+        await self.handleCashMetricsUpdate(data)
+
+    async def handleWithdrawQueueSizeUpdate(self, data):
+        pass
+
+
+class BenchConnection(AdminApiConnection):
+    async def processNotification(self, data):
+        start = time.perf_counter_ns()
+        await super().processNotification(data)
+        self.listener.record(time.perf_counter_ns() - start)
+
+
+async def consume(port, count):
+    import websockets
+
+    connection = BenchConnection("devbrown")
+    connection.listener = BenchListener(count)
+    async with websockets.connect(
+        f"ws://127.0.0.1:{port}", max_size=None
+    ) as connection.websocket:
+        start = time.perf_counter()
+        readTask = asyncio.create_task(connection.readLoop())
+        await connection.listener.done.wait()
+        elapsed = time.perf_counter() - start
+        readTask.cancel()
+    return elapsed, connection.listener.latencies
+
+
+def runBackend(backend, port, count):
+    used, _ = event_loop.getLoopFactory(backend)
+    if used != backend:
+        print(f"{backend:8}: not installed, skipped")
+        return
+
+    server = subprocess.Popen(
+        [sys.executable, __file__, "--serve", "--port", str(port)]
+        + ["--messages", str(count)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        # wait for the server to listen
+        server.stdout.readline()
+        elapsed, latencies = event_loop.run(consume(port, count), backend)
+    finally:
+        server.kill()
+        server.wait()
+
+    latencies.sort()
+    p50 = statistics.median(latencies) / 1e6
+    p99 = latencies[int(len(latencies) * 0.99) - 1] / 1e6
+    print(
+        f"{backend:8}: {count / elapsed:10.0f} msg/s, "
+        f"p50 {p50:.3f}ms, p99 {p99:.3f}ms over {count} messages"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Event loop backend benchmark")
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--backends",
+        type=str,
+        default=f"{event_loop.LOOP_ASYNCIO},{event_loop.LOOP_UVLOOP}",
+        help="comma separated list of loop backends to run",
+    )
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(args.port, args.messages))
+        sys.exit(0)
+
+    for backend in args.backends.split(","):
+        runBackend(backend.strip(), args.port, args.messages)
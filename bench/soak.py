@@ -0,0 +1,339 @@
+## soak test ##
+# runs the client against a local stub server pushing accelerated traffic
+# (wallet and custody notifications, churning exotic locations, sub account
+# lookups, request callbacks whose replies sometimes never come, short lived
+# tokens), samples retained memory and object counts per type, and fails if
+# retained memory keeps growing past the warmup
+#
+#   python bench/soak.py --duration 600 --rate 1000
+#   python bench/soak.py --duration 60 --max-slope-kb 256
+#
+# traffic is converted to simulated hours at PRODUCTION_RATE messages/sec,
+# the slope is reported and checked in KB per simulated hour
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import BrownClient
+from lib.api_connection import REPLY_LOAD_SUB_ACCOUNTS, urls
+from lib.cash import LOCATION_CUSTODY, LOCATION_EXOTIC
+from lib.subscriptions import ALL_ENTITIES
+
+DEFAULT_PORT = 8768
+DEFAULT_DURATION = 120
+DEFAULT_RATE = 1000
+DEFAULT_SAMPLES = 24
+DEFAULT_WARMUP = 0.25
+DEFAULT_MAX_SLOPE_KB = 512
+DEFAULT_ENTITIES = 1000
+DEFAULT_TOKEN_LIFETIME = 4
+DEFAULT_CALLBACK_TTL = 5
+
+# what a busy production session sees, to turn frames into hours
+PRODUCTION_RATE = 20
+
+# share of request callbacks the stub never answers
+DROP_RATIO = 0.2
+
+SOAK_ENV = "soak"
+SOAK_OWNER = "soak"
+TICK = 0.01
+
+
+## stub server ##
+def makeNotification(index, entities):
+    kind = index % 20
+    if kind == 0:
+        return {"notification": "withdraw_queue_size", "data": {"size": index % 97}}
+    if kind == 1:
+        # a location nobody saw before, every time
+        return {
+            "notification": "cash_metrics",
+            "data": {
+                "location": f"vault_{index}",
+                "balances": [{"ccy": "USDT", "balance": str(index % 1000)}],
+            },
+        }
+    if kind < 10:
+        return {
+            "notification": "load_account_balance",
+            "data": {
+                "entity_id": random.randrange(entities),
+                "account_balance": [
+                    {"ccy": "USDT", "balance": str(random.randrange(10**6))},
+                    {"ccy": "LBTC", "balance": str(random.randrange(10**4))},
+                ],
+            },
+        }
+    return {
+        "notification": "cash_metrics",
+        "data": {
+            "location": ["hot_wallet", "warm_wallet", "clearing_account"][index % 3],
+            "balances": [{"ccy": "USDT", "balance": str(index)}],
+        },
+    }
+
+
+async def serve(port, rate, entities):
+    import websockets
+
+    async def push(websocket):
+        index = 0
+        perTick = max(1, int(rate * TICK))
+        while True:
+            for _ in range(perTick):
+                await websocket.send(json.dumps(makeNotification(index, entities)))
+                index += 1
+            await asyncio.sleep(TICK)
+
+    async def handler(websocket):
+        pushTask = None
+        try:
+            async for message in websocket:
+                request = json.loads(message)
+                if "authorize" in request:
+                    reply = {"authorize": {"success": True, "email": "soak@localhost"}}
+                    await websocket.send(json.dumps(reply))
+                    if pushTask == None:
+                        pushTask = asyncio.create_task(push(websocket))
+                elif REPLY_LOAD_SUB_ACCOUNTS in request:
+                    ref = request[REPLY_LOAD_SUB_ACCOUNTS]
+                    accounts = [{"email": f"{ref}_{i}@localhost"} for i in range(5)]
+                    reply = {REPLY_LOAD_SUB_ACCOUNTS: {"accounts": accounts}}
+                    await websocket.send(json.dumps(reply))
+                elif "reference" in request:
+                    if random.random() >= DROP_RATIO:
+                        reply = {"reference": request["reference"], "data": {}}
+                        await websocket.send(json.dumps(reply))
+        finally:
+            if pushTask:
+                pushTask.cancel()
+
+    async with websockets.serve(handler, "127.0.0.1", port, max_size=None):
+        print("ready", flush=True)
+        await asyncio.Future()
+
+
+## client side ##
+class StubLoginClient(object):
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.issued = 0
+
+    def makeToken(self):
+        self.issued += 1
+        return {"access_token": f"soak_{self.issued}", "expires_in": self.lifetime}
+
+    async def update_access_token(self, token):
+        return self.makeToken()
+
+
+class SoakClient(BrownClient):
+    def __init__(self, tokenLifetime, callbackTtl):
+        super().__init__(SOAK_ENV, supervised=True)
+        self.loginClient = StubLoginClient(tokenLifetime)
+        self.connection.getAccessToken = self.getAccessToken
+        self.connection.callbackTtl = callbackTtl
+        self.loggedIn = asyncio.Event()
+        self.frames = 0
+
+    async def getAccessToken(self):
+        self.connection.loginClient = self.loginClient
+        return self.loginClient.makeToken()
+
+    async def onLoginSuccess(self):
+        await self.connection.subscriptions.watch(SOAK_OWNER, [ALL_ENTITIES])
+        self.loggedIn.set()
+
+    async def handleCashMetricsUpdate(self, data):
+        self.frames += 1
+        await super().handleCashMetricsUpdate(data)
+
+    async def handleWithdrawQueueSizeUpdate(self, data):
+        self.frames += 1
+        await super().handleWithdrawQueueSizeUpdate(data)
+
+
+def getWatched(client):
+    # containers the policies bound, reported next to the memory figures
+    connection = client.connection
+    cashMetrics = client.cashMetrics
+    return {
+        "callbacks": len(connection._callbacks),
+        "reply waiters": sum(len(w) for w in connection._replyWaiters.values()),
+        "exotic locations": len(cashMetrics.metricsMap[LOCATION_EXOTIC]),
+        "entities": len(cashMetrics.metricsMap[LOCATION_CUSTODY].userMap),
+        "snapshot wallets": len(client.snapshots._walletVersions),
+        "sub account cache": len(client.lookups.caches["sub_accounts"]),
+        "recon history": len(client.reconciler.history),
+        "alerts": len(client.rules.alerts),
+    }
+
+
+async def drive(client, stop):
+    # request traffic on top of the pushed notifications
+    connection = client.connection
+    index = 0
+
+    async def onReply(data):
+        pass
+
+    while not stop.is_set():
+        for _ in range(5):
+            ref = f"soak_{index}"
+            connection.queueCallback(ref, onReply)
+            await connection.send({"reference": ref, "request": "soak"})
+            index += 1
+        await client.lookups.load_sub_accounts(f"ref_{index % 2000}")
+        await asyncio.sleep(TICK)
+
+
+def takeSample(client):
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    types = Counter(type(obj).__name__ for obj in gc.get_objects())
+    return {
+        "frames": client.frames,
+        "hours": client.frames / PRODUCTION_RATE / 3600,
+        "retained": current,
+        "types": types,
+        "watched": getWatched(client),
+    }
+
+
+def getSlope(samples):
+    # least squares, bytes per simulated hour
+    xs = [sample["hours"] for sample in samples]
+    ys = [sample["retained"] for sample in samples]
+    meanX = sum(xs) / len(xs)
+    meanY = sum(ys) / len(ys)
+    den = sum((x - meanX) ** 2 for x in xs)
+    if den == 0:
+        return 0
+    return sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys)) / den
+
+
+async def soak(args):
+    urls[SOAK_ENV] = {
+        "api": f"ws://127.0.0.1:{args.port}",
+        "login": None,
+        "aeid": None,
+        "transport": {"max_size": None},
+    }
+    tracemalloc.start()
+    client = SoakClient(args.token_lifetime, args.callback_ttl)
+    runTask = asyncio.create_task(client.run())
+    await asyncio.wait_for(client.loggedIn.wait(), 10)
+
+    stop = asyncio.Event()
+    driveTask = asyncio.create_task(drive(client, stop))
+
+    samples = []
+    interval = args.duration / args.samples
+    warmupSamples = max(2, int(args.samples * args.warmup))
+    baseline = None
+    for index in range(args.samples):
+        await asyncio.sleep(interval)
+        for task in [runTask, driveTask]:
+            if task.done():
+                task.result()
+        samples.append(takeSample(client))
+        if index + 1 == warmupSamples:
+            baseline = tracemalloc.take_snapshot()
+
+        sample = samples[-1]
+        print(
+            f"{sample['hours']:7.2f}h {sample['frames']:9} frames"
+            f" {sample['retained'] / 1e6:8.2f}MB retained",
+            file=sys.stderr,
+        )
+
+    stop.set()
+    final = tracemalloc.take_snapshot()
+    driveTask.cancel()
+    runTask.cancel()
+    await asyncio.gather(driveTask, runTask, return_exceptions=True)
+    return samples, samples[warmupSamples - 1 :], baseline, final
+
+
+def report(samples, steady, baseline, final, args):
+    first, last = steady[0], steady[-1]
+    slope = getSlope(steady) / 1024
+    print(
+        f"{last['frames']} frames, {last['hours']:.1f} simulated hours"
+        f" at {PRODUCTION_RATE} msg/s"
+    )
+    print(
+        f"retained {first['retained'] / 1e6:.2f}MB -> {last['retained'] / 1e6:.2f}MB"
+        f" after warmup, slope {slope:.1f} KB/hour (max {args.max_slope_kb})"
+    )
+
+    print("watched structures (after warmup -> end):")
+    for name, size in last["watched"].items():
+        print(f" . {name:20} {first['watched'][name]:8} -> {size}")
+
+    print("object count growth after warmup:")
+    growth = last["types"] - first["types"]
+    for name, count in growth.most_common(args.top):
+        print(f" . {name:30} +{count}")
+
+    print("allocation growth after warmup:")
+    for stat in final.compare_to(baseline, "lineno")[: args.top]:
+        if stat.size_diff > 0:
+            frame = stat.traceback[0]
+            print(
+                f" . {os.path.relpath(frame.filename, ROOT)}:{frame.lineno}"
+                f" +{stat.size_diff / 1024:.1f}KB ({stat.count_diff:+} blocks)"
+            )
+
+    return slope <= args.max_slope_kb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client soak test")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--rate", type=int, default=DEFAULT_RATE, help="notifications/sec")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP)
+    parser.add_argument("--max-slope-kb", type=float, default=DEFAULT_MAX_SLOPE_KB)
+    parser.add_argument("--entities", type=int, default=DEFAULT_ENTITIES)
+    parser.add_argument("--token-lifetime", type=float, default=DEFAULT_TOKEN_LIFETIME)
+    parser.add_argument("--callback-ttl", type=float, default=DEFAULT_CALLBACK_TTL)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(args.port, args.rate, args.entities))
+        sys.exit(0)
+
+    server = subprocess.Popen(
+        [sys.executable, __file__, "--serve", "--port", str(args.port)]
+        + ["--rate", str(args.rate), "--entities", str(args.entities)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        server.stdout.readline()
+        # the client prints notifications, keep them off the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = asyncio.run(soak(args))
+    finally:
+        server.kill()
+        server.wait()
+
+    sys.exit(0 if report(*result, args) else 1)
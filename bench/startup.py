@@ -0,0 +1,137 @@
+## startup benchmark ##
+# import: runs `python -X importtime client.py --help`, reports wall time and
+#         the heaviest imports, fails if over budget or if a module that
+#         should be lazy shows up
+# login:  time from interpreter start to the first authorised frame
+#         against a live environment, needs --env and --key
+#
+#   python bench/startup.py import --runs 10 --budget-ms 250
+#   python bench/startup.py login --env devbrown --key admin.key
+
+import time
+
+START = time.perf_counter()
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_RUNS = 10
+DEFAULT_BUDGET_MS = 250
+DEFAULT_TOP = 15
+
+# none of these may be imported just to print the help
+LAZY_MODULES = [
+    "SDK.leverex_core.login_connection",
+    "websockets",
+    "cryptography",
+    "jwcrypto",
+    "pyqrcode",
+    "PIL",
+    "curses",
+    "concurrent.futures.process",
+    "multiprocessing.shared_memory",
+    "lib.daemon",
+    "lib.dashboard",
+    "lib.export",
+    "lib.shm_balances",
+]
+
+
+def parseImportTime(stderr):
+    # "import time: self [us] | cumulative | imported package"
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        selfUs, cumulativeUs, name = line.split(":", 1)[1].split("|")
+        modules[name.strip()] = (int(selfUs), int(cumulativeUs))
+    return modules
+
+
+def runImport(args):
+    walls = []
+    modules = {}
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "client.py", "--help"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        )
+        walls.append((time.perf_counter() - start) * 1000)
+        if proc.returncode != 0:
+            print(proc.stderr)
+            return 1
+        modules = parseImportTime(proc.stderr)
+
+    median = statistics.median(walls)
+    print(
+        f"client.py --help: median {median:.1f}ms, min {min(walls):.1f}ms"
+        f" over {args.runs} runs"
+    )
+    print(f"top {args.top} imports by cumulative time:")
+    heaviest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (selfUs, cumulativeUs) in heaviest[: args.top]:
+        print(f"  {cumulativeUs / 1000:8.2f}ms {name}")
+
+    failed = False
+    eager = [
+        name
+        for name in LAZY_MODULES
+        if name in modules or any(mod.startswith(name + ".") for mod in modules)
+    ]
+    if eager:
+        print(f"FAIL: imported at startup but should be lazy: {eager}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"FAIL: median {median:.1f}ms is over the {args.budget_ms}ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+def runLogin(args):
+    sys.path.insert(0, ROOT)
+    from client import BrownClient
+
+    imported = time.perf_counter()
+
+    class BenchClient(BrownClient):
+        async def onLoginSuccess(self):
+            authorised = time.perf_counter()
+            print(f"imports: {(imported - START) * 1000:.1f}ms")
+            print(f"first authorised frame: {(authorised - START) * 1000:.1f}ms")
+            raise SystemExit(0)
+
+    client = BenchClient(args.env, args.key)
+    try:
+        asyncio.run(client.run())
+    except SystemExit as e:
+        return e.code
+    print("connection closed before login")
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Admin client startup benchmark")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    importParser = sub.add_parser("import", help="time client.py --help")
+    importParser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    importParser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    importParser.add_argument("--top", type=int, default=DEFAULT_TOP)
+
+    loginParser = sub.add_parser("login", help="time to the first authorised frame")
+    loginParser.add_argument("--env", type=str, required=True)
+    loginParser.add_argument("--key", type=str, required=True)
+
+    args = parser.parse_args()
+    if args.mode == "import":
+        sys.exit(runImport(args))
+    sys.exit(runLogin(args))
@@ -0,0 +1,239 @@
+## websocket transport benchmark ##
+# replays recorded server traffic (client.py --record) through a local proxy
+# that adds latency and an optional bandwidth cap, once per transport
+# setting, and reports bytes on the wire, replay time and request round trips
+#
+#   python client.py --env=devbrown --key=admin.key --record=traffic.jsonl
+#   python bench/transport.py --traffic traffic.jsonl --rtt-ms 80 --bandwidth-kbps 20000
+#
+# without --traffic a synthetic cash metrics stream is used
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lib.api_connection import AdminApiConnection
+from lib.ws_transport import getConnectOptions, getTransportSettings, WriteCoalescer
+from loop import makeFrame
+
+DEFAULT_SERVER_PORT = 8766
+DEFAULT_PROXY_PORT = 8767
+DEFAULT_RTT_MS = 80
+DEFAULT_SYNTHETIC = 20000
+DEFAULT_REQUESTS = 2000
+DEFAULT_BURST = 16
+
+# settings compared, each on top of the transport defaults
+Profiles = [
+    ("no compression", {"compression": False}),
+    ("deflate, 9 bits", {"window_bits": 9}),
+    ("deflate, 12 bits", {"window_bits": 12}),
+    ("deflate, 15 bits", {"window_bits": 15}),
+    ("no compression, coalesced", {"compression": False, "write_coalesce": True}),
+    ("deflate 15, coalesced", {"window_bits": 15, "write_coalesce": True}),
+]
+
+
+def loadTraffic(path, count):
+    if not path:
+        return [makeFrame(index) for index in range(count)]
+    with open(path, "r") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+## stub server: replays the traffic on demand and echoes requests ##
+async def serve(port, path, count):
+    import websockets
+
+    frames = loadTraffic(path, count)
+
+    async def handler(websocket):
+        async for message in websocket:
+            if message == '{"replay": true}':
+                for frame in frames:
+                    await websocket.send(frame)
+                await websocket.send('{"replay_done": true}')
+            else:
+                await websocket.send(message)
+
+    async with websockets.serve(handler, "127.0.0.1", port, max_size=None):
+        print("ready", flush=True)
+        await asyncio.Future()
+
+
+## link simulation ##
+class LinkProxy(object):
+    def __init__(self, targetPort, rttMs, bandwidthKbps):
+        self.targetPort = targetPort
+        self.oneWay = rttMs / 2000
+        self.bytesPerSec = bandwidthKbps * 125 if bandwidthKbps else None
+        self.upstream = 0
+        self.downstream = 0
+
+    def reset(self):
+        self.upstream = 0
+        self.downstream = 0
+
+    async def start(self, port):
+        self.server = await asyncio.start_server(self.onClient, "127.0.0.1", port)
+
+    async def onClient(self, clientReader, clientWriter):
+        serverReader, serverWriter = await asyncio.open_connection(
+            "127.0.0.1", self.targetPort
+        )
+        await asyncio.gather(
+            self.pipe(clientReader, serverWriter, True),
+            self.pipe(serverReader, clientWriter, False),
+            return_exceptions=True,
+        )
+
+    async def pipe(self, reader, writer, isUpstream):
+        # chunks are released in order once their latency and serialization
+        # time on the simulated link elapsed
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+
+        async def deliver():
+            while True:
+                deliverAt, data = await queue.get()
+                if data == None:
+                    writer.close()
+                    return
+                delay = deliverAt - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+
+        deliverTask = asyncio.create_task(deliver())
+        linkFreeAt = 0
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                queue.put_nowait((0, None))
+                break
+            if isUpstream:
+                self.upstream += len(data)
+            else:
+                self.downstream += len(data)
+
+            sendAt = loop.time()
+            if self.bytesPerSec:
+                sendAt = max(sendAt, linkFreeAt) + len(data) / self.bytesPerSec
+                linkFreeAt = sendAt
+            queue.put_nowait((sendAt + self.oneWay, data))
+        await deliverTask
+
+
+## client side, through AdminApiConnection's send path ##
+async def runProfile(proxy, proxyPort, settings, requests, burst):
+    import websockets
+
+    connection = AdminApiConnection("devbrown")
+    connection.transport = getTransportSettings(dict(settings, max_size=None))
+    proxy.reset()
+
+    async with websockets.connect(
+        f"ws://127.0.0.1:{proxyPort}", **getConnectOptions(connection.transport)
+    ) as connection.websocket:
+        if connection.transport["write_coalesce"]:
+            connection.writer = WriteCoalescer(connection.websocket)
+
+        # downstream: full replay
+        start = time.perf_counter()
+        await connection.send({"replay": True})
+        frames = 0
+        while True:
+            data = await connection.websocket.recv()
+            if data == '{"replay_done": true}':
+                break
+            frames += 1
+        replayTime = time.perf_counter() - start
+        downstream = proxy.downstream
+
+        # upstream: bursts of small requests, round trip per burst
+        roundTrips = []
+        for burstIndex in range(requests // burst):
+            start = time.perf_counter()
+            await asyncio.gather(
+                *[
+                    connection.send({"load_sub_accounts": f"ref_{burstIndex}_{i}"})
+                    for i in range(burst)
+                ]
+            )
+            for _ in range(burst):
+                await connection.websocket.recv()
+            roundTrips.append((time.perf_counter() - start) * 1000)
+
+    roundTrips.sort()
+    return {
+        "frames": frames,
+        "downstream": downstream,
+        "replay_ms": replayTime * 1000,
+        "upstream": proxy.upstream,
+        "rtt_p50": statistics.median(roundTrips),
+        "rtt_p99": roundTrips[max(int(len(roundTrips) * 0.99) - 1, 0)],
+    }
+
+
+async def runAll(args):
+    proxy = LinkProxy(args.server_port, args.rtt_ms, args.bandwidth_kbps)
+    await proxy.start(args.proxy_port)
+
+    rawBytes = sum(len(frame) for frame in loadTraffic(args.traffic, args.synthetic))
+    print(
+        f"{rawBytes / 1e6:.2f}MB of json, link rtt {args.rtt_ms}ms"
+        f", bandwidth {args.bandwidth_kbps or 'unlimited'} kbps"
+    )
+    print(
+        f"{'profile':28}{'down MB':>9}{'ratio':>7}{'replay ms':>11}"
+        f"{'up KB':>9}{'burst p50':>11}{'burst p99':>11}"
+    )
+    for name, settings in Profiles:
+        result = await runProfile(
+            proxy, args.proxy_port, settings, args.requests, args.burst
+        )
+        print(
+            f"{name:28}{result['downstream'] / 1e6:9.2f}"
+            f"{rawBytes / result['downstream']:7.2f}{result['replay_ms']:11.0f}"
+            f"{result['upstream'] / 1e3:9.1f}{result['rtt_p50']:11.1f}"
+            f"{result['rtt_p99']:11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Websocket transport benchmark")
+    parser.add_argument("--traffic", type=str, help="recorded frames, one per line")
+    parser.add_argument("--synthetic", type=int, default=DEFAULT_SYNTHETIC)
+    parser.add_argument("--rtt-ms", type=float, default=DEFAULT_RTT_MS)
+    parser.add_argument("--bandwidth-kbps", type=float, default=0)
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS)
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST)
+    parser.add_argument("--server-port", type=int, default=DEFAULT_SERVER_PORT)
+    parser.add_argument("--proxy-port", type=int, default=DEFAULT_PROXY_PORT)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(args.server_port, args.traffic, args.synthetic))
+        sys.exit(0)
+
+    command = [sys.executable, __file__, "--serve"]
+    command += ["--server-port", str(args.server_port)]
+    command += ["--synthetic", str(args.synthetic)]
+    if args.traffic:
+        command += ["--traffic", args.traffic]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        asyncio.run(runAll(args))
+    finally:
+        server.kill()
+        server.wait()
@@ -1,22 +1,55 @@
 import logging
 import asyncio
+import json
 import sys
 import argparse
+from dataclasses import asdict
+from datetime import datetime
 
 from lib.printHelp import processHelp
 from lib.sessions import (
+    SESSIONS_PATH,
     SessionMap,
+    SessionStreamLoader,
 )
-from lib.api_connection import AdminApiConnection
+from lib.api_connection import AdminApiConnection, isErrorReply
 from lib.announcements import Announcements
 from lib.cash import CashMetrics
+from lib import event_loop, log_pipeline
+from lib.balance_index import BalanceIndex
+from lib.lookups import Lookups
+from lib.offload import Offloader
+from lib.reconcile import Reconciler
+from lib.rules import RuleEngine
+from lib.subscriptions import ALL_ENTITIES
+from lib.snapshots import SnapshotPublisher
 
 from commands import (
+    COMMAND_EXPORT,
+    COMMAND_BALANCE_ABOVE,
+    COMMAND_BALANCE_JSON,
+    COMMAND_BALANCE_LIST,
+    COMMAND_BALANCE_SHOW,
+    COMMAND_BALANCE_TOP,
+    COMMAND_CACHE_CLEAR,
+    COMMAND_CACHE_INVALIDATE,
+    COMMAND_CACHE_STATS,
     COMMAND_DEPOSIT,
+    COMMAND_JOURNAL_AT,
+    COMMAND_JOURNAL_STATS,
     COMMAND_LOAD_DEPOSIT_ADDRESS,
     COMMAND_LOAD_SUB_ACCOUNTS,
+    COMMAND_LOG_STATS,
+    COMMAND_RECON_HISTORY,
+    COMMAND_RECON_STATUS,
+    COMMAND_RULES,
+    COMMAND_WATCH_ADD,
+    COMMAND_WATCH_LIST,
+    COMMAND_WATCH_REMOVE,
     COMMAND_SUBACCOUNT_CREATE,
+    COMMAND_TOKEN_STATUS,
     COMMAND_WITHDRAW,
+    COMMAND_BATCH_WITHDRAW,
     Commands,
     COMMAND_EXIT,
 )
@@ -25,19 +58,87 @@ from commands import (
 
 theOneProduct = "xbtusd_rf"
 
+# subscriptions made from the prompt
+WATCH_OWNER = "console"
+
+replyLog = logging.getLogger(log_pipeline.CATEGORY_REPLY)
+
 
 class BrownClient(object):
-    def __init__(self, env, key=None):
-        self.connection = AdminApiConnection(env, key)
+    def __init__(
+        self,
+        env,
+        key=None,
+        daemonPath=None,
+        dashboard=False,
+        shmName=None,
+        rulesPath=None,
+        offloader=None,
+        supervised=False,
+        journalPath=None,
+    ):
+        # supervised clients share the loop with other targets, a failing
+        # connection must not stop it
+        self.connection = AdminApiConnection(env, key, stopLoopOnError=not supervised)
         self.sessionMap = SessionMap()
+        self.connection.streamSinks[SESSIONS_PATH] = SessionStreamLoader(self.sessionMap)
         self.commands = Commands()
         self.announcements = Announcements()
+        self.announcements.subscribe(self.onAnnouncement)
         self.cashMetrics = CashMetrics()
+        self.lookups = Lookups(self.connection)
+        self.offloader = offloader or Offloader()
+        self.snapshots = SnapshotPublisher(self.cashMetrics, self.sessionMap)
+        # report name -> (snapshot version, rendered text)
+        self._reports = {}
+        self.balanceIndex = BalanceIndex(self.cashMetrics)
+        self.reconciler = Reconciler(
+            self.cashMetrics,
+            self.sessionMap,
+            offloader=self.offloader,
+            snapshots=self.snapshots,
+        )
+        if rulesPath:
+            self.rules = RuleEngine.fromFile(rulesPath, self.cashMetrics.changeFeed)
+        else:
+            self.rules = RuleEngine(self.cashMetrics.changeFeed)
         self.numAccounts = None
+        self.withdrawQueueSize = None
         self.key = key
+        self.tag = env
+        self.supervisor = None
+
+        # append only history of applied changes, for point in time queries
+        self.journal = None
+        if journalPath:
+            from lib.state_journal import StateJournal
+
+            self.journal = StateJournal(journalPath, self.cashMetrics, self.sessionMap)
+
+        # optional front ends are only imported when asked for, short
+        # lived clients shouldn't pay for them at startup
+        self.daemon = None
+        if daemonPath:
+            from lib.daemon import DaemonServer
+
+            self.daemon = DaemonServer(self, daemonPath)
+        self.dashboard = None
+        if dashboard:
+            from lib.dashboard import Dashboard
+
+            self.dashboard = Dashboard(self)
+
+        # mirror balances for sibling processes
+        self.shmPublisher = None
+        if shmName:
+            from lib.shm_balances import BalancePublisher
+
+            self.shmPublisher = BalancePublisher(shmName, self.cashMetrics)
 
     ## asyncio entry point ##
     async def run(self):
+        if self.journal:
+            self.journal.start()
         await self.connection.run(self)
 
     ## input loop ##
@@ -50,16 +151,27 @@ class BrownClient(object):
             # strip the terminating \n
             if len(command) > 1 and command[-1] == "\n":
                 command = command[0:-1].strip()
-            keepRunning = await self.parseCommand(command)
+            try:
+                keepRunning = await self.parseCommand(command)
+            except Exception as e:
+                # a failed command shouldn't take the prompt down
+                logging.error(f"command failed: {e}")
 
     async def parseCommand(self, request):
         commandCode, args = self.commands.parseUserRequest(request)
         if commandCode == None:
             print(f"unexpected command: {request}")
             return True
+        return await self.processCommand(commandCode, args)
 
+    async def processCommand(self, commandCode, args):
         ## exit ##
-        elif commandCode == COMMAND_EXIT:
+        if commandCode == COMMAND_EXIT:
+            self.offloader.shutdown()
+            if self.shmPublisher:
+                self.shmPublisher.close()
+            if self.journal:
+                await self.journal.close()
             loop = asyncio.get_event_loop()
             loop.stop()
             return False
@@ -75,6 +187,8 @@ class BrownClient(object):
         # subaccount
         elif commandCode == COMMAND_WITHDRAW:
             await self.withdraw(*args)
+        elif commandCode == COMMAND_BATCH_WITHDRAW:
+            print(await self.batch_withdraw(*args))
 
         elif commandCode == COMMAND_DEPOSIT:
             await self.deposit(*args)
@@ -84,8 +198,58 @@ class BrownClient(object):
         elif commandCode == COMMAND_LOAD_SUB_ACCOUNTS:
             await self.load_sub_accounts(*args)
 
+        # reports are computed off the loop
+        elif commandCode == COMMAND_BALANCE_SHOW:
+            await self.balance_show()
+        elif commandCode == COMMAND_BALANCE_LIST:
+            await self.balance_list()
+        elif commandCode == COMMAND_BALANCE_JSON:
+            self.balance_json()
+        elif commandCode == COMMAND_BALANCE_TOP:
+            self.balance_top(*args)
+        elif commandCode == COMMAND_BALANCE_ABOVE:
+            self.balance_above(*args)
+
+        elif commandCode == COMMAND_EXPORT:
+            await self.export(*args)
+
+        elif commandCode == COMMAND_RECON_STATUS:
+            self.recon_status()
+        elif commandCode == COMMAND_RECON_HISTORY:
+            self.recon_history(*args)
+
+        elif commandCode == COMMAND_RULES:
+            self.rules_status()
+
+        elif commandCode == COMMAND_JOURNAL_STATS:
+            self.journal_stats()
+        elif commandCode == COMMAND_JOURNAL_AT:
+            await self.journal_at(*args)
+
+        # balance subscriptions
+        elif commandCode == COMMAND_WATCH_ADD:
+            await self.watch_add(*args)
+        elif commandCode == COMMAND_WATCH_REMOVE:
+            await self.watch_remove(*args)
+        elif commandCode == COMMAND_WATCH_LIST:
+            self.watch_list()
+
+        elif commandCode == COMMAND_TOKEN_STATUS:
+            self.token_status()
+
+        elif commandCode == COMMAND_LOG_STATS:
+            self.log_stats()
+
+        # lookup cache
+        elif commandCode == COMMAND_CACHE_STATS:
+            self.cache_stats()
+        elif commandCode == COMMAND_CACHE_CLEAR:
+            self.cache_clear(*args)
+        elif commandCode == COMMAND_CACHE_INVALIDATE:
+            self.cache_invalidate(*args)
+
         else:
-            print(f"unhandled command: {request}")
+            print(f"unhandled command: {commandCode}")
 
         return True
 
@@ -94,33 +258,243 @@ class BrownClient(object):
         await self.connection.createSubAccount(email)
 
     async def on_subaccount_create(self, data):
-        print(data)
+        replyLog.info("sub account created", extra={"data": data})
 
     ## withdrawal ##
     async def withdraw(self, address, currency, amount, entity_id):
         await self.connection.withdraw(address, currency, amount, entity_id)
 
+    # journaled next to the csv, a rerun with the same batch id resumes it
+    async def batch_withdraw(self, csv_path, batch_id, concurrency=None, unknown=None):
+        from lib import withdraw_batch
+
+        result = await withdraw_batch.withdraw_many(
+            withdraw_batch.ConnectionWithdrawer(self.connection),
+            withdraw_batch.loadRowsCsv(csv_path),
+            f"{csv_path}.journal",
+            batch_id,
+            concurrency or withdraw_batch.DEFAULT_CONCURRENCY,
+            retryUnknown=unknown == "retry",
+        )
+        return asdict(result)
+
     async def on_withdraw(self, data):
-        print(data)
+        replyLog.info("withdraw", extra={"data": data})
 
     # deposit
     async def deposit(self, something):
         pass
 
     async def on_deposit(self, data):
-        print(data)
+        replyLog.info("deposit", extra={"data": data})
 
+    # lookups are cached, repeated references are answered locally
     async def load_deposit_address(self, ref_str):
-        await self.connection.load_deposit_address(ref_str)
+        reply = await self.lookups.load_deposit_address(ref_str)
+        await self.on_load_deposit_address(reply)
 
     async def on_load_deposit_address(self, data):
-        print(data)
+        replyLog.info("deposit address", extra={"data": data})
 
+    # logged as they are decoded rather than as one object
     async def load_sub_accounts(self, ref_str):
-        await self.connection.load_sub_accounts(ref_str)
+        count, reply = await self.lookups.stream_sub_accounts(
+            ref_str, lambda account: replyLog.info("sub account", extra={"data": account})
+        )
+        if isErrorReply(reply):
+            await self.on_load_sub_accounts(reply)
+            return
+        replyLog.info("sub accounts loaded", extra={"reference": ref_str, "count": count})
 
     async def on_load_sub_accounts(self, data):
-        print(data)
+        replyLog.info("sub accounts", extra={"data": data})
+
+    ## cash reports ##
+    # rendered off the loop from the published snapshot, once per version
+    async def renderReport(self, name, render):
+        # session changes don't publish on their own, catch up first
+        snapshot = self.snapshots.publish()
+        version, text = self._reports.get(name, (None, None))
+        if version == snapshot.version:
+            return text
+        text = await render(snapshot)
+        self._reports[name] = (snapshot.version, text)
+        return text
+
+    async def renderCashReport(self):
+        return await self.renderReport("cash", self.offloader.renderCashReport)
+
+    async def renderUsersCash(self):
+        return await self.renderReport("users", self.offloader.renderUsersCash)
+
+    async def balance_show(self):
+        print(await self.renderCashReport())
+
+    async def balance_list(self):
+        print(await self.renderUsersCash())
+
+    def balance_json(self):
+        print(json.dumps(self.snapshots.latest().toDict(), default=str))
+
+    # answered from the sorted balance index, no scan of the user map
+    def balance_top(self, currency, count):
+        self.printBalances(currency, self.balanceIndex.top(currency, count))
+
+    def balance_above(self, currency, threshold):
+        self.printBalances(currency, self.balanceIndex.above(currency, threshold))
+
+    def printBalances(self, currency, entries):
+        for entityId, balance in entries:
+            print(f" . {entityId}: {balance} {currency}")
+        print(f"{len(entries)} of {self.balanceIndex.size(currency)} {currency} holders")
+
+    ## export ##
+    async def export(self, table, fmt, path, compression=None, columns=None):
+        from lib.export import export
+
+        # published first, sessions streamed in since the last notification
+        # are in it too. the snapshot is immutable, the export can run off
+        # the loop
+        snapshot = self.snapshots.publish()
+        loop = asyncio.get_running_loop()
+        count = await loop.run_in_executor(
+            None, export, snapshot, table, fmt, path, compression, columns
+        )
+        print(f"exported {count} {table} rows to {path}")
+        return count
+
+    ## reconciliation ##
+    def recon_status(self):
+        for ccy, status in self.reconciler.status().items():
+            print(
+                f" . {ccy}: assets {status['assets']}, liabilities {status['liabilities']}"
+                f", difference {status['difference']}"
+                + (" (BREAK)" if status["open_break"] else "")
+                + (" (pending)" if status["pending"] else "")
+            )
+
+    def recon_history(self, count=None):
+        for entry in self.reconciler.getHistory(count):
+            state = "open" if entry["closed_at"] == None else "closed"
+            print(
+                f" . {entry['currency']} {state}, difference {entry['difference']}"
+                f", opened by {entry['cause']}"
+            )
+
+    ## alert rules ##
+    def rules_status(self):
+        for status in self.rules.status():
+            line = f" . {status['name']}: {status['rule']}"
+            if status["active"]:
+                tripped = ", ".join(str(subject) for subject in status["active"])
+                line += f" [tripped: {tripped}]"
+            print(line)
+        for alert in list(self.rules.alerts)[-10:]:
+            print(f"   - {alert.message}")
+
+    ## state journal ##
+    def journal_stats(self):
+        if self.journal == None:
+            print("journal is off, start with --journal")
+            return
+        print(f" . {self.journal.stats()}")
+
+    async def journal_at(self, time):
+        if self.journal == None:
+            print("journal is off, start with --journal")
+            return
+        from lib.state_journal import parseTime
+
+        # replay reads segments from disk, keep it off the loop
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(
+            None, self.journal.stateAt, parseTime(time)
+        )
+        print(f"as of seq {state.seq}, {datetime.fromtimestamp(state.timestamp)}")
+        for loc, cashMap in state.wallets.items():
+            balances = " - ".join(f"{ccy}: {val}" for ccy, val in cashMap.items())
+            print(f" . {loc:22} = {balances}")
+        print(f" . {'limbo':22} = {state.limbo or 'N/A'}")
+        print(f" . {len(state.users)} entities")
+
+    ## balance subscriptions ##
+    def parseEntityIds(self, entity_ids):
+        return [int(entityId) for entityId in entity_ids.split(",") if entityId.strip()]
+
+    async def watch_add(self, entity_ids):
+        subscriptions = self.connection.subscriptions
+        await subscriptions.add(WATCH_OWNER, self.parseEntityIds(entity_ids))
+        return subscriptions.stats()
+
+    async def watch_remove(self, entity_ids):
+        subscriptions = self.connection.subscriptions
+        await subscriptions.remove(WATCH_OWNER, self.parseEntityIds(entity_ids))
+        return subscriptions.stats()
+
+    def watch_list(self):
+        print(f" . {self.connection.subscriptions.stats()}")
+
+    ## token ##
+    def token_status(self):
+        refresher = self.connection.tokenRefresher
+        if refresher == None:
+            print("not logged in")
+            return
+        print(f" . access token: {refresher.stats()}")
+
+    ## output ##
+    def log_stats(self):
+        if log_pipeline.pipeline == None:
+            print("log pipeline is not running")
+            return
+        stats = log_pipeline.pipeline.stats()
+        print(f" . quiet: {stats['quiet']}, queued: {stats['queued']}, dropped: {stats['dropped']}")
+        for category, counters in stats["categories"].items():
+            print(f" . {category}: {counters}")
+
+    ## lookup cache ##
+    def cache_stats(self):
+        for name, stats in self.lookups.stats().items():
+            print(f" . {name}: {stats}")
+
+    def cache_clear(self, cacheName):
+        self.lookups.clear(cacheName)
+
+    def cache_invalidate(self, cacheName, ref_str):
+        if not self.lookups.invalidate(cacheName, ref_str):
+            print(f"{ref_str} was not cached in {cacheName}")
+
+    ## notification handlers ##
+    async def handleCashMetricsUpdate(self, data):
+        self.cashMetrics.update(data)
+        self.snapshots.publish()
+        if self.shmPublisher:
+            self.shmPublisher.publish()
+        if self.dashboard:
+            self.dashboard.markDirty()
+
+    async def handleLiquidBalanceUpdate(self, data):
+        await self.handleCashMetricsUpdate(data)
+
+    async def handleWithdrawQueueSizeUpdate(self, data):
+        self.withdrawQueueSize = data
+        self.rules.updateWithdrawQueueSize(data)
+        if self.dashboard:
+            self.dashboard.markDirty()
+
+    def onAnnouncement(self, event, announcement):
+        logging.info(
+            f"announcement {announcement.id} {event}",
+            extra={"priority": announcement.priority, "message": announcement.message},
+        )
+
+    async def runDashboard(self):
+        await self.connection.subscriptions.watch("dashboard", [ALL_ENTITIES])
+        await self.dashboard.run()
+
+        # leaving the dashboard shuts the client down, same as exit
+        loop = asyncio.get_event_loop()
+        loop.stop()
 
     ## reply handlers ##
     async def onLoginSuccess(self):
@@ -131,17 +505,27 @@ class BrownClient(object):
         # await self.connection.subscribeImInfo()
         # await self.connection.subscribeToUserBalance()
 
+        # the supervisor owns the prompt
+        if self.supervisor:
+            await self.supervisor.onLoginSuccess(self)
+            return
+
+        # headless mode, serve commands over the local socket
+        if self.daemon:
+            await self.daemon.start()
+            return
+
+        # full screen view instead of the prompt
+        if self.dashboard:
+            asyncio.ensure_future(self.runDashboard())
+            return
+
         # start input prompt task
         loop = asyncio.get_event_loop()
         asyncio.ensure_future(self.inputLoop(loop))
 
 
 if __name__ == "__main__":
-    LOG_FORMAT = (
-        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s"
-    )
-    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
-
     parser = argparse.ArgumentParser(description="Admin Client")
     parser.add_argument(
         "--env",
@@ -153,10 +537,114 @@ if __name__ == "__main__":
         type=str,
         help="Key file for login over apikey (without providing a key it will show a QR code)",
     )
+    parser.add_argument(
+        "--daemon",
+        type=str,
+        help="Run headless, serving commands as JSON lines over this unix socket path",
+    )
+    parser.add_argument(
+        "--dashboard",
+        action="store_true",
+        help="Show a live full screen dashboard of wallets and queues instead of the prompt",
+    )
+    parser.add_argument(
+        "--shm",
+        type=str,
+        help="Publish wallet and entity balances to this shared memory segment",
+    )
+    parser.add_argument(
+        "--rules",
+        type=str,
+        help="JSON file of alert rules and sinks evaluated on every notification",
+    )
+    parser.add_argument(
+        "--loop",
+        type=str,
+        choices=event_loop.LoopBackends,
+        default=event_loop.LOOP_ASYNCIO,
+        help="Event loop backend, uvloop falls back to asyncio when not installed",
+    )
+    parser.add_argument(
+        "--target",
+        type=str,
+        action="append",
+        help="env:keyfile to run side by side with other targets, repeat for each one",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        help="Append every incoming websocket frame to this file, for bench/transport.py",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        help="Directory of the state change journal, enables 'journal at <time>'",
+    )
+    parser.add_argument(
+        "--log-format",
+        type=str,
+        choices=log_pipeline.LogFormats,
+        default=log_pipeline.FORMAT_TEXT,
+        help="Log line format, json writes one object per line",
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Only count log records per category, errors still go out",
+    )
+    parser.add_argument(
+        "--log-every",
+        type=str,
+        action="append",
+        help="category=N keeps one record in N for that category, e.g. notif=100",
+    )
+    parser.add_argument(
+        "--log-rate",
+        type=str,
+        action="append",
+        help="category=N caps that category at N records per second",
+    )
     args = parser.parse_args()
 
+    # log records are written by a background thread, never on the loop
+    log_pipeline.setup(
+        args.log_format,
+        policies=log_pipeline.parsePolicies(args.log_every, args.log_rate),
+        quiet=args.quiet,
+    )
+
+    if args.target:
+        # several envs and keys on one loop, sharing one process pool
+        from lib.supervisor import Supervisor, parseTarget
+
+        offloader = Offloader()
+        supervisor = Supervisor(
+            [parseTarget(target) for target in args.target],
+            lambda env, key: BrownClient(
+                env, key, offloader=offloader, supervised=True
+            ),
+        )
+        try:
+            event_loop.run(supervisor.run(), args.loop)
+        finally:
+            offloader.shutdown()
+            log_pipeline.shutdown()
+        sys.exit(0)
+
     try:
-        client = BrownClient(args.env, args.key)
-        asyncio.run(client.run())
+        client = BrownClient(
+            args.env,
+            args.key,
+            args.daemon,
+            args.dashboard,
+            args.shm,
+            args.rules,
+            journalPath=args.journal,
+        )
+        if args.record:
+            client.connection.record(args.record)
+        event_loop.run(client.run(), args.loop)
     except Exception:
         print("exiting...")
+    finally:
+        log_pipeline.shutdown()
@@ -8,14 +8,40 @@ COMMAND_HELP_SESSION = "help session"
 
 COMMAND_BALANCE_SHOW = "balance show"
 COMMAND_BALANCE_LIST = "balance list"
+COMMAND_BALANCE_JSON = "balance json"
+COMMAND_BALANCE_TOP = "balance top"
+COMMAND_BALANCE_ABOVE = "balance above"
 
 COMMAND_SUBACCOUNT_CREATE = "subaccount create"
 
 COMMAND_WITHDRAW = "withdraw"
+COMMAND_BATCH_WITHDRAW = "batch withdraw"
 COMMAND_DEPOSIT = "deposit"
 COMMAND_LOAD_DEPOSIT_ADDRESS = "deposit_address"
 COMMAND_LOAD_SUB_ACCOUNTS = "sub_accounts"
 
+COMMAND_CACHE_STATS = "cache stats"
+COMMAND_CACHE_CLEAR = "cache clear"
+COMMAND_CACHE_INVALIDATE = "cache invalidate"
+
+COMMAND_TOKEN_STATUS = "token"
+
+COMMAND_LOG_STATS = "log stats"
+
+COMMAND_EXPORT = "export"
+
+COMMAND_RECON_STATUS = "recon status"
+COMMAND_RECON_HISTORY = "recon history"
+
+COMMAND_RULES = "rules"
+
+COMMAND_WATCH_ADD = "watch add"
+COMMAND_WATCH_REMOVE = "watch remove"
+COMMAND_WATCH_LIST = "watch list"
+
+COMMAND_JOURNAL_STATS = "journal stats"
+COMMAND_JOURNAL_AT = "journal at"
+
 
 class OptionalArgumentValue(object):
     def __init__(self, value, descr=""):
@@ -190,6 +216,34 @@ class Commands(object):
             )
         )
 
+        self.addCommand(
+            Command(
+                "batch",
+                [],
+                'Bulk requests, type "help batch" to get more help',
+                [
+                    Command(
+                        "withdraw",
+                        [
+                            CommandArgument("csv_path", "str"),
+                            CommandArgument("batch_id", "str"),
+                            CommandArgument("concurrency", "int", optional=True),
+                            CommandArgument(
+                                "unknown",
+                                "str",
+                                optional=True,
+                                values=[
+                                    OptionalArgumentValue("skip", "rows with no known outcome are left out"),
+                                    OptionalArgumentValue("retry", "resends them, check the server first"),
+                                ],
+                            ),
+                        ],
+                        "sends every row of an address,currency,amount,entity_id csv, rerun with the same batch id to resume",
+                    )
+                ],
+            )
+        )
+
         self.addCommand(
             Command(
                 "deposit_address",
@@ -211,6 +265,185 @@ class Commands(object):
             )
         )
 
+        self.addCommand(
+            Command(
+                "balance",
+                [],
+                'Cash reports, type "help balance" to get more help',
+                [
+                    Command("show", [], "prints wallets, custody and limbo totals"),
+                    Command("list", [], "prints every user's balances"),
+                    Command("json", [], "prints the latest state snapshot as json"),
+                    Command(
+                        "top",
+                        [
+                            CommandArgument("currency", "str"),
+                            CommandArgument("count", "int"),
+                        ],
+                        "prints the largest custody balances in a currency",
+                    ),
+                    Command(
+                        "above",
+                        [
+                            CommandArgument("currency", "str"),
+                            CommandArgument("threshold", "Decimal"),
+                        ],
+                        "prints every entity holding more than threshold",
+                    ),
+                ],
+            )
+        )
+
+        self.addCommand(
+            Command(
+                "export",
+                [
+                    CommandArgument(
+                        "table",
+                        "str",
+                        values=[
+                            OptionalArgumentValue("users", "balance per entity and currency"),
+                            OptionalArgumentValue("sessions", "known sessions"),
+                        ],
+                    ),
+                    CommandArgument(
+                        "format",
+                        "str",
+                        values=[
+                            OptionalArgumentValue("jsonl"),
+                            OptionalArgumentValue("csv"),
+                            OptionalArgumentValue("parquet"),
+                        ],
+                    ),
+                    CommandArgument("path", "str"),
+                    CommandArgument(
+                        "compression",
+                        "str",
+                        optional=True,
+                        values=[
+                            OptionalArgumentValue("none"),
+                            OptionalArgumentValue("gzip"),
+                            OptionalArgumentValue("zstd"),
+                        ],
+                    ),
+                    CommandArgument("columns", "str", optional=True),
+                ],
+                "streams a table to a file, columns is a comma separated list",
+            )
+        )
+
+        self.addCommand(
+            Command("token", [], "prints access token expiry and refresh metrics")
+        )
+
+        self.addCommand(
+            Command(
+                "log",
+                [],
+                'Log output, type "help log" to get more help',
+                [Command("stats", [], "prints log records seen, sampled and dropped per category")],
+            )
+        )
+
+        self.addCommand(
+            Command("rules", [], "prints alert rules, which are tripped and recent alerts")
+        )
+
+        self.addCommand(
+            Command(
+                "watch",
+                [],
+                'Balance subscriptions, type "help watch" to get more help',
+                [
+                    Command(
+                        "add",
+                        [CommandArgument("entity_ids", "str")],
+                        "subscribes to a comma separated list of entities, 0 for all",
+                    ),
+                    Command(
+                        "remove",
+                        [CommandArgument("entity_ids", "str")],
+                        "drops entities from the watch list",
+                    ),
+                    Command("list", [], "prints the active balance subscriptions"),
+                ],
+            )
+        )
+
+        self.addCommand(
+            Command(
+                "journal",
+                [],
+                'State change journal, type "help journal" to get more help',
+                [
+                    Command("stats", [], "prints journal position, fsyncs and compactions"),
+                    Command(
+                        "at",
+                        [CommandArgument("time", "str")],
+                        "prints balances as of a time: epoch, iso datetime or HH:MM today",
+                    ),
+                ],
+            )
+        )
+
+        self.addCommand(
+            Command(
+                "recon",
+                [],
+                'Reconciliation of custody vs wallets, type "help recon" to get more help',
+                [
+                    Command("status", [], "prints assets, liabilities and difference per currency"),
+                    Command(
+                        "history",
+                        [CommandArgument("count", "int", optional=True)],
+                        "prints past and open breaks, most recent first",
+                    ),
+                ],
+            )
+        )
+
+        self.addCommand(
+            Command(
+                "cache",
+                [],
+                'Lookup cache manage, type "help cache" to get more help',
+                [
+                    Command("stats", [], "prints cache size and hit/miss counters"),
+                    Command(
+                        "clear",
+                        [
+                            CommandArgument(
+                                "cache",
+                                "str",
+                                optional=True,
+                                values=[
+                                    OptionalArgumentValue("all"),
+                                    OptionalArgumentValue("deposit_address"),
+                                    OptionalArgumentValue("sub_accounts"),
+                                ],
+                            )
+                        ],
+                        "drops cached lookups",
+                    ),
+                    Command(
+                        "invalidate",
+                        [
+                            CommandArgument(
+                                "cache",
+                                "str",
+                                values=[
+                                    OptionalArgumentValue("deposit_address"),
+                                    OptionalArgumentValue("sub_accounts"),
+                                ],
+                            ),
+                            CommandArgument("reference_str", "str"),
+                        ],
+                        "drops the cached lookup for one reference",
+                    ),
+                ],
+            )
+        )
+
     def addCommand(self, command):
         self.commands[command.name] = command
 
@@ -0,0 +1,334 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from lib.api_connection import (
+    AdminApiConnection,
+    REPLY_SUBACCOUNT_CREATE,
+    REPLY_WITHDRAW,
+    isErrorReply,
+    makeWithdrawRequest,
+    matchWithdrawReply,
+)
+from lib.cash import (
+    ACCOUNT_KEY,
+    BALANCE_KEY,
+    BALANCES_KEY,
+    CURRENCY_KEY,
+    ENTITY_ID_KEY,
+    LOCATION_KEY,
+    CashMetrics,
+)
+from lib.sessions import SESSIONS_PATH, SessionMap, SessionStreamLoader
+from lib import withdraw_batch
+from lib.change_feed import NotificationStream
+from lib.log_pipeline import CATEGORY_REPLY
+from lib.lookups import DEFAULT_CONCURRENCY, Lookups
+from lib.reconcile import Reconciler
+from lib.rules import RuleEngine
+from lib.snapshots import SnapshotPublisher
+
+replyLog = logging.getLogger(CATEGORY_REPLY)
+
+DEFAULT_STREAM_SIZE = 1024
+DEFAULT_REPLY_TIMEOUT = 30
+
+
+## results ##
+@dataclass(slots=True, frozen=True)
+class SubAccountResult:
+    email: str
+    reply: object
+
+
+@dataclass(slots=True, frozen=True)
+class WithdrawResult:
+    address: str
+    currency: str
+    amount: str
+    entity_id: int
+    reply: object
+
+
+@dataclass(slots=True, frozen=True)
+class DepositAddressResult:
+    reference: str
+    address: object
+    reply: object
+
+
+@dataclass(slots=True, frozen=True)
+class SubAccountsResult:
+    reference: str
+    accounts: list
+    reply: object
+
+
+## notifications ##
+@dataclass(slots=True, frozen=True)
+class BalanceUpdate:
+    entity_id: int
+    balances: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True, frozen=True)
+class WalletUpdate:
+    location: str
+    balances: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True, frozen=True)
+class WithdrawQueueSize:
+    size: object
+
+
+def _getField(reply, key):
+    if isinstance(reply, dict):
+        return reply.get(key)
+    return None
+
+
+def _parseBalances(entries):
+    balances = {}
+    for entry in entries or []:
+        if CURRENCY_KEY not in entry or BALANCE_KEY not in entry:
+            continue
+        balances[entry[CURRENCY_KEY]] = Decimal(entry[BALANCE_KEY])
+    return balances
+
+
+class AdminClient(object):
+    def __init__(self, env, key=None, replyTimeout=DEFAULT_REPLY_TIMEOUT):
+        self.connection = AdminApiConnection(env, key, stopLoopOnError=False)
+        self.cashMetrics = CashMetrics()
+        self.sessionMap = SessionMap()
+        self.connection.streamSinks[SESSIONS_PATH] = SessionStreamLoader(self.sessionMap)
+        self.snapshots = SnapshotPublisher(self.cashMetrics, self.sessionMap)
+        self.reconciler = Reconciler(self.cashMetrics, self.sessionMap)
+        self.rules = RuleEngine(self.cashMetrics.changeFeed)
+        self.lookups = Lookups(self.connection, replyTimeout)
+        self.replyTimeout = replyTimeout
+        self._streams = {}
+        self._loggedIn = asyncio.Event()
+        self._runTask = None
+
+    ## lifetime ##
+    async def start(self):
+        self._runTask = asyncio.create_task(
+            self.connection.run(self), name="admin client task"
+        )
+
+        # whichever comes first: login or the connection dying
+        loginTask = asyncio.create_task(self._loggedIn.wait())
+        done, _ = await asyncio.wait(
+            [loginTask, self._runTask], return_when=asyncio.FIRST_COMPLETED
+        )
+        if loginTask not in done:
+            loginTask.cancel()
+            self._runTask.result()
+            raise Exception("connection closed before login")
+
+    async def close(self):
+        if self._runTask == None:
+            return
+        self._runTask.cancel()
+        try:
+            await self._runTask
+        except asyncio.CancelledError:
+            pass
+        self._runTask = None
+        self._loggedIn.clear()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    ## requests ##
+    async def _request(self, replyKey, send, match=None):
+        future = self.connection.waitReply(replyKey, match=match)
+        try:
+            await send
+        except Exception:
+            self.connection.cancelReply(replyKey, future)
+            raise
+        return await asyncio.wait_for(future, self.replyTimeout)
+
+    async def create_sub_account(self, email) -> SubAccountResult:
+        reply = await self._request(
+            REPLY_SUBACCOUNT_CREATE, self.connection.createSubAccount(email)
+        )
+        return SubAccountResult(email, reply)
+
+    async def withdraw(
+        self, address, currency, amount, entity_id=None, idempotency_key=None
+    ) -> WithdrawResult:
+        # amounts go over the wire as strings, validate them here
+        amount = str(Decimal(amount))
+        request = makeWithdrawRequest(
+            address, currency, amount, entity_id, idempotency_key
+        )
+        reply = await self._request(
+            REPLY_WITHDRAW,
+            self.connection.withdraw(
+                address, currency, amount, entity_id, idempotency_key
+            ),
+            matchWithdrawReply(request),
+        )
+        return WithdrawResult(address, currency, amount, entity_id or 0, reply)
+
+    async def withdraw_many(
+        self,
+        rows,
+        journalPath,
+        batchId,
+        concurrency=withdraw_batch.DEFAULT_CONCURRENCY,
+        retryUnknown=False,
+    ) -> withdraw_batch.BatchResult:
+        # rows as in withdraw_batch.withdraw_many, or the path of a csv file.
+        # the journal makes a rerun with the same batch id skip acked rows
+        if isinstance(rows, str):
+            rows = withdraw_batch.loadRowsCsv(rows)
+        return await withdraw_batch.withdraw_many(
+            self, rows, journalPath, batchId, concurrency, retryUnknown
+        )
+
+    def _depositAddressResult(self, ref_str, reply):
+        return DepositAddressResult(ref_str, _getField(reply, "address"), reply)
+
+    def _subAccountsResult(self, ref_str, reply):
+        accounts = reply if isinstance(reply, list) else _getField(reply, "accounts")
+        return SubAccountsResult(ref_str, accounts or [], reply)
+
+    async def load_deposit_address(self, ref_str) -> DepositAddressResult:
+        reply = await self.lookups.load_deposit_address(ref_str)
+        return self._depositAddressResult(ref_str, reply)
+
+    async def load_sub_accounts(self, ref_str) -> SubAccountsResult:
+        reply = await self.lookups.load_sub_accounts(ref_str)
+        return self._subAccountsResult(ref_str, reply)
+
+    async def stream_sub_accounts(self, ref_str, onAccount) -> int:
+        # uncached, for references with more accounts than should sit in memory
+        count, reply = await self.lookups.stream_sub_accounts(ref_str, onAccount)
+        if isErrorReply(reply):
+            raise Exception(f"loading sub accounts for {ref_str} failed: {reply}")
+        return count
+
+    async def load_deposit_addresses(
+        self, refs, concurrency=DEFAULT_CONCURRENCY
+    ) -> dict:
+        replies = await self.lookups.load_deposit_addresses(refs, concurrency)
+        return {
+            ref: self._depositAddressResult(ref, reply)
+            for ref, reply in replies.items()
+        }
+
+    async def load_sub_accounts_many(
+        self, refs, concurrency=DEFAULT_CONCURRENCY
+    ) -> dict:
+        replies = await self.lookups.load_sub_accounts_many(refs, concurrency)
+        return {
+            ref: self._subAccountsResult(ref, reply) for ref, reply in replies.items()
+        }
+
+    ## state ##
+    def snapshot(self):
+        # immutable, consistent view of the balances as of the last notification
+        return self.snapshots.latest()
+
+    ## streams ##
+    async def _stream(self, streamType, maxsize, subscribe=None):
+        stream = NotificationStream(maxsize)
+        if streamType not in self._streams:
+            self._streams[streamType] = set()
+        self._streams[streamType].add(stream)
+        try:
+            # register before subscribing so the first push isn't missed
+            if subscribe:
+                await subscribe
+            while True:
+                yield await stream.get()
+        finally:
+            self._streams[streamType].discard(stream)
+            if stream.dropped:
+                logging.warning(
+                    f"{streamType.__name__} stream dropped {stream.dropped} entries"
+                )
+
+    def _publish(self, streamType, item):
+        for stream in self._streams.get(streamType, ()):
+            stream.push(item)
+
+    async def stream_balances(self, entity_id=0, maxsize=DEFAULT_STREAM_SIZE):
+        # entity id set to 0 means all user balances, overlapping streams
+        # share one server side subscription
+        owner = object()
+        subscriptions = self.connection.subscriptions
+        subscribe = subscriptions.watch(owner, [entity_id])
+        try:
+            async for update in self._stream(BalanceUpdate, maxsize, subscribe):
+                if entity_id and update.entity_id != entity_id:
+                    continue
+                yield update
+        finally:
+            subscriptions.release(owner)
+
+    def watch(self, entity_ids, owner=None):
+        # keeps only these entities subscribed for the owner, returns an
+        # awaitable completing once the diff was sent
+        return self.connection.subscriptions.watch(owner or self, entity_ids)
+
+    def stream_deltas(self, maxsize=DEFAULT_STREAM_SIZE):
+        # per (entity, currency) and (location, currency) changes only,
+        # no-op updates never show up here
+        return self.cashMetrics.changeFeed.stream(maxsize)
+
+    async def stream_wallets(self, maxsize=DEFAULT_STREAM_SIZE):
+        async for update in self._stream(WalletUpdate, maxsize):
+            yield update
+
+    async def stream_withdraw_queue_size(self, maxsize=DEFAULT_STREAM_SIZE):
+        async for update in self._stream(WithdrawQueueSize, maxsize):
+            yield update
+
+    ## listener interface ##
+    async def onLoginSuccess(self):
+        self._loggedIn.set()
+
+    async def handleCashMetricsUpdate(self, notif):
+        self.cashMetrics.update(notif)
+        self.snapshots.publish()
+        if ACCOUNT_KEY in notif and ENTITY_ID_KEY in notif:
+            self._publish(
+                BalanceUpdate,
+                BalanceUpdate(notif[ENTITY_ID_KEY], _parseBalances(notif[ACCOUNT_KEY])),
+            )
+        elif LOCATION_KEY in notif and BALANCES_KEY in notif:
+            self._publish(
+                WalletUpdate,
+                WalletUpdate(notif[LOCATION_KEY], _parseBalances(notif[BALANCES_KEY])),
+            )
+
+    async def handleLiquidBalanceUpdate(self, notif):
+        await self.handleCashMetricsUpdate(notif)
+
+    async def handleWithdrawQueueSizeUpdate(self, notif):
+        self.rules.updateWithdrawQueueSize(notif)
+        self._publish(WithdrawQueueSize, WithdrawQueueSize(notif))
+
+    # replies nobody waited on
+    async def on_subaccount_create(self, data):
+        replyLog.info("unsolicited sub account reply", extra={"data": data})
+
+    async def on_withdraw(self, data):
+        replyLog.info("unsolicited withdraw reply", extra={"data": data})
+
+    async def on_load_deposit_address(self, data):
+        replyLog.info("unsolicited deposit address reply", extra={"data": data})
+
+    async def on_load_sub_accounts(self, data):
+        replyLog.info("unsolicited sub accounts reply", extra={"data": data})
@@ -1,4 +1,11 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
 from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
 
 PriorityMap = {
    "low": 1,
@@ -6,6 +13,10 @@ PriorityMap = {
    "critical": 3
 }
 
+EVENT_ACTIVATED = "activated"
+EVENT_DEACTIVATED = "deactivated"
+
+@lru_cache(maxsize=4096)
 def toHumanTime(timestamp_s):
    dt = datetime.fromtimestamp(int(timestamp_s))
    return dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -19,6 +30,17 @@ class Announcement(object):
       self.start = data['start']
       self.end = data['end']
 
+   def getLevel(self):
+      return PriorityMap.get(self.priority, 0)
+
+   def hasEnd(self):
+      return self.end != None and self.end != 0
+
+   def isActiveAt(self, now):
+      if not self.enabled or self.start > now:
+         return False
+      return not self.hasEnd() or now < self.end
+
    def __str__(self):
       result = f"   . id: {self.id}, enabled: {self.enabled}\n"
       startAt = toHumanTime(self.start)
@@ -30,26 +52,195 @@ class Announcement(object):
       result += f"     priority: {self.priority}\n"
       return result
 
+   def toDict(self):
+      return {
+         'id': self.id,
+         'on': self.enabled,
+         'priority': self.priority,
+         'message': self.message,
+         'start': self.start,
+         'end': self.end
+      }
+
 class Announcements(object):
-   def __init__(self):
+   def __init__(self, clock=time.time):
       self.announcements = {}
+      self.version = 0
+      self._render = (None, None)
+
+      #active set, bucketed by priority level, kept current by the timer
+      self.clock = clock
+      self.active = {}
+      self.activeByLevel = {level: {} for level in [0] + list(PriorityMap.values())}
+      self._activeView = MappingProxyType(self.active)
+      self._activeViews = {level: MappingProxyType(bucket) \
+         for level, bucket in self.activeByLevel.items()}
+      self._subscribers = []
+
+      #(timestamp, id, generation) min heaps, superseded entries are
+      #skipped when they surface
+      self._starts = []
+      self._ends = []
+      self._generations = {}
+      self._timer = None
 
    def update(self, data):
+      now = self.clock()
       for ann in data:
          annObj = Announcement(ann)
          self.announcements[annObj.id] = annObj
+         self.schedule(annObj, now)
+      self.version += 1
+      self.compact()
+      self.arm()
+
+   ## active set ##
+   def subscribe(self, callback):
+      #callback(event, announcement) on every activation and deactivation
+      self._subscribers.append(callback)
+
+   def notify(self, event, annObj):
+      for callback in self._subscribers:
+         try:
+            callback(event, annObj)
+         except Exception as e:
+            logging.error(f"announcement subscriber failed: {e}")
+
+   def schedule(self, annObj, now):
+      generation = self._generations.get(annObj.id, 0) + 1
+      self._generations[annObj.id] = generation
+
+      previous = self.active.pop(annObj.id, None)
+      if previous != None:
+         del self.activeByLevel[previous.getLevel()][annObj.id]
+
+      if annObj.isActiveAt(now):
+         self.activate(annObj)
+         if annObj.hasEnd():
+            heapq.heappush(self._ends, (annObj.end, annObj.id, generation))
+         if previous == None:
+            self.notify(EVENT_ACTIVATED, annObj)
+         return
+
+      if previous != None:
+         self.notify(EVENT_DEACTIVATED, previous)
+      if annObj.enabled and annObj.start > now:
+         heapq.heappush(self._starts, (annObj.start, annObj.id, generation))
+
+   def activate(self, annObj):
+      self.active[annObj.id] = annObj
+      self.activeByLevel[annObj.getLevel()][annObj.id] = annObj
+
+   def advance(self, now=None):
+      #applies every start and end that is due
+      if now == None:
+         now = self.clock()
+
+      while self._starts and self._starts[0][0] <= now:
+         _, annId, generation = heapq.heappop(self._starts)
+         if self._generations.get(annId) != generation:
+            continue
+         annObj = self.announcements[annId]
+         if not annObj.isActiveAt(now):
+            #already over by the time it started
+            continue
+         self.activate(annObj)
+         if annObj.hasEnd():
+            heapq.heappush(self._ends, (annObj.end, annId, generation))
+         self.version += 1
+         self.notify(EVENT_ACTIVATED, annObj)
+
+      while self._ends and self._ends[0][0] <= now:
+         _, annId, generation = heapq.heappop(self._ends)
+         if self._generations.get(annId) != generation or annId not in self.active:
+            continue
+         annObj = self.active.pop(annId)
+         del self.activeByLevel[annObj.getLevel()][annId]
+         self.version += 1
+         self.notify(EVENT_DEACTIVATED, annObj)
+
+   def compact(self):
+      #rebuilds a heap once superseded entries outnumber the live ones
+      limit = 2 * len(self.announcements) + 64
+      for name in ['_starts', '_ends']:
+         heap = getattr(self, name)
+         if len(heap) > limit:
+            heap = [entry for entry in heap if self._generations.get(entry[1]) == entry[2]]
+            heapq.heapify(heap)
+            setattr(self, name, heap)
+
+   def getNextChange(self):
+      #earliest pending start or end, stale heap tops are dropped on the way
+      for heap in [self._starts, self._ends]:
+         while heap and self._generations.get(heap[0][1]) != heap[0][2]:
+            heapq.heappop(heap)
+      times = [heap[0][0] for heap in [self._starts, self._ends] if heap]
+      return min(times) if times else None
+
+   def arm(self):
+      #one timer on the loop, set for the next start or end
+      try:
+         loop = asyncio.get_running_loop()
+      except RuntimeError:
+         #no loop, callers advance() themselves
+         return
+
+      if self._timer != None:
+         self._timer.cancel()
+         self._timer = None
+
+      nextChange = self.getNextChange()
+      if nextChange == None:
+         return
+      delay = max(0, nextChange - self.clock())
+      self._timer = loop.call_later(delay, self.onTimer)
+
+   def onTimer(self):
+      self._timer = None
+      self.advance()
+      self.arm()
+
+   def getActive(self, level=None):
+      #read only views, no copy and no scan
+      if level == None:
+         return self._activeView
+      if isinstance(level, str):
+         level = PriorityMap[level]
+      return self._activeViews[level]
+
+   def getActiveAtLeast(self, level):
+      if isinstance(level, str):
+         level = PriorityMap[level]
+      result = {}
+      for bucketLevel, bucket in self.activeByLevel.items():
+         if bucketLevel >= level:
+            result.update(bucket)
+      return result
 
    def __str__(self):
-      result = " - announcements:\n"
-      if not self.announcements:
-         result += "   . N/A\n"
+      version, result = self._render
+      if version == self.version:
          return result
 
-      for annId in self.announcements:
-         ann = self.announcements[annId]
-         result += f"{str(ann)}\n"
+      result = [" - announcements:\n"]
+      if not self.announcements:
+         result.append("   . N/A\n")
+      else:
+         for annId in self.announcements:
+            ann = self.announcements[annId]
+            live = "     live now\n" if annId in self.active else ""
+            result.append(f"{str(ann)}{live}\n")
+
+      result = "".join(result)
+      self._render = (self.version, result)
       return result
 
+   def toDict(self):
+      return [ann.toDict() for ann in self.announcements.values()]
+
+   def toJson(self):
+      return json.dumps(self.toDict(), default=str)
+
    def getById(self, cId):
       if cId not in self.announcements:
          return None
@@ -1,27 +1,121 @@
-import websockets
 import json
 import asyncio
 import logging
+import random
+import time
+from collections import deque
+from decimal import Decimal
 
-from SDK.leverex_core.login_connection import LoginServiceClientWS
+from lib.log_pipeline import CATEGORY_LOGIN, CATEGORY_NOTIF, CATEGORY_REPLY
+from lib.stream_parse import decodeFrame
+from lib.subscriptions import SubscriptionManager
+from lib.token_refresh import TokenRefresher
+from lib.ws_transport import WriteCoalescer, getConnectOptions, getTransportSettings
 
 urls = {
     "devbrown": {
         "api": "wss://api-devbrown.leverex.io",
         "aeid": "https://staging.autheid.com",
         "login": "wss://login-devbrown.leverex.io/ws/v1/websocket",
+        # websockets tuning, see ws_transport.DEFAULT_TRANSPORT
+        "transport": {},
     },
 }
 
+REPLY_SUBACCOUNT_CREATE = "account_created"
+REPLY_WITHDRAW = "withdraw_liquid"
+REPLY_LOAD_DEPOSIT_ADDRESS = "load_deposit_address"
+REPLY_LOAD_SUB_ACCOUNTS = "load_sub_accounts"
+
+# sub account lists, either the reply itself or under "accounts"
+SUB_ACCOUNTS_PATHS = [(REPLY_LOAD_SUB_ACCOUNTS,), (REPLY_LOAD_SUB_ACCOUNTS, "accounts")]
+
+
+notifLog = logging.getLogger(CATEGORY_NOTIF)
+loginLog = logging.getLogger(CATEGORY_LOGIN)
+replyLog = logging.getLogger(CATEGORY_REPLY)
+
+# delay between reconnect attempts, doubled up to the max
+RECONNECT_BACKOFF_MIN = 1
+RECONNECT_BACKOFF_MAX = 30
+
+# callbacks whose replies never came are dropped after this many seconds
+DEFAULT_CALLBACK_TTL = 300
+CALLBACK_SWEEP_INTERVAL = 1
+
+
+def isErrorReply(reply):
+    if not isinstance(reply, dict):
+        return False
+    if reply.get("success") == False:
+        return True
+    return bool(reply.get("error") or reply.get("error_msg"))
+
 
 class NoCallbackException(Exception):
     pass
 
 
+class AmbiguousReplyException(Exception):
+    def __init__(self, replyKey):
+        super().__init__(f"{replyKey} reply could not be matched to its request")
+
+
+AMBIGUOUS_REPLY = -1
+
+# reply fields a withdrawal reply may echo back, compared to the request
+WITHDRAW_ECHO_FIELDS = {
+    "idempotency_key": str,
+    "address": str,
+    "currency": str,
+    "amount": Decimal,
+    "entity_id": int,
+}
+
+
+def makeWithdrawRequest(
+    address, currency, amount, entity_id=None, idempotency_key=None
+):
+    request = {
+        "address": address,
+        "currency": currency,
+        "amount": amount,
+        "entity_id": entity_id or 0,
+    }
+    if idempotency_key:
+        # assumption: not a documented request field, a server ignoring it
+        # gives no duplicate protection
+        request["idempotency_key"] = idempotency_key
+    return request
+
+
+def matchWithdrawReply(request):
+    # True if the reply echoes this request, False if it echoes another one,
+    # None if it echoes nothing to tell
+    def match(reply):
+        if not isinstance(reply, dict):
+            return None
+        echoed = [key for key in WITHDRAW_ECHO_FIELDS if key in reply]
+        if not echoed:
+            return None
+        try:
+            return all(
+                WITHDRAW_ECHO_FIELDS[key](reply[key])
+                == WITHDRAW_ECHO_FIELDS[key](request[key])
+                for key in echoed
+                if key in request
+            )
+        except (ArithmeticError, TypeError, ValueError):
+            return False
+
+    return match
+
+
 class RequestCallback(object):
-    def __init__(self, callback, count):
+    def __init__(self, callback, count, ttl):
         self.callback = callback
         self.count = count
+        self.expiresAt = time.monotonic() + ttl
 
     async def fire(self, data):
         await self.callback(data)
@@ -30,14 +124,31 @@ class RequestCallback(object):
 
 
 class AdminApiConnection(object):
-    def __init__(self, env, key=None):
+    def __init__(self, env, key=None, stopLoopOnError=True):
         self.env = env
         self.websocket = None
         self.access_token = None
         self.listener = None
         self.loginStatus = False
         self.key = key
+        self.loginClient = None
+        self.tokenRefresher = None
+        self.transport = getTransportSettings(urls.get(env, {}).get("transport"))
+        self.writer = None
+        self.recorder = None
+        self.subscriptions = SubscriptionManager(self)
+        # frame path -> ArraySink, those arrays are handed over element by element
+        self.streamSinks = {}
         self._callbacks = {}
+        self.callbackTtl = DEFAULT_CALLBACK_TTL
+        self.expiredCallbacks = 0
+        self.reconnects = 0
+        self.logins = 0
+        self._nextCallbackSweep = 0
+        self._replyWaiters = {}
+
+        # embedders own the event loop, they get the exception instead
+        self.stopLoopOnError = stopLoopOnError
 
         if env not in urls:
             logging.error(f"invalid environment: {env}")
@@ -46,49 +157,74 @@ class AdminApiConnection(object):
     ## login rountines ##
     async def getAccessToken(self):
         # get token from login server
-        print("logging in...")
+        loginLog.info("logging in", extra={"env": self.env})
+
+        # the login stack (crypto, QR code rendering) is only loaded once
+        # we actually log in, not for --help or a failed argument parse
+        from SDK.leverex_core.login_connection import LoginServiceClientWS
 
-        loginClient = LoginServiceClientWS(
+        # kept around to cycle the token with
+        self.loginClient = LoginServiceClientWS(
             self.key,
             urls[self.env]["login"],
             aeid_endpoint=urls[self.env]["aeid"],
             dump_communication=True,
         )
-        access_token_info = await loginClient.logMeIn(urls[self.env]["api"])
+        access_token_info = await self.loginClient.logMeIn(urls[self.env]["api"])
 
         if access_token_info == None:
             raise Exception("Failed to get access token")
         return access_token_info
 
+    async def relogin(self):
+        # the refresher keeps cycling with the new login client
+        token = await self.getAccessToken()
+        self.tokenRefresher.loginClient = self.loginClient
+        return token
+
+    def onTokenExpired(self):
+        # logged out until the server accepts the new token
+        self.loginStatus = False
+        loginLog.error("access token expired, logging in again", extra={"env": self.env})
+
+    async def send(self, msg):
+        data = json.dumps(msg)
+        if self.writer:
+            await self.writer.send(data)
+            return
+        await self.websocket.send(data)
+
+    def record(self, path):
+        # appends every incoming frame, replayed by bench/transport.py
+        self.recorder = open(path, "a", buffering=1)
+
     async def authorize(self, token):
         auth_request = {
             "authorize": {"token": token["access_token"]},
         }
         self.access_token = token
-        await self.websocket.send(json.dumps(auth_request))
+        if self.websocket == None:
+            # reconnecting, the new connection is authorized with this token
+            return
+        import websockets
+
+        try:
+            await self.send(auth_request)
+        except websockets.ConnectionClosed:
+            # dropped under a token refresh, same as above
+            pass
 
     async def connected(self):
         auth_request = {
             # "request": "authorize",
             "connected": {},
         }
-        await self.websocket.send(json.dumps(auth_request))
+        await self.send(auth_request)
 
     async def cycleToken(self):
-        while True:
-            # wait for token lifetime - 1min
-            await asyncio.sleep(self.access_token["expires_in"] * 0.9)
-
-            # cycle token with login server
-            loginClient = LoginServiceClientWS(
-                self.key, urls[self.env]["login"], aeid_endpoint=urls[self.env]["aeid"]
-            )
-            access_token = await loginClient.update_access_token(
-                self.access_token["access_token"]
-            )
-
-            # send to service
-            await self.authorize(access_token)
+        # refresh ahead of expiry with retries, successor token is
+        # pushed to every session sharing the refresher
+        await self.tokenRefresher.run()
 
     ## asyncio entry point ##
     async def run(self, listener):
@@ -97,51 +233,122 @@ class AdminApiConnection(object):
         try:
             # get access token
             accessToken = await self.getAccessToken()
-            # set admin custom CA & connect to admin api
-            # custom_ca_context = ssl.create_default_context(cafile="leverex_local.crt")
-            async with websockets.connect(
-                urls[self.env]["api"],  # ssl=custom_ca_context
-            ) as self.websocket:
-                # autorize connection with acceess token
-                # await self.connected()
-                await self.authorize(accessToken)
-
-                # start read and token cycling loops, they will be awaited when TaskGroup scopes out
-                async with asyncio.TaskGroup() as tg:
-                    readTask = tg.create_task(self.readLoop(), name="admin read task")
-                    cycleTask = tg.create_task(
-                        self.cycleToken(), name="admin login cycle task"
-                    )
+            self.tokenRefresher = TokenRefresher(
+                self.loginClient, accessToken, login=self.relogin
+            )
+            self.tokenRefresher.addSession(self)
 
-        except Exception:
-            import traceback
+            # start connection and token cycling loops, they will be awaited when TaskGroup scopes out
+            async with asyncio.TaskGroup() as tg:
+                connectTask = tg.create_task(
+                    self.connectLoop(), name="admin connection task"
+                )
+                cycleTask = tg.create_task(
+                    self.cycleToken(), name="admin login cycle task"
+                )
 
-            traceback.print_exc()
-            print(f"connection failed with error: {urls[self.env]}")
+        except Exception:
+            logging.exception(f"connection failed with error: {urls[self.env]}")
+            if not self.stopLoopOnError:
+                raise
             loop = asyncio.get_running_loop()
             loop.stop()
             return
 
+    async def connectLoop(self):
+        # a dropped connection is reopened with backoff and authorized with
+        # the current token, subscriptions are restored once logged back in.
+        # failing to connect the first time is fatal
+        import websockets
+
+        backoff = RECONNECT_BACKOFF_MIN
+        connectedOnce = False
+        while True:
+            try:
+                # set admin custom CA & connect to admin api
+                # custom_ca_context = ssl.create_default_context(cafile="leverex_local.crt")
+                async with websockets.connect(
+                    urls[self.env]["api"],  # ssl=custom_ca_context
+                    **getConnectOptions(self.transport),
+                ) as self.websocket:
+                    connectedOnce = True
+                    self.loginStatus = False
+                    self.subscriptions.reset()
+                    self.writer = None
+                    if self.transport["write_coalesce"]:
+                        self.writer = WriteCoalescer(self.websocket)
+                    # autorize connection with acceess token
+                    # await self.connected()
+                    await self.authorize(self.tokenRefresher.token)
+                    await self.readLoop()
+
+            except (websockets.WebSocketException, OSError) as e:
+                if not connectedOnce:
+                    raise
+                if self.loginStatus:
+                    backoff = RECONNECT_BACKOFF_MIN
+                loginLog.warning(
+                    "connection lost, reconnecting",
+                    extra={"env": self.env, "error": str(e), "delay": backoff},
+                )
+            finally:
+                self.websocket = None
+                self.writer = None
+                self.loginStatus = False
+
+            self.reconnects += 1
+            await asyncio.sleep(backoff * random.uniform(0.5, 1))
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
     ## wait on data from primary ws session ##
     async def readLoop(self):
         while True:
             data = await self.websocket.recv()
             if data is None:
                 continue
-            data_json = json.loads(data)
+            if self.recorder:
+                self.recorder.write(data + "\n")
+            data_json = decodeFrame(data, self.getStreamSinks())
             if "notification" in data_json:
                 await self.processNotification(data_json)
             else:
                 await self.processResponse(data_json)
 
+    def getStreamSinks(self):
+        # a sub account reply streams only when its waiter asked for it
+        sinks = self.streamSinks
+        waiters = self._replyWaiters.get(REPLY_LOAD_SUB_ACCOUNTS)
+        if waiters and waiters[0][1] != None:
+            sinks = dict(sinks)
+            for path in SUB_ACCOUNTS_PATHS:
+                sinks[path] = waiters[0][1]
+        return sinks
+
     ## callback handlers
-    def queueCallback(self, key, callback, callbackCount=1):
+    def queueCallback(self, key, callback, callbackCount=1, ttl=None):
         if callback == None:
             return
 
+        self.expireCallbacks()
         if key in self._callbacks:
             raise Exception(f"callback collision! ({key})")
-        self._callbacks[key] = RequestCallback(callback, callbackCount)
+        self._callbacks[key] = RequestCallback(
+            callback, callbackCount, ttl or self.callbackTtl
+        )
+
+    def expireCallbacks(self):
+        # swept at most once a second, on the next queued callback
+        now = time.monotonic()
+        if now < self._nextCallbackSweep:
+            return
+        self._nextCallbackSweep = now + CALLBACK_SWEEP_INTERVAL
+
+        expired = [key for key, cb in self._callbacks.items() if cb.expiresAt <= now]
+        for key in expired:
+            del self._callbacks[key]
+        if expired:
+            self.expiredCallbacks += len(expired)
+            logging.warning(f"dropped {len(expired)} callbacks with no reply")
 
     async def fireCallback(self, key, data):
         callback = None
@@ -155,41 +362,117 @@ class AdminApiConnection(object):
         if done:
             del self._callbacks[key]
 
+    ## reply waiters ##
+    # admin replies carry no reference, the server answers them in the
+    # order the requests were sent so waiters are resolved FIFO per reply type.
+    # a waiter with a match callback only takes a reply echoing its request
+    def waitReply(self, replyKey, sink=None, match=None):
+        # with a sink, list payloads in the reply go to it instead of the future
+        future = asyncio.get_running_loop().create_future()
+        if replyKey not in self._replyWaiters:
+            self._replyWaiters[replyKey] = deque()
+        self._replyWaiters[replyKey].append((future, sink, match))
+        return future
+
+    def findWaiter(self, waiters, data):
+        # index of the waiter the reply belongs to, None if it echoes a
+        # request nobody waits for, AMBIGUOUS_REPLY if it can't be told apart
+        results = [match(data) if match else None for _, _, match in waiters]
+        for index, result in enumerate(results):
+            if result == True:
+                return index
+        if False in results and None not in results:
+            return None
+        if len(waiters) > 1 and any(match for _, _, match in waiters):
+            return AMBIGUOUS_REPLY
+        return 0
+
+    def resolveReply(self, replyKey, data):
+        waiters = self._replyWaiters.get(replyKey)
+        if not waiters:
+            return False
+
+        index = self.findWaiter(waiters, data)
+        if index == None:
+            return False
+        if index == AMBIGUOUS_REPLY:
+            # several correlated requests in flight and the reply echoes none
+            # of their fields, none of them can tell which reply is theirs
+            replyLog.error(
+                "uncorrelated reply", extra={"reply_key": replyKey, "data": data}
+            )
+            for waiter in [w for w in waiters if w[2]]:
+                waiters.remove(waiter)
+                if not waiter[0].done():
+                    waiter[0].set_exception(AmbiguousReplyException(replyKey))
+            return True
+
+        future, _, _ = waiters[index]
+        del waiters[index]
+        if future.done():
+            # waiter timed out, the late reply still belongs to it
+            replyLog.info("dropping late reply", extra={"reply_key": replyKey, "data": data})
+            return True
+        future.set_result(data)
+        return True
+
+    def detachSink(self, replyKey, future):
+        # the waiter stays in line for its late reply, nothing is streamed to it
+        waiters = self._replyWaiters.get(replyKey)
+        if waiters:
+            for index, (waiter, sink, match) in enumerate(waiters):
+                if waiter is future:
+                    waiters[index] = (waiter, None, match)
+                    break
+
+    def cancelReply(self, replyKey, future):
+        # the request never made it out, no reply will come for this waiter
+        waiters = self._replyWaiters.get(replyKey)
+        if waiters:
+            for waiter in waiters:
+                if waiter[0] is future:
+                    waiters.remove(waiter)
+                    break
+        future.cancel()
+
     async def createSubAccount(self, email):
         msg = {"create_sub_account": email}
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
 
-    async def withdraw(self, address, currency, amount, entity_id=None):
+    async def withdraw(
+        self, address, currency, amount, entity_id=None, idempotency_key=None
+    ):
         msg = {
-            "withdraw_liquid": {
-                "address": address,
-                "currency": currency,
-                "amount": amount,
-                "entity_id": entity_id or 0,
-            }
+            "withdraw_liquid": makeWithdrawRequest(
+                address, currency, amount, entity_id, idempotency_key
+            )
         }
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
 
     async def deposit(self, email):
         msg = {"deposit": email}
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
 
     async def subscribeImInfo(self):
         msg = {"request": "im_info"}
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
 
     async def subscribeToUserBalance(self, entityId: int = 0):
         # entity id set to 0 means sub to all user balances
         msg = {"load_account_balance": {"entity_id": entityId}}
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
+
+    async def unsubscribeFromUserBalance(self, entityId: int):
+        msg = {"unsubscribe_account_balance": {"entity_id": entityId}}
+        await self.send(msg)
 
     async def load_deposit_address(self, ref_str):
         msg = {"load_deposit_address": {"reference": ref_str}}
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
 
     async def load_sub_accounts(self, ref_str):
         msg = {"load_sub_accounts": ref_str}
-        await self.websocket.send(json.dumps(msg))
+        await self.send(msg)
 
     ## handle replies ##
     async def processResponse(self, data):
@@ -207,35 +490,49 @@ class AdminApiConnection(object):
             if validated:
                 if not self.loginStatus:
                     self.loginStatus = True
-                    print(f"-- LOGGED IN AS: {reply['email']}")
-                    await self.listener.onLoginSuccess()
+                    loginLog.info("logged in", extra={"email": reply["email"]})
+                    # put back whatever was watched before a reconnect
+                    await self.subscriptions.restore()
+                    self.logins += 1
+                    # the listener's session (prompt, daemon, dashboard) outlives
+                    # reconnects, it only hears about the first login
+                    if self.logins == 1:
+                        await self.listener.onLoginSuccess()
 
             else:
                 self.loginStatus = False
                 raise Exception("login failed!")
 
-        elif "account_created" in data:
-            await self.listener.on_subaccount_create(data["account_created"])
+        elif REPLY_SUBACCOUNT_CREATE in data:
+            reply = data[REPLY_SUBACCOUNT_CREATE]
+            if not self.resolveReply(REPLY_SUBACCOUNT_CREATE, reply):
+                await self.listener.on_subaccount_create(reply)
 
-        elif "withdraw_liquid" in data:
-            await self.listener.on_withdraw(data["withdraw_liquid"])
+        elif REPLY_WITHDRAW in data:
+            reply = data[REPLY_WITHDRAW]
+            if not self.resolveReply(REPLY_WITHDRAW, reply):
+                await self.listener.on_withdraw(reply)
 
-        elif "load_deposit_address" in data:
-            await self.listener.on_load_deposit_address(data["load_deposit_address"])
+        elif REPLY_LOAD_DEPOSIT_ADDRESS in data:
+            reply = data[REPLY_LOAD_DEPOSIT_ADDRESS]
+            if not self.resolveReply(REPLY_LOAD_DEPOSIT_ADDRESS, reply):
+                await self.listener.on_load_deposit_address(reply)
 
-        elif "load_sub_accounts" in data:
-            await self.listener.on_load_sub_accounts(data["load_sub_accounts"])
+        elif REPLY_LOAD_SUB_ACCOUNTS in data:
+            reply = data[REPLY_LOAD_SUB_ACCOUNTS]
+            if not self.resolveReply(REPLY_LOAD_SUB_ACCOUNTS, reply):
+                await self.listener.on_load_sub_accounts(reply)
 
         elif "reference" in data:
             refId = data["reference"]
             try:
                 await self.fireCallback(refId, data)
             except NoCallbackException:
-                logging.info(f"no callback registered for reply: {data}")
+                replyLog.info("no callback registered for reply", extra={"data": data})
             return
 
         else:
-            logging.info(f"unhandled reply packet: {data}")
+            replyLog.info("unhandled reply packet", extra={"data": data})
 
     ## handle server push ##
     async def processNotification(self, data):
@@ -249,8 +546,9 @@ class AdminApiConnection(object):
         elif notifType == "liquid_wallet_balances":
             await self.listener.handleLiquidBalanceUpdate(notif)
         elif notifType == "load_account_balance":
-            print(f"account balance notif: {notif}")
+            # the record is formatted on the log thread, if it isn't dropped
+            notifLog.info("account balance notif", extra={"data": notif})
             await self.listener.handleCashMetricsUpdate(notif)
 
         else:
-            logging.info(f"unhandled notification packet: {data}")
+            notifLog.info("unhandled notification packet", extra={"data": data})
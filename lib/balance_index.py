@@ -0,0 +1,66 @@
+from decimal import Decimal
+
+from sortedcontainers import SortedList
+
+from lib.cash import LOCATION_CUSTODY
+from lib.change_feed import KIND_ENTITY
+
+
+class BalanceIndex(object):
+    # per currency order statistics over custody balances, kept in step
+    # with the change feed so queries never scan the user map. entries are
+    # (balance, entity id), the id breaks ties so a removal is a bisect even
+    # when most accounts hold the same balance
+    def __init__(self, cashMetrics):
+        self.indexes = {}
+        self.balances = {}
+
+        userMap = cashMetrics.metricsMap[LOCATION_CUSTODY].userMap
+        for entityId, balances in userMap.items():
+            for ccy, balance in balances.items():
+                self.set(ccy, entityId, balance)
+        cashMetrics.changeFeed.subscribe(self.onDelta)
+
+    def onDelta(self, delta):
+        if delta.kind == KIND_ENTITY:
+            self.set(delta.currency, delta.key, delta.new)
+
+    def set(self, ccy, entityId, balance):
+        index = self.indexes.get(ccy)
+        if index == None:
+            index = SortedList()
+            self.indexes[ccy] = index
+            self.balances[ccy] = {}
+
+        balances = self.balances[ccy]
+        old = balances.get(entityId)
+        if old != None:
+            index.remove((old, entityId))
+        if balance == None:
+            balances.pop(entityId, None)
+            return
+        balances[entityId] = balance
+        index.add((balance, entityId))
+
+    def size(self, ccy):
+        return len(self.balances.get(ccy, {}))
+
+    def top(self, ccy, count):
+        # largest first, (entity id, balance) pairs
+        index = self.indexes.get(ccy)
+        if index == None or count <= 0:
+            return []
+        return [(entityId, balance) for balance, entityId in reversed(index[-count:])]
+
+    def above(self, ccy, threshold):
+        # strictly above the threshold, largest first
+        index = self.indexes.get(ccy)
+        if index == None:
+            return []
+        threshold = Decimal(threshold)
+        result = []
+        for balance, entityId in reversed(index):
+            if balance <= threshold:
+                break
+            result.append((entityId, balance))
+        return result
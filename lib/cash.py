@@ -1,8 +1,10 @@
 import logging
+import json
 from decimal import Decimal
 from copy import deepcopy
 
 from SDK.leverex_core.utils import round_flat
+from lib.change_feed import ChangeFeed, KIND_ENTITY, KIND_WALLET
 
 BALANCES_KEY   = 'balances'
 BALANCE_KEY    = 'balance'
@@ -22,34 +24,91 @@ LOCATION_WITHDRAW = 'withdrawals'
 LOCATION_PENDING  = 'pending_withdraw'
 LOCATION_EXOTIC   = 'exotic'
 
+#exotic locations are whatever the server reports, only the most
+#recently updated ones are kept
+MAX_EXOTIC_LOCATIONS = 256
+
 CCY_USDT = 'USDT'
 CCY_LBTC = 'LBTC'
 
 class WalletCash(object):
-   def __init__(self):
+   def __init__(self, location=None, changeFeed=None):
       self.cashMap = {}
+      self.location = location
+      self.changeFeed = changeFeed
+
+      #bumped on every change, renderers key their caches on it
+      self.version = 0
+      self._balanceStr = (None, None)
 
    def copy(self, obj):
       self.cashMap = {}
       self.cashMap = deepcopy(obj.cashMap)
+      self.version += 1
 
    def add(self, obj):
       for ccy in obj.cashMap:
          if not ccy in self.cashMap:
             self.cashMap[ccy] = Decimal(0)
          self.cashMap[ccy] += obj.cashMap[ccy]
+      self.version += 1
 
    def update(self, data):
       balanceList = data[BALANCES_KEY]
 
+      changed = False
       for balance in balanceList:
          if CURRENCY_KEY not in balance or BALANCE_KEY not in balance:
             continue
-         self.cashMap[balance[CURRENCY_KEY]] = Decimal(balance[BALANCE_KEY])
+         ccy = balance[CURRENCY_KEY]
+         value = Decimal(balance[BALANCE_KEY])
+         old = self.cashMap.get(ccy)
+         if old == value:
+            continue
+
+         self.cashMap[ccy] = value
+         changed = True
+         if self.changeFeed:
+            self.changeFeed.publish(KIND_WALLET, self.location, ccy, old, value)
+
+      if changed:
+         self.version += 1
+
+   def getBalanceStr(self):
+      version, balanceStr = self._balanceStr
+      if version != self.version:
+         balanceStr = ", ".join(
+            f"{ccy}: {round_flat(self.cashMap[ccy], 8)}" for ccy in self.cashMap)
+         self._balanceStr = (self.version, balanceStr)
+      return balanceStr
+
+   def toDict(self):
+      return {ccy: str(self.cashMap[ccy]) for ccy in self.cashMap}
 
 class UsersCash(object):
-   def __init__(self):
+   def __init__(self, changeFeed=None):
       self.userMap = {}
+      self.changeFeed = changeFeed or ChangeFeed()
+
+      self.version = 0
+      self._rows = {}
+      self._render = (None, None)
+      self._totalCash = (None, None)
+
+   def touch(self, userId):
+      #drop the user's rendered row, the rest stay cached
+      self.version += 1
+      self._rows.pop(userId, None)
+
+   def setBalance(self, userId, ccy, balance):
+      #returns False for no-op updates, those aren't published
+      user = self.userMap[userId]
+      old = user.get(ccy)
+      if old == balance:
+         return False
+      user[ccy] = balance
+      self.changeFeed.publish(KIND_ENTITY, userId, ccy, old, balance)
+      return True
 
    def update(self, data):
       if not USER_KEY in data:
@@ -61,59 +120,92 @@ class UsersCash(object):
       if not balanceList:
          return
 
-      if not userId in self.userMap:
+      #a new entry is a change even before it holds any balance
+      changed = not userId in self.userMap
+      if changed:
          self.userMap[userId] = {}
 
       for balance in balanceList:
-         self.userMap[userId][balance[CURRENCY_KEY]] = Decimal(balance[BALANCE_KEY])
+         if self.setBalance(userId, balance[CURRENCY_KEY], Decimal(balance[BALANCE_KEY])):
+            changed = True
+      if changed:
+         self.touch(userId)
 
    def updateFromAccountBalanceNotif(self, data):
-      print (data)
       if not ENTITY_ID_KEY in data or not ACCOUNT_KEY in data:
          return
 
       entityId = data[ENTITY_ID_KEY]
-      if not entityId in self.userMap:
+      #a new entry is a change even before it holds any balance
+      changed = not entityId in self.userMap
+      if changed:
          self.userMap[entityId] = {}
 
       for entry in data[ACCOUNT_KEY]:
          balance = Decimal(entry[BALANCE_KEY])
          ccy = entry[CURRENCY_KEY]
-         self.userMap[entityId][ccy] = balance
+         if self.setBalance(entityId, ccy, balance):
+            changed = True
+      if changed:
+         self.touch(entityId)
 
    def getTotalCash(self):
+      version, result = self._totalCash
+      if version == self.version:
+         return dict(result)
+
       result = {}
       for userId in self.userMap:
          for ccy in self.userMap[userId]:
             if ccy not in result:
                result[ccy] = Decimal(0)
             result[ccy] += self.userMap[userId][ccy]
+      self._totalCash = (self.version, result)
+      return dict(result)
+
+   def getRow(self, userId):
+      row = self._rows.get(userId)
+      if row == None:
+         user = self.userMap[userId]
+         balances = "".join(f"{ccy}: {user[ccy]}, " for ccy in user)
+         row = f"   - id: {userId} - {balances}"
+         self._rows[userId] = row
+      return row
+
+   def getPrettyStr(self):
+      version, result = self._render
+      if version != self.version:
+         rows = [" . User Cash:"]
+         rows.extend(self.getRow(userId) for userId in self.userMap)
+         rows.append("")
+         result = "\n".join(rows)
+         self._render = (self.version, result)
       return result
 
    def prettyPrint(self):
-      result = " . User Cash:\n"
-      for userId in self.userMap:
-         user = self.userMap[userId]
-         result += f"   - id: {userId} - "
-         for ccy in user:
-            result += f"{ccy}: {user[ccy]}, "
-         result += "\n"
-      print (result)
+      print (self.getPrettyStr())
+
+   def toDict(self):
+      return {
+         userId: {ccy: str(bal) for ccy, bal in self.userMap[userId].items()}
+         for userId in self.userMap
+      }
 
 
 class CashMetrics(object):
-   def __init__(self):
-      self.metricsMap = {
-         LOCATION_HOT      : WalletCash(),
-         LOCATION_WARM     : WalletCash(),
-         LOCATION_TOTAL    : WalletCash(),
-         LOCATION_CLEARING : WalletCash(),
-         LOCATION_DEPOSIT  : WalletCash(),
-         LOCATION_WITHDRAW : WalletCash(),
-         LOCATION_PENDING  : WalletCash(),
-         LOCATION_CUSTODY  : UsersCash(),
-         LOCATION_EXOTIC   : {}
-      }
+   def __init__(self, maxExoticLocations=MAX_EXOTIC_LOCATIONS):
+      #every balance change lands here as a delta
+      self.changeFeed = ChangeFeed()
+
+      self.metricsMap = {}
+      for loc in [LOCATION_HOT, LOCATION_WARM, LOCATION_TOTAL, LOCATION_CLEARING,
+         LOCATION_DEPOSIT, LOCATION_WITHDRAW, LOCATION_PENDING]:
+         self.metricsMap[loc] = WalletCash(loc, self.changeFeed)
+      self.metricsMap[LOCATION_CUSTODY] = UsersCash(self.changeFeed)
+      self.metricsMap[LOCATION_EXOTIC] = {}
+      self.maxExoticLocations = maxExoticLocations
+      self.evictedExotic = 0
+      self._sections = {}
 
    def update(self, data):
       if not BALANCES_KEY in data:
@@ -125,24 +217,61 @@ class CashMetrics(object):
          return
       loc = data[LOCATION_KEY]
       if not loc in self.metricsMap:
-         if loc not in self.metricsMap[LOCATION_EXOTIC]:
-            self.metricsMap[LOCATION_EXOTIC][loc] = WalletCash()
-         self.metricsMap[LOCATION_EXOTIC][loc].update(data)
+         self.updateExotic(loc, data)
          return
 
       if loc == LOCATION_CUSTODY:
          return
 
-      self.metricsMap[loc].update(data)
+      wallet = self.metricsMap[loc]
+      version = wallet.version
+      wallet.update(data)
+
+      if loc in [LOCATION_HOT, LOCATION_WARM] and wallet.version != version:
+         self.updateTotal()
+
+   def updateExotic(self, loc, data):
+      #reinserted on every update, the first entry is the least recent one
+      exotic = self.metricsMap[LOCATION_EXOTIC]
+      wallet = exotic.pop(loc, None)
+      if wallet == None:
+         wallet = WalletCash(loc, self.changeFeed)
+      exotic[loc] = wallet
+      wallet.update(data)
+
+      while len(exotic) > self.maxExoticLocations:
+         evicted = next(iter(exotic))
+         del exotic[evicted]
+         if self.evictedExotic % 1000 == 0:
+            logging.warning(f"more than {self.maxExoticLocations} exotic locations, dropped {evicted}")
+         self.evictedExotic += 1
+
+   def updateTotal(self):
+      totalCash = self.metricsMap[LOCATION_TOTAL]
+      previous = totalCash.cashMap
+      totalCash.copy(self.metricsMap[LOCATION_HOT])
+      totalCash.add(self.metricsMap[LOCATION_WARM])
+
+      for ccy in totalCash.cashMap:
+         old = previous.get(ccy)
+         if old != totalCash.cashMap[ccy]:
+            self.changeFeed.publish(
+               KIND_WALLET, LOCATION_TOTAL, ccy, old, totalCash.cashMap[ccy])
+
+   def getSection(self, name, key, builder):
+      #sections are only rebuilt when the versions they depend on moved
+      cached = self._sections.get(name)
+      if cached != None and cached[0] == key:
+         return cached[1]
+      result = builder()
+      self._sections[name] = (key, result)
+      return result
 
-      if loc in [LOCATION_HOT, LOCATION_WARM]:
-         totalCash = self.metricsMap[LOCATION_TOTAL]
-         totalCash.copy(self.metricsMap[LOCATION_HOT])
-         totalCash.add(self.metricsMap[LOCATION_WARM])
+   def getVersion(self, loc):
+      return self.metricsMap[loc].version
 
-   def prettyPrint(self, sessionObj):
-      #user cash
-      result = " . Users Cash"
+   def buildUsersSection(self, sessionObj):
+      result = [" . Users Cash"]
       try:
          #sum of users cash
          usersCash = self.metricsMap[LOCATION_CUSTODY]
@@ -150,75 +279,112 @@ class CashMetrics(object):
          if not cashAggregate:
             raise Exception()
 
-         result += f" ({len(usersCash.userMap)} accounts):\n"
-         totals = "    - total on accounts = "
-         for ccy in cashAggregate:
-            totals += f"{ccy}: {round_flat(cashAggregate[ccy], 8)} - "
-         result += f"{totals[:-2]}\n"
+         result[0] += f" ({len(usersCash.userMap)} accounts):"
+         totals = " - ".join(
+            f"{ccy}: {round_flat(cashAggregate[ccy], 8)}" for ccy in cashAggregate)
+         result.append(f"    - total on accounts = {totals} ")
 
          #sum of cash stuck in session limbo
          limboAggregate = sessionObj.getLimboCashAggregate()
-         limboed = "    - in session limbo  = "
          if limboAggregate:
-            for ccy in limboAggregate:
-               limboed += f"{ccy}: {round_flat(limboAggregate[ccy], 8)} - "
-            result += f"{limboed[:-2]}\n"
+            limboed = " - ".join(
+               f"{ccy}: {round_flat(limboAggregate[ccy], 8)}" for ccy in limboAggregate)
+            result.append(f"    - in session limbo  = {limboed} ")
          else:
-            result += f"{limboed}N/A\n"
+            result.append("    - in session limbo  = N/A")
 
          #sum of both per currency
-         final = "    - final sum         = "
+         final = []
          for ccy in cashAggregate:
             val = cashAggregate[ccy]
             if ccy in limboAggregate:
                val += limboAggregate[ccy]
-            final += f"{ccy}: {round_flat(val, 8)} - "
-         result += f"{final[:-2]}\n"
+            final.append(f"{ccy}: {round_flat(val, 8)}")
+         result.append(f"    - final sum         = {' - '.join(final)} ")
       except:
-         result += ": N/A\n"
-
-      #clearing account
-      result += " . Clearing Account:"
+         result = [" . Users Cash: N/A"]
+      result.append("")
+      return "\n".join(result)
+
+   def buildClearingSection(self):
+      result = [" . Clearing Account:"]
+      clearing = self.metricsMap[LOCATION_CLEARING]
+      for ccy in clearing.cashMap:
+         result.append(f"    - {ccy}              = {round_flat(clearing.cashMap[ccy], 8)}")
+      result.append("")
+      return "\n".join(result)
+
+   def getWalletStr(self, loc, toAdd=None):
       try:
-         clearing = self.metricsMap[LOCATION_CLEARING]
-         result += "\n"
-         for ccy in clearing.cashMap:
-            result += f"    - {ccy}              = {round_flat(clearing.cashMap[ccy], 8)}\n"
+         wallet = self.metricsMap[loc]
+         if toAdd:
+            addedWallet = WalletCash()
+            addedWallet.copy(wallet)
+            addedWallet.add(self.metricsMap[toAdd])
+            wallet = addedWallet
+         return wallet.getBalanceStr()
       except:
-         result += " N/A\n"
-
-      #wallets
-      result += " . Wallets:\n"
-
-      def getWalletStr(loc, toAdd=None):
-         try:
-            wallet = self.metricsMap[loc]
-            if toAdd:
-               addedWallet = WalletCash()
-               addedWallet.copy(wallet)
-               addedWallet.add(self.metricsMap[toAdd])
-               wallet = addedWallet
-
-            balanceStr = ""
-            for ccy in wallet.cashMap:
-               balanceStr += f"{ccy}: {round_flat(wallet.cashMap[ccy], 8)}, "
-            return balanceStr[:-2]
-         except:
-            return "N/A"
-
-      result += f"    - hot                  = {getWalletStr(LOCATION_HOT)}\n"
-      result += f"    - warm                 = {getWalletStr(LOCATION_WARM)}\n"
-      result += f"    - total                = {getWalletStr(LOCATION_TOTAL)}\n"
-
-      #transfers
-      result += " . Transfers:\n"
-      result += f"    - total deposits       = {getWalletStr(LOCATION_DEPOSIT)}\n"
-      result += f"    - total withdrawals    = {getWalletStr(LOCATION_WITHDRAW)}\n"
-      result += f"    - pending withdrawals  = {getWalletStr(LOCATION_PENDING)}\n"
-      result += f"    - sum of transfers     = {getWalletStr(LOCATION_DEPOSIT, LOCATION_WITHDRAW)}\n"
+         return "N/A"
+
+   def buildWalletsSection(self):
+      return "\n".join([
+         " . Wallets:",
+         f"    - hot                  = {self.getWalletStr(LOCATION_HOT)}",
+         f"    - warm                 = {self.getWalletStr(LOCATION_WARM)}",
+         f"    - total                = {self.getWalletStr(LOCATION_TOTAL)}",
+         ""
+      ])
+
+   def buildTransfersSection(self):
+      return "\n".join([
+         " . Transfers:",
+         f"    - total deposits       = {self.getWalletStr(LOCATION_DEPOSIT)}",
+         f"    - total withdrawals    = {self.getWalletStr(LOCATION_WITHDRAW)}",
+         f"    - pending withdrawals  = {self.getWalletStr(LOCATION_PENDING)}",
+         f"    - sum of transfers     = {self.getWalletStr(LOCATION_DEPOSIT, LOCATION_WITHDRAW)}",
+         ""
+      ])
+
+   def getPrettyStr(self, sessionObj):
+      sections = [
+         self.getSection("users",
+            (self.getVersion(LOCATION_CUSTODY), id(sessionObj), sessionObj.version),
+            lambda: self.buildUsersSection(sessionObj)),
+         self.getSection("clearing",
+            self.getVersion(LOCATION_CLEARING),
+            self.buildClearingSection),
+         self.getSection("wallets",
+            tuple(self.getVersion(loc) for loc in [LOCATION_HOT, LOCATION_WARM, LOCATION_TOTAL]),
+            self.buildWalletsSection),
+         self.getSection("transfers",
+            tuple(self.getVersion(loc) for loc in [LOCATION_DEPOSIT, LOCATION_WITHDRAW, LOCATION_PENDING]),
+            self.buildTransfersSection),
+      ]
 
       #exotic locations
-      print (result)
+      return "".join(sections)
+
+   def prettyPrint(self, sessionObj):
+      print (self.getPrettyStr(sessionObj))
 
    def prettyPrintUsersBalance(self):
       self.metricsMap[LOCATION_CUSTODY].prettyPrint()
+
+   def toDict(self, sessionObj=None):
+      result = {}
+      for loc in self.metricsMap:
+         if loc == LOCATION_EXOTIC:
+            result[loc] = {exLoc: wallet.toDict() \
+               for exLoc, wallet in self.metricsMap[loc].items()}
+            continue
+         result[loc] = self.metricsMap[loc].toDict()
+
+      result["users_total"] = {ccy: str(val) for ccy, val in \
+         self.metricsMap[LOCATION_CUSTODY].getTotalCash().items()}
+      if sessionObj != None:
+         result["limbo_total"] = {ccy: str(val) for ccy, val in \
+            sessionObj.getLimboCashAggregate().items()}
+      return result
+
+   def toJson(self, sessionObj=None):
+      return json.dumps(self.toDict(sessionObj), default=str)
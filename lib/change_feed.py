@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from decimal import Decimal
+
+KIND_ENTITY = "entity"
+KIND_WALLET = "wallet"
+
+DEFAULT_STREAM_SIZE = 1024
+
+
+@dataclass(slots=True, frozen=True)
+class BalanceDelta:
+    seq: int
+    kind: str
+    # entity id for entity deltas, location for wallet deltas
+    key: object
+    currency: str
+    old: Decimal
+    new: Decimal
+
+    @property
+    def delta(self):
+        return self.new - (self.old or Decimal(0))
+
+
+class NotificationStream(object):
+    # bounded buffer between the read loop and a consumer, a slow consumer
+    # loses the oldest entries rather than stalling the read loop
+    def __init__(self, maxsize=DEFAULT_STREAM_SIZE):
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def push(self, item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class ChangeFeed(object):
+    def __init__(self):
+        self.seq = 0
+        self.callbacks = []
+        self.streams = set()
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def publish(self, kind, key, ccy, old, new):
+        self.seq += 1
+        delta = BalanceDelta(self.seq, kind, key, ccy, old, new)
+        for callback in self.callbacks:
+            callback(delta)
+        for stream in self.streams:
+            stream.push(delta)
+        return delta
+
+    async def stream(self, maxsize=DEFAULT_STREAM_SIZE):
+        # gaps in seq tell the consumer it fell behind and lost deltas
+        stream = NotificationStream(maxsize)
+        self.streams.add(stream)
+        try:
+            while True:
+                yield await stream.get()
+        finally:
+            self.streams.discard(stream)
+            if stream.dropped:
+                logging.warning(f"change feed stream dropped {stream.dropped} deltas")
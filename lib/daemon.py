@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import os
+
+from commands import (
+    COMMAND_BATCH_WITHDRAW,
+    COMMAND_EXPORT,
+    COMMAND_BALANCE_ABOVE,
+    COMMAND_BALANCE_JSON,
+    COMMAND_BALANCE_LIST,
+    COMMAND_BALANCE_SHOW,
+    COMMAND_BALANCE_TOP,
+    COMMAND_CACHE_CLEAR,
+    COMMAND_CACHE_INVALIDATE,
+    COMMAND_CACHE_STATS,
+    COMMAND_EXIT,
+    COMMAND_JOURNAL_AT,
+    COMMAND_JOURNAL_STATS,
+    COMMAND_LOAD_DEPOSIT_ADDRESS,
+    COMMAND_LOAD_SUB_ACCOUNTS,
+    COMMAND_LOG_STATS,
+    COMMAND_RECON_HISTORY,
+    COMMAND_RECON_STATUS,
+    COMMAND_RULES,
+    COMMAND_WATCH_ADD,
+    COMMAND_WATCH_LIST,
+    COMMAND_WATCH_REMOVE,
+    COMMAND_SUBACCOUNT_CREATE,
+    COMMAND_TOKEN_STATUS,
+    COMMAND_WITHDRAW,
+    Commands,
+)
+from lib.api_connection import (
+    REPLY_SUBACCOUNT_CREATE,
+    REPLY_WITHDRAW,
+    makeWithdrawRequest,
+    matchWithdrawReply,
+)
+from lib.printHelp import getHelpStr
+
+# reply packet each command waits on, commands missing from
+# this map are acked as soon as the request is sent
+CommandReplyMap = {
+    COMMAND_SUBACCOUNT_CREATE: REPLY_SUBACCOUNT_CREATE,
+    COMMAND_WITHDRAW: REPLY_WITHDRAW,
+}
+
+KEY_ID = "id"
+KEY_COMMAND = "command"
+KEY_STATUS = "status"
+KEY_DATA = "data"
+KEY_ERROR = "error"
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+DEFAULT_REPLY_TIMEOUT = 30
+
+
+class DaemonSession(object):
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+
+        # each local client gets its own parser, Commands tracks
+        # the last primary command and shouldn't be shared
+        self.commands = Commands()
+        self._tasks = set()
+
+    async def run(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+
+                # requests are processed concurrently, replies carry
+                # the request id so the client can match them up
+                task = asyncio.create_task(self.processLine(line))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            # the local client is done sending, requests already on their way
+            # to the server still get their outcome written back
+            if self._tasks:
+                await asyncio.wait(list(self._tasks), timeout=self.server.replyTimeout)
+        finally:
+            # only left running past the reply timeout or on shutdown
+            for task in list(self._tasks):
+                task.cancel()
+            self.writer.close()
+
+    async def processLine(self, line):
+        requestId = None
+        try:
+            request = json.loads(line)
+            requestId = request.get(KEY_ID)
+            data = await self.processRequest(request[KEY_COMMAND])
+            await self.send({KEY_ID: requestId, KEY_STATUS: STATUS_OK, KEY_DATA: data})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.send(
+                {KEY_ID: requestId, KEY_STATUS: STATUS_ERROR, KEY_ERROR: str(e)}
+            )
+
+    async def processRequest(self, request):
+        commandCode, args = self.commands.parseUserRequest(request)
+        if commandCode == None:
+            raise Exception(f"unexpected command: {request}")
+
+        if commandCode == COMMAND_EXIT:
+            # only drop this local client, the daemon session stays up
+            self.reader.feed_eof()
+            return None
+
+        return await self.server.execute(commandCode, args)
+
+    async def send(self, packet):
+        if self.writer.is_closing():
+            return
+        self.writer.write((json.dumps(packet, default=str) + "\n").encode())
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # the local client went away entirely, nobody to tell
+            logging.debug(f"daemon client gone, dropped reply to {packet.get(KEY_ID)}")
+
+
+class DaemonServer(object):
+    def __init__(self, client, path, replyTimeout=DEFAULT_REPLY_TIMEOUT):
+        self.client = client
+        self.path = path
+        self.replyTimeout = replyTimeout
+        self.server = None
+
+        # commands answered straight from the client's lookup layer
+        lookups = client.lookups
+        self.directCommands = {
+            COMMAND_LOAD_DEPOSIT_ADDRESS: lookups.load_deposit_address,
+            COMMAND_LOAD_SUB_ACCOUNTS: lookups.load_sub_accounts,
+            COMMAND_CACHE_STATS: lookups.stats,
+            COMMAND_CACHE_CLEAR: lookups.clear,
+            COMMAND_CACHE_INVALIDATE: lookups.invalidate,
+            COMMAND_TOKEN_STATUS: self.tokenStatus,
+            COMMAND_BALANCE_SHOW: client.renderCashReport,
+            COMMAND_BALANCE_LIST: client.renderUsersCash,
+            COMMAND_BALANCE_JSON: self.balanceJson,
+            COMMAND_BALANCE_TOP: client.balanceIndex.top,
+            COMMAND_BALANCE_ABOVE: client.balanceIndex.above,
+            COMMAND_RECON_STATUS: client.reconciler.status,
+            COMMAND_RECON_HISTORY: client.reconciler.getHistory,
+            COMMAND_RULES: client.rules.status,
+            COMMAND_WATCH_ADD: client.watch_add,
+            COMMAND_WATCH_REMOVE: client.watch_remove,
+            COMMAND_WATCH_LIST: client.connection.subscriptions.stats,
+            COMMAND_EXPORT: client.export,
+            COMMAND_BATCH_WITHDRAW: client.batch_withdraw,
+            COMMAND_LOG_STATS: self.logStats,
+        }
+        if client.journal:
+            self.directCommands[COMMAND_JOURNAL_STATS] = client.journal.stats
+            self.directCommands[COMMAND_JOURNAL_AT] = self.journalAt
+
+    async def start(self):
+        # clear stale socket from a previous run
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.server = await asyncio.start_unix_server(self.onClient, path=self.path)
+
+        # the socket drives an authenticated admin session, owner only
+        os.chmod(self.path, 0o600)
+        logging.info(f"daemon listening on {self.path}")
+
+    async def stop(self):
+        if self.server == None:
+            return
+        self.server.close()
+        await self.server.wait_closed()
+        self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def balanceJson(self):
+        # consistent view, published after the last applied notification
+        return self.client.snapshots.latest().toDict()
+
+    async def journalAt(self, time):
+        from lib.state_journal import parseTime
+
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(
+            None, self.client.journal.stateAt, parseTime(time)
+        )
+        return state.toDict()
+
+    def logStats(self):
+        from lib import log_pipeline
+
+        if log_pipeline.pipeline == None:
+            return None
+        return log_pipeline.pipeline.stats()
+
+    def tokenStatus(self):
+        return self.client.connection.tokenRefresher.stats()
+
+    async def onClient(self, reader, writer):
+        session = DaemonSession(self, reader, writer)
+        await session.run()
+
+    async def execute(self, commandCode, args):
+        # reports come back as text instead of going to the daemon's stdout
+        if commandCode.startswith("help"):
+            return getHelpStr(self.client.commands, commandCode)
+
+        if commandCode in self.directCommands:
+            result = self.directCommands[commandCode](*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+
+        connection = self.client.connection
+        replyKey = CommandReplyMap.get(commandCode)
+        future = None
+        if replyKey:
+            match = None
+            if commandCode == COMMAND_WITHDRAW:
+                match = matchWithdrawReply(makeWithdrawRequest(*args))
+            # queue the waiter before sending so the reply can't slip past it
+            future = connection.waitReply(replyKey, match=match)
+
+        try:
+            await self.client.processCommand(commandCode, args)
+        except Exception:
+            if future:
+                connection.cancelReply(replyKey, future)
+            raise
+
+        if future == None:
+            return None
+        return await asyncio.wait_for(future, self.replyTimeout)
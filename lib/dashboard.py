@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from lib import log_pipeline
+from lib.cash import (
+    LOCATION_CLEARING,
+    LOCATION_HOT,
+    LOCATION_PENDING,
+    LOCATION_TOTAL,
+    LOCATION_WARM,
+)
+from SDK.leverex_core.utils import round_flat
+
+DEFAULT_FPS = 10
+LABEL_WIDTH = 24
+
+
+def formatCash(cashMap):
+    if not cashMap:
+        return "N/A"
+    return ", ".join(f"{ccy}: {round_flat(cashMap[ccy], 8)}" for ccy in cashMap)
+
+
+class Dashboard(object):
+    def __init__(self, client, fps=DEFAULT_FPS):
+        self.client = client
+        self.frameTime = 1 / max(fps, 1)
+        self.dirty = True
+        self.notifCount = 0
+        self.rate = 0
+        self._rateCount = 0
+        self._rateStart = time.monotonic()
+
+        # custody and limbo totals, summed by the offloader from snapshots
+        self.custodyCash = {}
+        self.limboCash = {}
+        self.userCount = 0
+        self._aggregates = None
+        self._aggregateVersion = None
+
+        self._screen = None
+        self._painted = {}
+        self._savedStreams = []
+
+    ## fed by the notification handlers ##
+    def markDirty(self):
+        # bursts only flip a flag, the frame loop does the drawing
+        self.dirty = True
+        self.notifCount += 1
+        self._rateCount += 1
+
+    ## aggregates ##
+    def refreshAggregates(self):
+        # one job at a time on the latest snapshot, frames show the last
+        # finished totals meanwhile
+        if self._aggregates != None and not self._aggregates.done():
+            return
+        snapshot = self.client.snapshots.latest()
+        if snapshot.version == self._aggregateVersion:
+            return
+        self._aggregates = asyncio.ensure_future(self.computeAggregates(snapshot))
+
+    async def computeAggregates(self, snapshot):
+        offloader = self.client.offloader
+        try:
+            custody, limbo = await asyncio.gather(
+                offloader.getTotalCash(snapshot),
+                offloader.getLimboCashAggregate(snapshot),
+            )
+        except Exception as e:
+            logging.error(f"dashboard totals failed: {e}")
+            return
+        self.custodyCash = custody
+        self.limboCash = limbo
+        self.userCount = len(snapshot.users)
+        self._aggregateVersion = snapshot.version
+        self.dirty = True
+
+    ## view ##
+    def getWalletStr(self, loc):
+        return self.client.cashMetrics.getWalletStr(loc) or "N/A"
+
+    def getRows(self):
+        rows = [
+            ("environment", self.client.connection.env),
+            ("notifications", f"{self.notifCount} ({self.rate:.0f}/s)"),
+            ("", ""),
+            ("hot wallet", self.getWalletStr(LOCATION_HOT)),
+            ("warm wallet", self.getWalletStr(LOCATION_WARM)),
+            ("total wallets", self.getWalletStr(LOCATION_TOTAL)),
+            ("clearing account", self.getWalletStr(LOCATION_CLEARING)),
+            ("pending withdrawals", self.getWalletStr(LOCATION_PENDING)),
+            ("", ""),
+        ]
+
+        rows.append((f"custody ({self.userCount})", formatCash(self.custodyCash)))
+        rows.append(("limbo cash", formatCash(self.limboCash)))
+        rows.append(("withdraw queue size", str(self.client.withdrawQueueSize)))
+        rows.append(("", ""))
+        rows.append(("", "press q to quit"))
+        return rows
+
+    ## drawing ##
+    def paint(self):
+        height, width = self._screen.getmaxyx()
+        for lineNum, (label, value) in enumerate(self.getRows()):
+            if lineNum >= height:
+                break
+
+            # repaint only the lines whose text changed since the last frame
+            text = f"{label:<{LABEL_WIDTH}}{value}"[: width - 1]
+            if self._painted.get(lineNum) == text:
+                continue
+            self._screen.move(lineNum, 0)
+            self._screen.clrtoeol()
+            self._screen.addstr(lineNum, 0, text)
+            self._painted[lineNum] = text
+        self._screen.refresh()
+
+    def updateRate(self):
+        now = time.monotonic()
+        elapsed = now - self._rateStart
+        if elapsed >= 1:
+            self.rate = self._rateCount / elapsed
+            self._rateCount = 0
+            self._rateStart = now
+            self.dirty = True
+
+    ## terminal setup ##
+    def muteOutput(self):
+        # stray prints and log lines would tear the screen
+        devnull = open(os.devnull, "w")
+        self._savedStreams = [(None, sys.stdout)]
+        sys.stdout = devnull
+        for handler in log_pipeline.getStreamHandlers():
+            self._savedStreams.append((handler, handler.setStream(devnull)))
+
+    def restoreOutput(self):
+        devnull = sys.stdout
+        for handler, stream in self._savedStreams:
+            if handler == None:
+                sys.stdout = stream
+            else:
+                handler.setStream(stream)
+        self._savedStreams = []
+        devnull.close()
+
+    async def run(self):
+        try:
+            import curses
+        except ImportError:
+            logging.error("the dashboard needs curses, not available on this platform")
+            return
+
+        self._screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        self._screen.nodelay(True)
+        self.muteOutput()
+        try:
+            while True:
+                frameStart = time.monotonic()
+                key = self._screen.getch()
+                if key in (ord("q"), ord("Q")):
+                    break
+                if key == curses.KEY_RESIZE:
+                    self._screen.clear()
+                    self._painted = {}
+                    self.dirty = True
+
+                self.updateRate()
+                self.refreshAggregates()
+                if self.dirty:
+                    self.dirty = False
+                    self.paint()
+
+                # capped frame rate, whatever the notification rate is
+                elapsed = time.monotonic() - frameStart
+                await asyncio.sleep(max(self.frameTime - elapsed, 0))
+        finally:
+            if self._aggregates != None:
+                self._aggregates.cancel()
+            self.restoreOutput()
+            curses.nocbreak()
+            curses.echo()
+            curses.endwin()
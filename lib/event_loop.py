@@ -0,0 +1,33 @@
+import asyncio
+import logging
+
+LOOP_ASYNCIO = "asyncio"
+LOOP_UVLOOP = "uvloop"
+LOOP_AUTO = "auto"
+
+LoopBackends = [LOOP_ASYNCIO, LOOP_UVLOOP, LOOP_AUTO]
+
+
+def getLoopFactory(backend=LOOP_ASYNCIO):
+    # returns (backend actually used, loop factory), uvloop falls back
+    # to the stock loop when it isn't installed
+    if backend not in LoopBackends:
+        raise Exception(f"unknown event loop backend: {backend}")
+    if backend == LOOP_ASYNCIO:
+        return LOOP_ASYNCIO, asyncio.new_event_loop
+
+    try:
+        import uvloop
+    except ImportError:
+        if backend == LOOP_UVLOOP:
+            logging.warning("uvloop is not installed, using the asyncio event loop")
+        return LOOP_ASYNCIO, asyncio.new_event_loop
+    return LOOP_UVLOOP, uvloop.new_event_loop
+
+
+def run(coro, backend=LOOP_ASYNCIO):
+    # asyncio.run on the selected backend, for the console client as well
+    # as embedders driving AdminClient from a script
+    _, loopFactory = getLoopFactory(backend)
+    with asyncio.Runner(loop_factory=loopFactory) as runner:
+        return runner.run(coro)
@@ -0,0 +1,160 @@
+import csv
+import gzip
+import io
+import json
+
+TABLE_USERS = "users"
+TABLE_SESSIONS = "sessions"
+
+FORMAT_JSONL = "jsonl"
+FORMAT_CSV = "csv"
+FORMAT_PARQUET = "parquet"
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+DEFAULT_CHUNK_SIZE = 10000
+
+TableColumns = {
+    TABLE_USERS: ["entity_id", "currency", "balance"],
+    TABLE_SESSIONS: [
+        "product",
+        "id",
+        "state",
+        "damaged",
+        "start_timestamp",
+        "end_timestamp",
+        "timestamp_end",
+        "open_price",
+        "close_price",
+        "reason",
+        "message",
+        "novation_account_balance",
+    ],
+}
+
+
+## row sources, read from an immutable state snapshot ##
+def iterUserRows(snapshot):
+    for entityId, balances in snapshot.users.items():
+        for ccy, balance in balances.items():
+            yield {"entity_id": entityId, "currency": ccy, "balance": str(balance)}
+
+
+def iterSessionRows(snapshot):
+    for session in snapshot.sessions:
+        yield dict(session)
+
+
+TableRows = {
+    TABLE_USERS: iterUserRows,
+    TABLE_SESSIONS: iterSessionRows,
+}
+
+
+def iterChunks(rows, columns, chunkSize):
+    chunk = []
+    for row in rows:
+        chunk.append({col: row.get(col) for col in columns})
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+## outputs ##
+def openText(path, compression):
+    if compression == COMPRESSION_GZIP:
+        return gzip.open(path, "wt", newline="")
+    if compression == COMPRESSION_ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression needs the zstandard package")
+        raw = zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    return open(path, "w", newline="")
+
+
+def writeJsonl(chunks, path, columns, compression):
+    with openText(path, compression) as f:
+        for chunk in chunks:
+            f.write("".join(json.dumps(row, default=str) + "\n" for row in chunk))
+
+
+def writeCsv(chunks, path, columns, compression):
+    with openText(path, compression) as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for chunk in chunks:
+            writer.writerows(chunk)
+
+
+def writeParquet(chunks, path, columns, compression):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("parquet export needs pyarrow")
+
+    # everything goes out as strings, balances keep their exact decimals
+    schema = pa.schema([(col, pa.string()) for col in columns])
+    if compression == COMPRESSION_NONE:
+        compression = None
+    with pq.ParquetWriter(path, schema, compression=compression or "none") as writer:
+        for chunk in chunks:
+            arrays = [
+                pa.array(
+                    [None if row[col] == None else str(row[col]) for row in chunk],
+                    pa.string(),
+                )
+                for col in columns
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+
+FormatWriters = {
+    FORMAT_JSONL: writeJsonl,
+    FORMAT_CSV: writeCsv,
+    FORMAT_PARQUET: writeParquet,
+}
+
+
+def export(
+    snapshot,
+    table,
+    fmt,
+    path,
+    compression=COMPRESSION_NONE,
+    columns=None,
+    chunkSize=DEFAULT_CHUNK_SIZE,
+):
+    # rows are streamed chunk by chunk, the table is never built in memory
+    if table not in TableRows:
+        raise Exception(f"unknown table: {table}")
+    if fmt not in FormatWriters:
+        raise Exception(f"unknown export format: {fmt}")
+
+    allColumns = TableColumns[table]
+    if columns:
+        if isinstance(columns, str):
+            columns = [col.strip() for col in columns.split(",") if col.strip()]
+        unknown = [col for col in columns if col not in allColumns]
+        if unknown:
+            raise Exception(f"unknown columns for {table}: {unknown}")
+    else:
+        columns = allColumns
+
+    count = 0
+
+    def countRows(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    chunks = iterChunks(countRows(TableRows[table](snapshot)), columns, chunkSize)
+    FormatWriters[fmt](chunks, path, columns, compression or COMPRESSION_NONE)
+    return count
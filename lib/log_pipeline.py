@@ -0,0 +1,277 @@
+import contextvars
+import copy
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+## output pipeline ##
+# every log record goes through a bounded queue to a background thread that
+# formats and writes it, the event loop only builds the record and enqueues
+# it. categories are logger names, hot paths log to their own:
+CATEGORY_NOTIF = "notif"
+CATEGORY_REPLY = "reply"
+CATEGORY_LOGIN = "login"
+
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+LogFormats = [FORMAT_TEXT, FORMAT_JSON]
+
+TEXT_FORMAT = (
+    "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s"
+)
+DEFAULT_QUEUE_SIZE = 10000
+
+# per category: keep one record in `every`, at most `rate` per second.
+# nothing is dropped unless asked for on the command line
+DEFAULT_POLICIES = {}
+
+# attributes every LogRecord has, anything else came in through `extra`
+_RECORD_KEYS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+
+# (env, key) tag of the connection the running task works for, set by the
+# supervisor. tasks inherit it, so records from anything a target's run
+# task starts carry its tag
+logTarget = contextvars.ContextVar("logTarget", default=None)
+
+
+def getCategory(record):
+    return record.name.split(".")[0]
+
+
+class TargetFilter(logging.Filter):
+    # runs on the caller's thread, where the context is the logging task's
+    def filter(self, record):
+        target = logTarget.get()
+        if target != None and not hasattr(record, "target"):
+            record.target = target
+        return True
+
+
+class CategoryStats(object):
+    def __init__(self):
+        self.seen = 0
+        self.emitted = 0
+        self.sampled = 0
+        self.limited = 0
+        self.muted = 0
+
+    def toDict(self):
+        return {
+            "seen": self.seen,
+            "emitted": self.emitted,
+            "sampled": self.sampled,
+            "limited": self.limited,
+            "muted": self.muted,
+        }
+
+
+class OutputPolicy(logging.Filter):
+    # runs on the caller's thread before anything is queued, counts every
+    # record and drops the ones the category's sampling or rate limit refuse
+    def __init__(self, policies=None, quiet=False):
+        super().__init__()
+        self.policies = {category: dict(p) for category, p in DEFAULT_POLICIES.items()}
+        for category, policy in (policies or {}).items():
+            self.policies.setdefault(category, {}).update(policy)
+        self.quiet = quiet
+        self.stats = {}
+        # records seen per target, when several run side by side
+        self.targets = {}
+        self._buckets = {}
+
+    def filter(self, record):
+        category = getCategory(record)
+        stats = self.stats.get(category)
+        if stats == None:
+            stats = self.stats[category] = CategoryStats()
+        stats.seen += 1
+
+        target = getattr(record, "target", None)
+        if target != None:
+            self.targets[target] = self.targets.get(target, 0) + 1
+
+        # errors always make it out
+        if record.levelno >= logging.ERROR:
+            stats.emitted += 1
+            return True
+        if self.quiet:
+            stats.muted += 1
+            return False
+
+        policy = self.policies.get(category)
+        if policy:
+            every = policy.get("every", 1)
+            if every > 1 and stats.seen % every != 0:
+                stats.sampled += 1
+                return False
+            if policy.get("rate") and not self.takeToken(category, policy["rate"]):
+                stats.limited += 1
+                return False
+
+        stats.emitted += 1
+        return True
+
+    def takeToken(self, category, rate):
+        # token bucket, bursts up to one second worth of records
+        now = time.monotonic()
+        tokens, last = self._buckets.get(category, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[category] = (tokens, now)
+            return False
+        self._buckets[category] = (tokens - 1, now)
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    # the stock handler formats the whole record before queueing it, here
+    # only the message is merged, layout and json happen on the listener
+    # thread. a full queue drops instead of blocking
+    def __init__(self, recordQueue):
+        super().__init__(recordQueue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the caller may change its args or extras once logging returns,
+        # the listener gets them as they were at the call
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        for key, value in vars(record).items():
+            if key not in _RECORD_KEYS and isinstance(value, (dict, list, set)):
+                setattr(record, key, copy.copy(value))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "category": getCategory(record),
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_KEYS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    # structured fields are appended after the message
+    def format(self, record):
+        line = super().format(record)
+        extra = {k: v for k, v in vars(record).items() if k not in _RECORD_KEYS}
+        if extra:
+            line += " " + json.dumps(extra, default=str)
+        return line
+
+
+class LogPipeline(object):
+    def __init__(
+        self,
+        fmt=FORMAT_TEXT,
+        level=logging.INFO,
+        policies=None,
+        quiet=False,
+        stream=None,
+        queueSize=DEFAULT_QUEUE_SIZE,
+    ):
+        self.output = logging.StreamHandler(stream or sys.stderr)
+        if fmt == FORMAT_JSON:
+            self.output.setFormatter(JsonFormatter())
+        else:
+            self.output.setFormatter(TextFormatter(TEXT_FORMAT))
+
+        self.policy = OutputPolicy(policies, quiet)
+        self.handler = DeferredQueueHandler(queue.Queue(queueSize))
+        self.handler.addFilter(TargetFilter())
+        self.handler.addFilter(self.policy)
+        self.listener = QueueListener(self.handler.queue, self.output)
+        self.level = level
+
+    def start(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+
+    def stop(self):
+        # flushes whatever is still queued
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+
+    def getStreamHandlers(self):
+        return [self.output]
+
+    def stats(self):
+        return {
+            "quiet": self.policy.quiet,
+            "queued": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "categories": {
+                category: stats.toDict()
+                for category, stats in self.policy.stats.items()
+            },
+            "targets": dict(self.policy.targets),
+        }
+
+
+# the running pipeline, if any
+pipeline = None
+
+
+def setup(fmt=FORMAT_TEXT, level=logging.INFO, policies=None, quiet=False):
+    global pipeline
+    if pipeline != None:
+        pipeline.stop()
+    pipeline = LogPipeline(fmt, level, policies, quiet)
+    pipeline.start()
+    return pipeline
+
+
+def shutdown():
+    global pipeline
+    if pipeline != None:
+        pipeline.stop()
+        pipeline = None
+
+
+def parsePolicies(samples=None, rates=None):
+    # "category=value" pairs from the command line
+    policies = {}
+    for key, items, cast in [("every", samples, int), ("rate", rates, float)]:
+        for item in items or []:
+            category, _, value = item.partition("=")
+            if not value:
+                raise Exception(f"expected category=value, got: {item}")
+            policies.setdefault(category, {})[key] = cast(value)
+    return policies
+
+
+def getStreamHandlers():
+    # where log lines end up, pipeline or plain logging
+    if pipeline != None:
+        return pipeline.getStreamHandlers()
+    return [
+        handler
+        for handler in logging.getLogger().handlers
+        if isinstance(handler, logging.StreamHandler)
+    ]
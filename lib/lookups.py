@@ -0,0 +1,259 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from lib.api_connection import (
+    REPLY_LOAD_DEPOSIT_ADDRESS,
+    REPLY_LOAD_SUB_ACCOUNTS,
+    AmbiguousReplyException,
+    isErrorReply,
+)
+from lib.stream_parse import ArraySink
+
+CACHE_DEPOSIT_ADDRESS = "deposit_address"
+CACHE_SUB_ACCOUNTS = "sub_accounts"
+CACHE_ALL = "all"
+
+# continuation token of a paged sub account reply
+KEY_NEXT_CURSOR = "next_cursor"
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REPLY_TIMEOUT = 30
+
+# reply field echoing the looked up reference, when the server sends it
+KEY_REFERENCE = "reference"
+
+
+def matchReference(ref):
+    # True if the reply echoes this reference, False if another one,
+    # None if it echoes none
+    def match(reply):
+        if not isinstance(reply, dict) or KEY_REFERENCE not in reply:
+            return None
+        return str(reply[KEY_REFERENCE]) == str(ref)
+
+    return match
+
+
+class LookupCache(object):
+    # LRU ordered, entries optionally expire after ttl seconds
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry == None:
+            self.misses += 1
+            return None
+
+        value, expiresAt = entry
+        if expiresAt != None and expiresAt <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        expiresAt = None
+        if self.ttl != None:
+            expiresAt = time.monotonic() + self.ttl
+        self._entries[key] = (value, expiresAt)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        return self._entries.pop(key, None) != None
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class Lookups(object):
+    def __init__(self, connection, replyTimeout=DEFAULT_REPLY_TIMEOUT):
+        self.connection = connection
+        self.replyTimeout = replyTimeout
+
+        # deposit addresses never change once assigned, sub account
+        # lists do so they expire
+        self.caches = {
+            CACHE_DEPOSIT_ADDRESS: LookupCache(100000),
+            CACHE_SUB_ACCOUNTS: LookupCache(10000, ttl=300),
+        }
+        self._inflight = {}
+
+        # replies are only told apart once one echoed its reference, until
+        # then requests of a reply type go out one at a time
+        self._correlated = set()
+        self._gates = {}
+
+    def getGate(self, replyKey):
+        if replyKey not in self._gates:
+            self._gates[replyKey] = asyncio.Lock()
+        return self._gates[replyKey]
+
+    async def request(self, replyKey, send, request, ref, sink=None, exclusive=False):
+        # sends the request and waits for the reply echoing ref, or for the
+        # next one in line while replies echo nothing
+        match = matchReference(ref)
+        gate = self.getGate(replyKey)
+        locked = exclusive or replyKey not in self._correlated
+        if locked:
+            await gate.acquire()
+        try:
+            future = self.connection.waitReply(replyKey, sink, match)
+            try:
+                await send(request)
+            except Exception:
+                self.connection.cancelReply(replyKey, future)
+                raise
+            try:
+                reply = await asyncio.wait_for(asyncio.shield(future), self.replyTimeout)
+            except asyncio.TimeoutError:
+                if replyKey in self._correlated:
+                    # its late reply echoes a reference nobody waits for
+                    self.connection.cancelReply(replyKey, future)
+                else:
+                    # the next reply in line is still this one's
+                    self.connection.detachSink(replyKey, future)
+                raise
+            except AmbiguousReplyException:
+                self._correlated.discard(replyKey)
+                raise
+        finally:
+            if locked:
+                gate.release()
+
+        if match(reply) == True:
+            self._correlated.add(replyKey)
+        return reply
+
+    async def _load(self, cacheName, replyKey, send, ref):
+        cache = self.caches[cacheName]
+        reply = cache.get(ref)
+        if reply != None:
+            return reply
+
+        # share the pending request with concurrent lookups of the same ref
+        inflightKey = (cacheName, ref)
+        if inflightKey in self._inflight:
+            return await asyncio.wait_for(
+                asyncio.shield(self._inflight[inflightKey]), self.replyTimeout
+            )
+
+        future = asyncio.ensure_future(self.request(replyKey, send, ref, ref))
+        self._inflight[inflightKey] = future
+        try:
+            reply = await asyncio.shield(future)
+        finally:
+            del self._inflight[inflightKey]
+
+        if not isErrorReply(reply):
+            cache.put(ref, reply)
+        return reply
+
+    async def _loadMany(self, loader, refs, concurrency):
+        # dedupe while keeping the caller's order
+        pending = iter(list(dict.fromkeys(refs)))
+        results = {}
+
+        async def worker():
+            for ref in pending:
+                results[ref] = await loader(ref)
+
+        async with asyncio.TaskGroup() as tg:
+            for i in range(max(1, concurrency)):
+                tg.create_task(worker())
+        return results
+
+    ## single ##
+    async def load_deposit_address(self, ref_str):
+        return await self._load(
+            CACHE_DEPOSIT_ADDRESS,
+            REPLY_LOAD_DEPOSIT_ADDRESS,
+            self.connection.load_deposit_address,
+            ref_str,
+        )
+
+    async def load_sub_accounts(self, ref_str):
+        return await self._load(
+            CACHE_SUB_ACCOUNTS,
+            REPLY_LOAD_SUB_ACCOUNTS,
+            self.connection.load_sub_accounts,
+            ref_str,
+        )
+
+    ## streamed ##
+    async def stream_sub_accounts(self, ref_str, onAccount):
+        # accounts are handed to onAccount as the reply is decoded, nothing
+        # is kept or cached. paged replies are followed through their cursor
+        # the array is streamed to the first waiter in line, so these always
+        # go out one at a time
+        request = ref_str
+        count = 0
+        while True:
+            sink = ArraySink(onAccount)
+            reply = await self.request(
+                REPLY_LOAD_SUB_ACCOUNTS,
+                self.connection.load_sub_accounts,
+                request,
+                ref_str,
+                sink,
+                exclusive=True,
+            )
+            count += sink.count
+
+            if isErrorReply(reply) or not isinstance(reply, dict):
+                return count, reply
+            cursor = reply.get(KEY_NEXT_CURSOR)
+            if not cursor:
+                return count, reply
+            request = {"reference": ref_str, "cursor": cursor}
+
+    ## bulk ##
+    async def load_deposit_addresses(self, refs, concurrency=DEFAULT_CONCURRENCY):
+        return await self._loadMany(self.load_deposit_address, refs, concurrency)
+
+    async def load_sub_accounts_many(self, refs, concurrency=DEFAULT_CONCURRENCY):
+        return await self._loadMany(self.load_sub_accounts, refs, concurrency)
+
+    ## cache management ##
+    def getCaches(self, cacheName):
+        if cacheName == CACHE_ALL:
+            return list(self.caches.values())
+        if cacheName not in self.caches:
+            raise Exception(f"unknown cache: {cacheName}")
+        return [self.caches[cacheName]]
+
+    def invalidate(self, cacheName, ref):
+        return any(cache.invalidate(ref) for cache in self.getCaches(cacheName))
+
+    def clear(self, cacheName=CACHE_ALL):
+        for cache in self.getCaches(cacheName):
+            cache.clear()
+
+    def stats(self):
+        return {name: cache.stats() for name, cache in self.caches.items()}
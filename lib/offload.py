@@ -0,0 +1,163 @@
+import asyncio
+import os
+import time
+from decimal import Decimal
+
+from lib.cash import LOCATION_CUSTODY, LOCATION_EXOTIC, CashMetrics
+from lib.sessions import SessionData, SessionMap
+
+# max time the loop may be held by snapshotting before it yields, in seconds
+DEFAULT_BUDGET = 0.005
+CHUNK_SIZE = 1024
+
+
+class LatencyGuard(object):
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.maxBlock = 0
+        self._since = time.monotonic()
+
+    async def checkpoint(self):
+        held = time.monotonic() - self._since
+        if held < self.budget:
+            return
+        self.maxBlock = max(self.maxBlock, held)
+        await asyncio.sleep(0)
+        self._since = time.monotonic()
+
+    def reset(self):
+        self._since = time.monotonic()
+
+
+## worker side, runs in the pool ##
+def sumShard(rows):
+    result = {}
+    for _, balances in rows:
+        for ccy in balances:
+            if ccy not in result:
+                result[ccy] = Decimal(0)
+            result[ccy] += balances[ccy]
+    return result
+
+
+def buildState(payload):
+    cashMetrics = CashMetrics()
+    for loc, cashMap in payload["wallets"].items():
+        cashMetrics.metricsMap[loc].cashMap = cashMap
+    cashMetrics.metricsMap[LOCATION_CUSTODY].userMap = dict(payload["users"])
+
+    sessionMap = SessionMap()
+    for product, sessionData in payload["sessions"]:
+        sessionMap.setSession(product, SessionData(sessionData))
+    return cashMetrics, sessionMap
+
+
+def renderCashReport(payload):
+    cashMetrics, sessionMap = buildState(payload)
+    return cashMetrics.getPrettyStr(sessionMap)
+
+
+def renderUsersCash(payload):
+    cashMetrics, _ = buildState(payload)
+    return cashMetrics.metricsMap[LOCATION_CUSTODY].getPrettyStr()
+
+
+def getLimboCashAggregate(payload):
+    _, sessionMap = buildState(payload)
+    return sessionMap.getLimboCashAggregate()
+
+
+def mergeSums(sums):
+    result = {}
+    for shard in sums:
+        for ccy in shard:
+            if ccy not in result:
+                result[ccy] = Decimal(0)
+            result[ccy] += shard[ccy]
+    return result
+
+
+## loop side ##
+class Offloader(object):
+    def __init__(self, workers=None, budget=DEFAULT_BUDGET):
+        self.workers = workers or os.cpu_count() or 1
+        self.budget = budget
+        # longest the loop was held by any job's copy, in seconds
+        self.maxBlock = 0
+        self._pool = None
+
+    def getPool(self):
+        if self._pool == None:
+            # pulls in multiprocessing, only paid for on the first job
+            from concurrent.futures import ProcessPoolExecutor
+
+            self._pool = ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool == None:
+            return
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+    async def runJob(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.getPool(), func, *args)
+
+    ## snapshots ##
+    # jobs are fed from a published StateSnapshot, it never changes so
+    # copying it in chunks still yields a single point in time
+    async def copyUsers(self, snapshot):
+        # balances are copied in chunks so the loop keeps reading in between,
+        # each copy times itself, concurrent jobs interleave at checkpoints
+        guard = LatencyGuard(self.budget)
+        rows = []
+        for userId, balances in snapshot.users.items():
+            rows.append((userId, dict(balances)))
+            if len(rows) % CHUNK_SIZE == 0:
+                await guard.checkpoint()
+        self.maxBlock = max(self.maxBlock, guard.maxBlock)
+        return rows
+
+    def copySessions(self, snapshot):
+        return [(session["product"], dict(session)) for session in snapshot.sessions]
+
+    def copyWallets(self, snapshot):
+        # exotic locations aren't part of the reports
+        return {
+            loc: dict(cashMap)
+            for loc, cashMap in snapshot.wallets.items()
+            if not loc.startswith(f"{LOCATION_EXOTIC}/")
+        }
+
+    async def getPayload(self, snapshot, wallets=False, users=False, sessions=False):
+        # plain dicts, the snapshot's read only views don't pickle
+        return {
+            "wallets": self.copyWallets(snapshot) if wallets else {},
+            "users": await self.copyUsers(snapshot) if users else [],
+            "sessions": self.copySessions(snapshot) if sessions else [],
+        }
+
+    ## jobs ##
+    async def getTotalCash(self, snapshot):
+        rows = await self.copyUsers(snapshot)
+        if not rows:
+            return {}
+
+        # one shard per worker
+        shardSize = -(-len(rows) // self.workers)
+        shards = [rows[i : i + shardSize] for i in range(0, len(rows), shardSize)]
+        sums = await asyncio.gather(*[self.runJob(sumShard, shard) for shard in shards])
+        return mergeSums(sums)
+
+    async def getLimboCashAggregate(self, snapshot):
+        payload = await self.getPayload(snapshot, sessions=True)
+        return await self.runJob(getLimboCashAggregate, payload)
+
+    async def renderCashReport(self, snapshot):
+        payload = await self.getPayload(snapshot, True, True, True)
+        return await self.runJob(renderCashReport, payload)
+
+    async def renderUsersCash(self, snapshot):
+        payload = await self.getPayload(snapshot, users=True)
+        return await self.runJob(renderUsersCash, payload)
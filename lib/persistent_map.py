@@ -0,0 +1,231 @@
+## immutable hash array mapped trie ##
+# every write returns a new map sharing all untouched nodes with the old one,
+# so a snapshot costs O(log32 n) per changed key instead of a full copy
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+HASH_MASK = (1 << 64) - 1
+
+_EMPTY_CHILDREN = (None,) * WIDTH
+
+
+class _Leaf(object):
+    __slots__ = ("hash", "key", "value")
+
+    def __init__(self, keyHash, key, value):
+        self.hash = keyHash
+        self.key = key
+        self.value = value
+
+
+class _Collision(object):
+    __slots__ = ("hash", "pairs")
+
+    def __init__(self, keyHash, pairs):
+        self.hash = keyHash
+        self.pairs = pairs
+
+
+class _Node(object):
+    __slots__ = ("children",)
+
+    def __init__(self, children=_EMPTY_CHILDREN):
+        self.children = children
+
+    def replace(self, index, child):
+        children = list(self.children)
+        children[index] = child
+        return _Node(tuple(children))
+
+
+def _hash(key):
+    return hash(key) & HASH_MASK
+
+
+def _split(shift, first, second):
+    # both entries land under the same slot above, push them down a level
+    node = _Node()
+    firstIndex = (first.hash >> shift) & MASK
+    secondIndex = (second.hash >> shift) & MASK
+    if firstIndex == secondIndex:
+        return node.replace(firstIndex, _split(shift + BITS, first, second))
+    return node.replace(firstIndex, first).replace(secondIndex, second)
+
+
+def _set(node, shift, keyHash, key, value):
+    # returns the new node and whether a key was added
+    index = (keyHash >> shift) & MASK
+    child = node.children[index]
+
+    if child == None:
+        return node.replace(index, _Leaf(keyHash, key, value)), True
+
+    if isinstance(child, _Node):
+        newChild, added = _set(child, shift + BITS, keyHash, key, value)
+        if newChild is child:
+            return node, False
+        return node.replace(index, newChild), added
+
+    if isinstance(child, _Leaf):
+        if child.hash == keyHash and child.key == key:
+            if child.value is value:
+                return node, False
+            return node.replace(index, _Leaf(keyHash, key, value)), False
+        if child.hash == keyHash:
+            pairs = ((child.key, child.value), (key, value))
+            return node.replace(index, _Collision(keyHash, pairs)), True
+        newLeaf = _Leaf(keyHash, key, value)
+        return node.replace(index, _split(shift + BITS, child, newLeaf)), True
+
+    # collision bucket
+    if child.hash != keyHash:
+        newLeaf = _Leaf(keyHash, key, value)
+        return node.replace(index, _split(shift + BITS, child, newLeaf)), True
+    pairs = [pair for pair in child.pairs if pair[0] != key]
+    added = len(pairs) == len(child.pairs)
+    pairs.append((key, value))
+    return node.replace(index, _Collision(keyHash, tuple(pairs))), added
+
+
+def _delete(node, shift, keyHash, key):
+    # returns the new node (None once empty) and whether a key was removed
+    index = (keyHash >> shift) & MASK
+    child = node.children[index]
+    if child == None:
+        return node, False
+
+    if isinstance(child, _Node):
+        newChild, removed = _delete(child, shift + BITS, keyHash, key)
+        if not removed:
+            return node, False
+    elif isinstance(child, _Leaf):
+        if child.hash != keyHash or child.key != key:
+            return node, False
+        newChild = None
+    else:
+        pairs = tuple(pair for pair in child.pairs if pair[0] != key)
+        if len(pairs) == len(child.pairs):
+            return node, False
+        newChild = _Collision(keyHash, pairs)
+        if len(pairs) == 1:
+            newChild = _Leaf(keyHash, pairs[0][0], pairs[0][1])
+
+    newNode = node.replace(index, newChild)
+    if all(c == None for c in newNode.children):
+        return None, True
+    return newNode, True
+
+
+def _build(entries, shift):
+    # bulk load, nodes are built bottom up without any path copying
+    buckets = [[] for _ in range(WIDTH)]
+    for entry in entries:
+        buckets[(entry.hash >> shift) & MASK].append(entry)
+
+    children = []
+    for bucket in buckets:
+        if not bucket:
+            children.append(None)
+        elif len(bucket) == 1:
+            children.append(bucket[0])
+        elif all(entry.hash == bucket[0].hash for entry in bucket):
+            pairs = tuple((entry.key, entry.value) for entry in bucket)
+            children.append(_Collision(bucket[0].hash, pairs))
+        else:
+            children.append(_build(bucket, shift + BITS))
+    return _Node(tuple(children))
+
+
+def _iterate(node):
+    for child in node.children:
+        if child == None:
+            continue
+        if isinstance(child, _Node):
+            yield from _iterate(child)
+        elif isinstance(child, _Leaf):
+            yield child.key, child.value
+        else:
+            yield from child.pairs
+
+
+class PersistentMap(object):
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, root=None, size=0):
+        self._root = root
+        self._size = size
+
+    @classmethod
+    def fromItems(cls, items):
+        entries = dict(items)
+        if not entries:
+            return cls()
+        leaves = [_Leaf(_hash(key), key, value) for key, value in entries.items()]
+        return cls(_build(leaves, 0), len(leaves))
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def get(self, key, default=None):
+        node = self._root
+        keyHash = _hash(key)
+        shift = 0
+        while node != None:
+            child = node.children[(keyHash >> shift) & MASK]
+            if isinstance(child, _Node):
+                node = child
+                shift += BITS
+                continue
+            if isinstance(child, _Leaf):
+                if child.hash == keyHash and child.key == key:
+                    return child.value
+            elif isinstance(child, _Collision) and child.hash == keyHash:
+                for pairKey, pairValue in child.pairs:
+                    if pairKey == key:
+                        return pairValue
+            break
+        return default
+
+    def set(self, key, value):
+        root = self._root or _Node()
+        newRoot, added = _set(root, 0, _hash(key), key, value)
+        if newRoot is root and self._root != None:
+            return self
+        return PersistentMap(newRoot, self._size + (1 if added else 0))
+
+    def delete(self, key):
+        if self._root == None:
+            return self
+        newRoot, removed = _delete(self._root, 0, _hash(key), key)
+        if not removed:
+            return self
+        return PersistentMap(newRoot, self._size - 1)
+
+    def items(self):
+        if self._root == None:
+            return iter(())
+        return _iterate(self._root)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+
+_MISSING = object()
@@ -1,16 +1,21 @@
 import logging
 from commands import COMMAND_HELP, COMMAND_HELP_SESSION
 
-def processHelp(commandsObj, requestStr):
+def getHelpStr(commandsObj, requestStr):
    if len(requestStr) == 0:
       logging.error("empty help command")
-      return
+      return None
    elif requestStr == COMMAND_HELP:
-      print (commandsObj.getHelpStr())
-      return
+      return commandsObj.getHelpStr()
    else:
       theCommand = commandsObj
       keys = requestStr.split()
       for i in range(1, len(keys)):
          theCommand = theCommand.getChild(keys[i])
-      print (theCommand.getHelpStr())
+      return theCommand.getHelpStr()
+
+def processHelp(commandsObj, requestStr):
+   helpStr = getHelpStr(commandsObj, requestStr)
+   if helpStr == None:
+      return
+   print (helpStr)
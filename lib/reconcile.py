@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from lib.cash import (
+    LOCATION_CLEARING,
+    LOCATION_CUSTODY,
+    LOCATION_HOT,
+    LOCATION_PENDING,
+    LOCATION_WARM,
+)
+from lib.change_feed import KIND_ENTITY, KIND_WALLET
+
+## invariant, per currency ##
+# liabilities: custody + session limbo + clearing account
+# assets:      hot + warm wallets + pending withdrawals
+# the difference is assets - liabilities. past the currency's tolerance for
+# longer than the grace period it is a break, updates arriving one at a time
+# routinely leave the sums apart for a moment
+SIDE_LIABILITIES = "liabilities"
+SIDE_ASSETS = "assets"
+
+WalletSides = {
+    LOCATION_CLEARING: SIDE_LIABILITIES,
+    LOCATION_HOT: SIDE_ASSETS,
+    LOCATION_WARM: SIDE_ASSETS,
+    LOCATION_PENDING: SIDE_ASSETS,
+}
+
+# smallest unit amounts are kept in, absorbs rounding in server aggregates
+DEFAULT_TOLERANCE = Decimal("0.00000001")
+DEFAULT_GRACE = 5
+DEFAULT_HISTORY = 1000
+
+
+@dataclass(slots=True)
+class ReconBreak:
+    currency: str
+    difference: Decimal
+    # the delta that moved the currency out of balance, None for limbo changes
+    cause: object
+    opened_at: float = field(default_factory=time.time)
+    closed_at: float = None
+    # the latest delta while the break stayed open
+    last: object = None
+
+    def isOpen(self):
+        return self.closed_at == None
+
+    def toDict(self):
+        def deltaDict(delta):
+            if delta == None:
+                return None
+            return {
+                "seq": delta.seq,
+                "kind": delta.kind,
+                "key": delta.key,
+                "currency": delta.currency,
+                "old": delta.old,
+                "new": delta.new,
+            }
+
+        return {
+            "currency": self.currency,
+            "difference": self.difference,
+            "cause": deltaDict(self.cause),
+            "last": deltaDict(self.last),
+            "opened_at": self.opened_at,
+            "closed_at": self.closed_at,
+        }
+
+
+class Reconciler(object):
+    # running sums are adjusted by each delta, nothing is recomputed
+    # from the full state after the initial seed
+    def __init__(
+        self,
+        cashMetrics,
+        sessionMap,
+        tolerance=DEFAULT_TOLERANCE,
+        grace=DEFAULT_GRACE,
+        historySize=DEFAULT_HISTORY,
+        offloader=None,
+        snapshots=None,
+    ):
+        self.sessionMap = sessionMap
+        # with both, the limbo aggregate is summed off the loop
+        self.offloader = offloader if snapshots != None else None
+        self.snapshots = snapshots
+        # one tolerance for every currency or {currency: tolerance}
+        if not isinstance(tolerance, dict):
+            tolerance = {None: tolerance}
+        self.tolerances = {ccy: Decimal(str(value)) for ccy, value in tolerance.items()}
+        self.grace = grace
+        self.sums = {SIDE_LIABILITIES: {}, SIDE_ASSETS: {}}
+        self.openBreaks = {}
+        self.history = deque(maxlen=historySize)
+        self.callbacks = []
+
+        # out of balance, not for long enough to be a break yet
+        self._pending = {}
+        self._pendingSince = {}
+        self._timers = {}
+
+        self._limbo = {}
+        self._sessionVersion = None
+        self._limboScheduled = False
+        self._limboTask = None
+
+        # the client builds it before any state comes in, the seed only
+        # costs something when embedded next to a loaded CashMetrics
+        for ccy, value in cashMetrics.metricsMap[LOCATION_CUSTODY].getTotalCash().items():
+            self.add(SIDE_LIABILITIES, ccy, value)
+        for loc, side in WalletSides.items():
+            for ccy, value in cashMetrics.metricsMap[loc].cashMap.items():
+                self.add(side, ccy, value)
+        self.syncLimbo()
+        for ccy in self.currencies():
+            self.check(ccy, None)
+
+        cashMetrics.changeFeed.subscribe(self.onDelta)
+        sessionMap.subscribe(self.onSessionChange)
+
+    def subscribe(self, callback):
+        # called with the break when it opens and again when it closes
+        self.callbacks.append(callback)
+
+    def add(self, side, ccy, value):
+        sums = self.sums[side]
+        sums[ccy] = sums.get(ccy, Decimal(0)) + value
+
+    def getTolerance(self, ccy):
+        return self.tolerances.get(ccy, self.tolerances.get(None, DEFAULT_TOLERANCE))
+
+    def currencies(self):
+        return set(self.sums[SIDE_LIABILITIES]) | set(self.sums[SIDE_ASSETS])
+
+    def getDifference(self, ccy):
+        assets = self.sums[SIDE_ASSETS].get(ccy, Decimal(0))
+        liabilities = self.sums[SIDE_LIABILITIES].get(ccy, Decimal(0))
+        return assets - liabilities
+
+    def syncLimbo(self):
+        # limbo only moves with the session map, diff its aggregate on change
+        if self._sessionVersion == self.sessionMap.version:
+            return []
+        self._sessionVersion = self.sessionMap.version
+        return self.applyLimbo(self.sessionMap.getLimboCashAggregate())
+
+    def applyLimbo(self, limbo):
+        changed = []
+        for ccy in set(limbo) | set(self._limbo):
+            diff = limbo.get(ccy, Decimal(0)) - self._limbo.get(ccy, Decimal(0))
+            if diff:
+                self.add(SIDE_LIABILITIES, ccy, diff)
+                changed.append(ccy)
+        self._limbo = limbo
+        return changed
+
+    def refreshLimbo(self):
+        self._limboScheduled = False
+        for ccy in self.syncLimbo():
+            self.check(ccy, None)
+
+    def onSessionChange(self, sessionMap):
+        # a streamed session list changes the map once per session, the
+        # limbo aggregate is diffed once they are all in
+        if self._limboScheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.refreshLimbo()
+            return
+        self._limboScheduled = True
+        if self.offloader != None:
+            self._limboTask = loop.create_task(self.offloadLimbo())
+        else:
+            loop.call_soon(self.refreshLimbo)
+
+    async def offloadLimbo(self):
+        # deltas checked while the job runs see the previous limbo, the
+        # grace period absorbs that like any other update in flight
+        await asyncio.sleep(0)
+        self._limboScheduled = False
+        version = self.sessionMap.version
+        snapshot = self.snapshots.publish()
+        try:
+            limbo = await self.offloader.getLimboCashAggregate(snapshot)
+        except Exception as e:
+            logging.error(f"limbo aggregate failed: {e}")
+            return
+        # a newer aggregate may have landed meanwhile
+        if self._sessionVersion != None and self._sessionVersion >= version:
+            return
+        self._sessionVersion = version
+        for ccy in self.applyLimbo(limbo):
+            self.check(ccy, None)
+
+    def onDelta(self, delta):
+        if self.offloader == None:
+            self.refreshLimbo()
+
+        if delta.kind == KIND_ENTITY:
+            side = SIDE_LIABILITIES
+        elif delta.kind == KIND_WALLET and delta.key in WalletSides:
+            side = WalletSides[delta.key]
+        else:
+            return
+
+        self.add(side, delta.currency, delta.delta)
+        self.check(delta.currency, delta)
+
+    def check(self, ccy, delta):
+        difference = self.getDifference(ccy)
+        current = self.openBreaks.get(ccy)
+
+        if abs(difference) <= self.getTolerance(ccy):
+            self.clearPending(ccy)
+            if current != None:
+                current.difference = difference
+                current.last = delta
+                current.closed_at = time.time()
+                del self.openBreaks[ccy]
+                self.notify(current)
+            return
+
+        if current != None:
+            current.difference = difference
+            current.last = delta
+            return
+
+        pending = self._pending.get(ccy)
+        if pending == None:
+            pending = self._pending[ccy] = ReconBreak(ccy, difference, delta)
+            self._pendingSince[ccy] = time.monotonic()
+            self.armGrace(ccy)
+        else:
+            pending.difference = difference
+            pending.last = delta
+
+        if time.monotonic() - self._pendingSince[ccy] >= self.grace:
+            self.open(ccy)
+
+    ## grace period ##
+    def armGrace(self, ccy):
+        if self.grace <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop to time it, checked again on the next update
+            return
+        self._timers[ccy] = loop.call_later(self.grace, self.onGraceElapsed, ccy)
+
+    def onGraceElapsed(self, ccy):
+        self._timers.pop(ccy, None)
+        pending = self._pending.get(ccy)
+        if pending != None:
+            self.check(ccy, pending.last)
+
+    def clearPending(self, ccy):
+        self._pending.pop(ccy, None)
+        self._pendingSince.pop(ccy, None)
+        timer = self._timers.pop(ccy, None)
+        if timer:
+            timer.cancel()
+
+    def open(self, ccy):
+        reconBreak = self._pending[ccy]
+        self.clearPending(ccy)
+        self.openBreaks[ccy] = reconBreak
+        self.history.append(reconBreak)
+        logging.warning(f"reconciliation break on {ccy}: {reconBreak.difference}")
+        self.notify(reconBreak)
+
+    def notify(self, reconBreak):
+        for callback in self.callbacks:
+            callback(reconBreak)
+
+    def status(self):
+        self.refreshLimbo()
+        result = {}
+        for ccy in sorted(self.currencies()):
+            result[ccy] = {
+                SIDE_ASSETS: self.sums[SIDE_ASSETS].get(ccy, Decimal(0)),
+                SIDE_LIABILITIES: self.sums[SIDE_LIABILITIES].get(ccy, Decimal(0)),
+                "difference": self.getDifference(ccy),
+                "open_break": ccy in self.openBreaks,
+                "pending": ccy in self._pending,
+            }
+        return result
+
+    def getHistory(self, count=None):
+        # most recent first
+        breaks = list(reversed(self.history))
+        if count:
+            breaks = breaks[:count]
+        return [reconBreak.toDict() for reconBreak in breaks]
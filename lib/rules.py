@@ -0,0 +1,371 @@
+import asyncio
+import json
+import logging
+import operator
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from lib.change_feed import KIND_ENTITY, KIND_WALLET
+
+METRIC_WALLET = "wallet"
+METRIC_CUSTODY = "custody"
+METRIC_WITHDRAW_QUEUE = "withdraw_queue"
+
+OP_JUMP_PCT = "jump_pct"
+
+Operators = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+SINK_LOG = "log"
+SINK_FILE = "file"
+SINK_WEBHOOK = "webhook"
+
+DEFAULT_WEBHOOK_TIMEOUT = 5
+DEFAULT_ALERT_HISTORY = 1000
+
+
+@dataclass(slots=True, frozen=True)
+class Alert:
+    rule: str
+    # currency for rules on any currency, None otherwise
+    subject: object
+    value: Decimal
+    message: str
+    timestamp: float = field(default_factory=time.time)
+
+    def toDict(self):
+        return {
+            "rule": self.rule,
+            "subject": self.subject,
+            "value": str(self.value),
+            "message": self.message,
+            "timestamp": self.timestamp,
+        }
+
+
+## sinks ##
+class LogSink(object):
+    def emit(self, alert):
+        logging.warning(f"[alert] {alert.message}")
+
+
+class FileSink(object):
+    # appended from a single thread, in order, so a slow disk never holds
+    # up the loop
+    def __init__(self, path):
+        self.path = path
+        self._executor = None
+
+    def emit(self, alert):
+        line = json.dumps(alert.toDict(), default=str) + "\n"
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.write(line)
+            return
+        if self._executor == None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="alert file")
+        self._executor.submit(self.write, line)
+
+    def write(self, line):
+        try:
+            with open(self.path, "a") as f:
+                f.write(line)
+        except Exception as e:
+            logging.error(f"failed to write alert to {self.path}: {e}")
+
+
+class WebhookSink(object):
+    # fire and forget, a slow endpoint never holds up notification processing
+    def __init__(self, url, timeout=DEFAULT_WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._tasks = set()
+
+    def emit(self, alert):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logging.error(f"no event loop to post alert to {self.url}")
+            return
+        task = loop.create_task(self.post(alert))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def post(self, alert):
+        import aiohttp
+
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(self.url, json=alert.toDict()) as response:
+                    if response.status >= 400:
+                        logging.error(f"webhook {self.url} answered {response.status}")
+        except Exception as e:
+            logging.error(f"failed to post alert to {self.url}: {e}")
+
+
+def makeSink(spec):
+    sinkType = spec.get("type", SINK_LOG)
+    if sinkType == SINK_LOG:
+        return LogSink()
+    if sinkType == SINK_FILE:
+        return FileSink(spec["path"])
+    if sinkType == SINK_WEBHOOK:
+        return WebhookSink(spec["url"], spec.get("timeout", DEFAULT_WEBHOOK_TIMEOUT))
+    raise Exception(f"unknown alert sink: {sinkType}")
+
+
+## rules ##
+class Rule(object):
+    # compiled form of a rule spec, e.g.
+    #  {"name": "queue", "metric": "withdraw_queue", "op": ">", "value": 50, "for": 30}
+    #  {"name": "hot lbtc", "metric": "wallet", "location": "hot_wallet",
+    #   "currency": "LBTC", "op": "<", "value": "1.5"}
+    #  {"name": "jump", "metric": "custody", "currency": "USDT", "op": "jump_pct", "value": 20}
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.metric = spec["metric"]
+        self.location = spec.get("location")
+        self.currency = spec.get("currency")
+        self.op = spec["op"]
+        self.threshold = Decimal(str(spec["value"]))
+        self.holdFor = float(spec.get("for", 0))
+        self.cooldown = float(spec.get("cooldown", 0))
+
+        if self.metric not in [METRIC_WALLET, METRIC_CUSTODY, METRIC_WITHDRAW_QUEUE]:
+            raise Exception(f"rule {self.name}: unknown metric {self.metric}")
+        if self.metric == METRIC_WALLET and not self.location:
+            raise Exception(f"rule {self.name}: wallet rules need a location")
+        if self.op != OP_JUMP_PCT and self.op not in Operators:
+            raise Exception(f"rule {self.name}: unknown operator {self.op}")
+        self.compare = Operators.get(self.op)
+
+    def getFieldKey(self):
+        # the only fields whose changes can flip this rule
+        if self.metric == METRIC_WALLET:
+            return (METRIC_WALLET, self.location, self.currency)
+        if self.metric == METRIC_CUSTODY:
+            return (METRIC_CUSTODY, None, self.currency)
+        return (METRIC_WITHDRAW_QUEUE, None, None)
+
+    def evaluate(self, old, new):
+        # returns the value the rule tripped on, None when it holds
+        if self.op == OP_JUMP_PCT:
+            if not old:
+                return None
+            change = abs(new - old) / abs(old) * 100
+            return change if change > self.threshold else None
+        if new == None:
+            return None
+        return new if self.compare(new, self.threshold) else None
+
+    def describe(self):
+        target = self.metric
+        if self.location:
+            target += f" {self.location}"
+        if self.currency:
+            target += f" {self.currency}"
+        result = f"{target} {self.op} {self.threshold}"
+        if self.holdFor:
+            result += f" for {self.holdFor}s"
+        return result
+
+
+class RuleEngine(object):
+    def __init__(self, changeFeed=None, sinks=None):
+        self.rules = []
+        self.index = {}
+        self.sinks = sinks or [LogSink()]
+        self.alerts = deque(maxlen=DEFAULT_ALERT_HISTORY)
+        self.withdrawQueueSize = None
+
+        # (rule name, subject) -> monotonic time the condition started to hold
+        self._since = {}
+        self._timers = {}
+        self._firedAt = {}
+        # jump rules: (rule name, subject) -> value before the first jump
+        self._baselines = {}
+
+        # custody totals per currency, what custody rules are evaluated on.
+        # a notification moves many entities, the totals are checked once
+        # it is applied: currency -> total before the pending changes
+        self.custodyTotals = {}
+        self._custodyBefore = {}
+        self._custodyScheduled = False
+
+        if changeFeed != None:
+            changeFeed.subscribe(self.onDelta)
+
+    @classmethod
+    def fromFile(cls, path, changeFeed=None):
+        with open(path, "r") as f:
+            config = json.load(f)
+        sinks = [makeSink(spec) for spec in config.get("sinks", [])]
+        engine = cls(changeFeed, sinks or None)
+        for spec in config.get("rules", []):
+            engine.addRule(spec)
+        return engine
+
+    def addRule(self, spec):
+        rule = Rule(spec)
+        self.rules.append(rule)
+        self.index.setdefault(rule.getFieldKey(), []).append(rule)
+        return rule
+
+    ## inputs ##
+    def onDelta(self, delta):
+        if delta.kind == KIND_ENTITY:
+            self.addCustody(delta.currency, delta.delta)
+            return
+        if delta.kind != KIND_WALLET:
+            return
+        self.applyAll(METRIC_WALLET, delta.key, delta.currency, delta.old, delta.new)
+
+    def applyAll(self, metric, location, ccy, old, new):
+        # rules on this currency and rules on any currency, the latter
+        # keep their state per currency
+        for rule in self.index.get((metric, location, ccy), []):
+            self.apply(rule, None, old, new)
+        for rule in self.index.get((metric, location, None), []):
+            self.apply(rule, ccy, old, new)
+
+    def addCustody(self, ccy, amount):
+        total = self.custodyTotals.get(ccy, Decimal(0))
+        self._custodyBefore.setdefault(ccy, total)
+        self.custodyTotals[ccy] = total + amount
+        if self._custodyScheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.checkCustody()
+            return
+        self._custodyScheduled = True
+        loop.call_soon(self.checkCustody)
+
+    def checkCustody(self):
+        self._custodyScheduled = False
+        before, self._custodyBefore = self._custodyBefore, {}
+        for ccy, old in before.items():
+            new = self.custodyTotals[ccy]
+            if new != old:
+                self.applyAll(METRIC_CUSTODY, None, ccy, old, new)
+
+    def updateWithdrawQueueSize(self, data):
+        size = data
+        if isinstance(data, dict):
+            size = data.get("size", data.get("queue_size"))
+        try:
+            size = Decimal(str(size))
+        except Exception:
+            logging.debug(f"unexpected withdraw queue size payload: {data}")
+            return
+
+        old = self.withdrawQueueSize
+        self.withdrawQueueSize = size
+        for rule in self.index.get((METRIC_WITHDRAW_QUEUE, None, None), []):
+            self.apply(rule, None, old, size)
+
+    ## debouncing ##
+    def apply(self, rule, subject, old, new):
+        key = (rule.name, subject)
+        value = rule.evaluate(old, new)
+        if value == None:
+            self.clear(rule, key)
+            return
+
+        if key in self._since:
+            if rule.op == OP_JUMP_PCT and key not in self._timers:
+                # each jump is a trip of its own, measured from where the
+                # first one started. back within range of it ends the episode
+                value = rule.evaluate(self._baselines.get(key), new)
+                if value == None:
+                    self.clear(rule, key)
+                else:
+                    self.fire(rule, subject, value)
+                return
+            # already tripped or waiting on its hold time
+            if key not in self._timers and not self.isFiring(key):
+                self.checkHeld(rule, subject, value)
+            return
+
+        self._since[key] = time.monotonic()
+        if rule.op == OP_JUMP_PCT:
+            self._baselines[key] = old
+        if rule.holdFor <= 0:
+            self.fire(rule, subject, value)
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop to time the hold, checked again on the next update
+            return
+        self._timers[key] = loop.call_later(
+            rule.holdFor, self.onHoldElapsed, rule, subject, value
+        )
+
+    def clear(self, rule, key):
+        self._since.pop(key, None)
+        self._baselines.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if not rule.cooldown:
+            self._firedAt.pop(key, None)
+
+    def isFiring(self, key):
+        firedAt = self._firedAt.get(key)
+        since = self._since.get(key)
+        return firedAt != None and since != None and firedAt >= since
+
+    def onHoldElapsed(self, rule, subject, value):
+        self._timers.pop((rule.name, subject), None)
+        self.checkHeld(rule, subject, value)
+
+    def checkHeld(self, rule, subject, value):
+        since = self._since.get((rule.name, subject))
+        if since != None and time.monotonic() - since >= rule.holdFor:
+            self.fire(rule, subject, value)
+
+    def fire(self, rule, subject, value):
+        key = (rule.name, subject)
+        now = time.monotonic()
+        lastFired = self._firedAt.get(key)
+        if lastFired != None and now - lastFired < rule.cooldown:
+            # only an emitted alert restarts the cooldown
+            return
+        self._firedAt[key] = now
+
+        message = f"{rule.name}: {rule.describe()}, got {value}"
+        if subject != None:
+            message += f" ({subject})"
+        alert = Alert(rule.name, subject, value, message)
+        self.alerts.append(alert)
+        for sink in self.sinks:
+            try:
+                sink.emit(alert)
+            except Exception as e:
+                logging.error(f"alert sink {type(sink).__name__} failed: {e}")
+
+    def status(self):
+        active = {}
+        for name, subject in self._since:
+            active.setdefault(name, []).append(subject)
+        return [
+            {
+                "name": rule.name,
+                "rule": rule.describe(),
+                "active": active.get(rule.name, []),
+            }
+            for rule in self.rules
+        ]
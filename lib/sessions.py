@@ -1,6 +1,10 @@
+import logging
+import json
 from datetime import datetime
 from decimal import Decimal
+from functools import lru_cache
 from SDK.leverex_core.utils import round_flat
+from lib.stream_parse import ArraySink
 
 FixScenarioMap = {
    "cancel" : "cancel_trades",
@@ -18,9 +22,16 @@ SessionDataKeys = [
 ]
 
 VAL_DAMAGED = 'Damaged'
+KEY_PRODUCT = 'product_name'
+KEY_SESSIONS = 'sessions'
+
+#where session lists sit in a frame
+SESSIONS_PATH = ('data', KEY_SESSIONS)
 KEY_IM      = 'im_balance'
 KEY_NET_EXP = 'net_exposure'
 
+#session ids and timestamps repeat on every render
+@lru_cache(maxsize=65536)
 def toHumanTime(timestamp_ms):
    dt = datetime.fromtimestamp(int(timestamp_ms)/1000)
    return dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -57,6 +68,13 @@ class SessionData(object):
    def isDamaged(self):
       return self.state == VAL_DAMAGED
 
+   def toDict(self):
+      result = {}
+      for key in SessionDataKeys:
+         if hasattr(self, key):
+            result[key] = getattr(self, key)
+      return result
+
    def __str__(self):
       result  = f" - session {self.id}:\n"
       result += f"   . state: {self.state}\n"
@@ -130,6 +148,22 @@ class SessionMap(object):
       self.sessionMap = {}
       self.currentSessions = {}
 
+      #bumped on every change, renderers key their caches on it
+      self.version = 0
+      self._render = (None, None)
+      self._limboCash = (None, None)
+
+      #called with the map after every change
+      self.callbacks = []
+
+   def subscribe(self, callback):
+      self.callbacks.append(callback)
+
+   def touch(self):
+      self.version += 1
+      for callback in self.callbacks:
+         callback(self)
+
    def find(self, sessionId):
       #search damaged session map
       for product in self.sessionMap:
@@ -155,6 +189,7 @@ class SessionMap(object):
       if not product in self.sessionMap:
          self.sessionMap[product] = {}
       self.sessionMap[product][sessionObj.id] = sessionObj
+      self.touch()
 
    def setCurrent(self, sessionObj: CurrentSessionData):
       product = sessionObj.product
@@ -162,6 +197,7 @@ class SessionMap(object):
          self.currentSessions[product].id == sessionObj.id:
          return
       self.currentSessions[product] = sessionObj
+      self.touch()
 
    def extendSession(self, sesId, data):
       session = self.find(sesId)
@@ -169,12 +205,18 @@ class SessionMap(object):
          logging.warn(f"could not extend session info for id: {sesId}")
          return
       session.deserData(data)
+      self.touch()
 
    def updateImInfo(self, data):
       for product in self.currentSessions:
          self.currentSessions[product].updateImInfo(data)
+      self.touch()
 
    def getLimboCashAggregate(self):
+      version, result = self._limboCash
+      if version == self.version:
+         return dict(result)
+
       #sum up cash in damaged sessions
       result = {}
       for product in self.sessionMap:
@@ -187,9 +229,14 @@ class SessionMap(object):
                      if not ccy in result:
                         result[ccy] = Decimal(0)
                      result[ccy] += Decimal(balEntry[ccy])
-      return result
+      self._limboCash = (self.version, result)
+      return dict(result)
 
    def __str__(self):
+      version, result = self._render
+      if version == self.version:
+         return result
+
       def getShortDescr(sessionObj):
          descr = f"id: {sessionObj.id}"
          descr += f", created at: {toHumanTime(sessionObj.id)}"
@@ -198,50 +245,92 @@ class SessionMap(object):
             descr += f", reason: {sessionObj.reason}"
          return descr
 
-      result = " - Current Sessions:\n"
+      result = [" - Current Sessions:\n"]
       if not self.currentSessions:
-         result += ("  |- N/A\n")
+         result.append("  |- N/A\n")
       else:
          for product in self.currentSessions:
-            result += f"  |- {product}:\n"
-            result += f"    |- {getShortDescr(self.currentSessions[product])}\n"
+            result.append(f"  |- {product}:\n")
+            result.append(f"    |- {getShortDescr(self.currentSessions[product])}\n")
 
-      result += " - Damaged Sessions:\n"
+      result.append(" - Damaged Sessions:\n")
       if not self.sessionMap:
-         result += (" - No session data!")
+         result.append(" - No session data!")
       else:
          for product in self.sessionMap:
-            result += (f"  |- {product}:\n")
+            result.append(f"  |- {product}:\n")
             sesData = self.sessionMap[product]
             if not sesData:
-               result += ("    |- N/A\n")
+               result.append("    |- N/A\n")
                continue
 
             for sessionId in sesData:
                session = sesData[sessionId]
-               result += f"    |- {getShortDescr(session)}\n"
+               result.append(f"    |- {getShortDescr(session)}\n")
 
       #limbo'd cash
       limboAggregate = self.getLimboCashAggregate()
-      limboStr = ""
+      result.append(f" - Cash in limbo:\n")
       if not limboAggregate:
-         limboStr = "  |- N/A"
+         result.append("  |- N/A")
       for ccy in limboAggregate:
-         limboStr += f"    |- {ccy}: {round_flat(limboAggregate[ccy], 8)}\n"
-      result += f" - Cash in limbo:\n"
-      result += f"{limboStr}\n"
+         result.append(f"    |- {ccy}: {round_flat(limboAggregate[ccy], 8)}\n")
+      result.append("\n")
 
+      result = "".join(result)
+      self._render = (self.version, result)
       return result
 
+   def toDict(self):
+      return {
+         "current": {product: session.toDict() \
+            for product, session in self.currentSessions.items()},
+         "sessions": {product: [session.toDict() for session in sesData.values()] \
+            for product, sesData in self.sessionMap.items()},
+         "limbo_total": {ccy: str(val) \
+            for ccy, val in self.getLimboCashAggregate().items()},
+      }
+
+   def toJson(self):
+      return json.dumps(self.toDict(), default=str)
+
 def processSessionData(data):
-   product = data['product_name']
+   product = data[KEY_PRODUCT]
    sessionData = {}
-   for session in data['sessions']:
+   for session in data[KEY_SESSIONS]:
       sessionObj = SessionData(session)
       sessionData[sessionObj.id] = sessionObj
 
    return product, sessionData
 
+class SessionStreamLoader(ArraySink):
+   #sessions go in the map one at a time as the frame is scanned, only
+   #the raw element being decoded is held on top of the map itself
+   def __init__(self, sessionMap):
+      super().__init__()
+      self.sessionMap = sessionMap
+      self.pending = []
+
+   def onItem(self, item, parent):
+      self.count += 1
+      sessionObj = SessionData(item)
+      product = parent.get(KEY_PRODUCT)
+      if product == None:
+         #product name comes after the list, hold on until the frame ends
+         self.pending.append(sessionObj)
+         return
+      self.sessionMap.setSession(product, sessionObj)
+
+   def onEnd(self, parent):
+      product = parent.get(KEY_PRODUCT)
+      if product == None:
+         if self.pending:
+            logging.warning(f"dropping {len(self.pending)} sessions without a product")
+      else:
+         for sessionObj in self.pending:
+            self.sessionMap.setSession(product, sessionObj)
+      self.pending = []
+
 def processShowSessions(sessionMap, sessionId=None):
    if sessionId == None:
       print (str(sessionMap))
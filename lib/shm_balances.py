@@ -0,0 +1,244 @@
+import logging
+import struct
+import sys
+import time
+from decimal import Decimal
+from multiprocessing import resource_tracker, shared_memory
+
+from lib.cash import LOCATION_CUSTODY, LOCATION_EXOTIC
+from lib.change_feed import KIND_ENTITY as CHANGE_ENTITY
+
+## segment layout, little endian ##
+# header: magic, layout version, seqlock counter, capacity, record count, publish time
+# record: kind, location (wallets only), entity id (entities only), currency,
+#         balance as a fixed point integer with 8 decimals
+# records of wallets and entities that went away are tombstoned, readers skip
+# them and the writer reuses their slots
+HEADER = struct.Struct("<4sIQIId")
+RECORD = struct.Struct("<B7x32sq8sq")
+
+MAGIC = b"LVXB"
+LAYOUT_VERSION = 2
+SEQ_OFFSET = 8
+
+KIND_WALLET = 0
+KIND_ENTITY = 1
+KIND_TOMBSTONE = 255
+
+SCALE = 10**8
+DEFAULT_CAPACITY = 262144
+# a reader gives up on a consistent copy after this long, in seconds, backing
+# off from yielding its time slice to READ_BACKOFF_MAX between attempts
+READ_TIMEOUT = 1.0
+READ_BACKOFF_MAX = 0.001
+
+# segments created by publishers in this process, they are already
+# registered with our resource tracker
+_published = set()
+
+
+def toFixed(value):
+    return int((Decimal(value) * SCALE).to_integral_value())
+
+
+def fromFixed(value):
+    return Decimal(value) / SCALE
+
+
+class BalancePublisher(object):
+    # single writer, mirrors wallet and per entity balances into shared memory
+    def __init__(self, name, cashMetrics, capacity=DEFAULT_CAPACITY):
+        self.cashMetrics = cashMetrics
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=True, size=HEADER.size + RECORD.size * capacity
+        )
+        self.buf = self.shm.buf
+        _published.add(self.shm.name)
+        self.seq = 0
+        self.count = 0
+        self._slots = {}
+        # (kind, location, entity id) -> currencies holding a slot
+        self._owned = {}
+        self._free = []
+        self._full = False
+
+        self._walletVersions = {}
+        self._pendingEntities = set()
+        cashMetrics.changeFeed.subscribe(self.onDelta)
+        self._pendingEntities.update(cashMetrics.metricsMap[LOCATION_CUSTODY].userMap)
+
+        self.writeHeader()
+        self.publish()
+
+    def onDelta(self, delta):
+        if delta.kind == CHANGE_ENTITY:
+            self._pendingEntities.add(delta.key)
+
+    def close(self):
+        self.buf = None
+        _published.discard(self.shm.name)
+        self.shm.close()
+        self.shm.unlink()
+
+    def writeHeader(self):
+        HEADER.pack_into(
+            self.buf,
+            0,
+            MAGIC,
+            LAYOUT_VERSION,
+            self.seq,
+            self.capacity,
+            self.count,
+            time.time(),
+        )
+
+    def getSlot(self, key):
+        slot = self._slots.get(key)
+        if slot != None:
+            return slot
+        if self._free:
+            slot = self._free.pop()
+        elif self.count >= self.capacity:
+            if not self._full:
+                logging.error(f"shared memory segment full ({self.capacity} records)")
+                self._full = True
+            return None
+        else:
+            slot = self.count
+            self.count += 1
+        self._slots[key] = slot
+        self._owned.setdefault(key[:3], set()).add(key[3])
+        return slot
+
+    def writeRecord(self, kind, location, entityId, ccy, value):
+        slot = self.getSlot((kind, location, entityId, ccy))
+        if slot == None:
+            return
+        RECORD.pack_into(
+            self.buf,
+            HEADER.size + slot * RECORD.size,
+            kind,
+            location.encode()[:32],
+            entityId,
+            ccy.encode()[:8],
+            toFixed(value),
+        )
+
+    def freeRecords(self, kind, location, entityId):
+        for ccy in self._owned.pop((kind, location, entityId), ()):
+            slot = self._slots.pop((kind, location, entityId, ccy))
+            RECORD.pack_into(
+                self.buf, HEADER.size + slot * RECORD.size, KIND_TOMBSTONE, b"", 0, b"", 0
+            )
+            self._free.append(slot)
+
+    def iterWallets(self):
+        for loc, wallet in self.cashMetrics.metricsMap.items():
+            if loc == LOCATION_CUSTODY:
+                continue
+            if loc == LOCATION_EXOTIC:
+                yield from wallet.items()
+                continue
+            yield loc, wallet
+
+    def publish(self):
+        wallets = [
+            (loc, wallet)
+            for loc, wallet in self.iterWallets()
+            if self._walletVersions.get(loc) != wallet.version
+        ]
+        # exotic locations are bounded, evicted ones lose their records
+        gone = set(self._walletVersions) - {loc for loc, _ in self.iterWallets()}
+        if not wallets and not gone and not self._pendingEntities:
+            return
+
+        # seqlock: odd while writing, readers retry until they see
+        # the same even value before and after their copy
+        self.seq += 1
+        struct.pack_into("<Q", self.buf, SEQ_OFFSET, self.seq)
+        try:
+            for loc in gone:
+                del self._walletVersions[loc]
+                self.freeRecords(KIND_WALLET, loc, 0)
+
+            for loc, wallet in wallets:
+                for ccy, value in wallet.cashMap.items():
+                    self.writeRecord(KIND_WALLET, loc, 0, ccy, value)
+                self._walletVersions[loc] = wallet.version
+
+            userMap = self.cashMetrics.metricsMap[LOCATION_CUSTODY].userMap
+            for entityId in list(self._pendingEntities):
+                if entityId in userMap:
+                    for ccy, value in userMap[entityId].items():
+                        self.writeRecord(KIND_ENTITY, "", int(entityId), ccy, value)
+                else:
+                    self.freeRecords(KIND_ENTITY, "", int(entityId))
+                self._pendingEntities.discard(entityId)
+        finally:
+            # even again whatever happened, a reader never spins on a
+            # writer that is gone
+            self.seq += 1
+            self.writeHeader()
+
+
+class BalanceReader(object):
+    def __init__(self, name, timeout=READ_TIMEOUT):
+        self.timeout = timeout
+        if sys.version_info >= (3, 13):
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # python registers attached segments with its resource tracker and
+            # would unlink it when this process exits, the writer owns it. a
+            # writer in this process shares the registration, leave it be
+            if self.shm.name not in _published:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        magic, layout, _, self.capacity, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or layout != LAYOUT_VERSION:
+            self.shm.close()
+            raise Exception(f"unexpected segment layout in {name}")
+
+    def close(self):
+        self.shm.close()
+
+    def getSeq(self):
+        return struct.unpack_from("<Q", self.shm.buf, SEQ_OFFSET)[0]
+
+    def readRaw(self):
+        buf = self.shm.buf
+        deadline = time.monotonic() + self.timeout
+        backoff = 0
+        while True:
+            seqBefore = self.getSeq()
+            if seqBefore % 2 == 0:
+                _, _, _, _, count, publishedAt = HEADER.unpack_from(buf, 0)
+                data = bytes(buf[HEADER.size : HEADER.size + count * RECORD.size])
+                if self.getSeq() == seqBefore:
+                    return seqBefore, publishedAt, count, data
+            if time.monotonic() >= deadline:
+                raise Exception("could not get a consistent read of the balances")
+            # let the writer finish, first by yielding then with a growing sleep
+            time.sleep(backoff)
+            backoff = min(READ_BACKOFF_MAX, backoff * 2 or 0.00005)
+
+    def read(self):
+        seq, publishedAt, count, data = self.readRaw()
+        wallets = {}
+        entities = {}
+        for kind, location, entityId, ccy, value in RECORD.iter_unpack(data):
+            if kind == KIND_TOMBSTONE:
+                continue
+            ccy = ccy.rstrip(b"\0").decode()
+            if kind == KIND_WALLET:
+                loc = location.rstrip(b"\0").decode()
+                wallets.setdefault(loc, {})[ccy] = fromFixed(value)
+            else:
+                entities.setdefault(entityId, {})[ccy] = fromFixed(value)
+        return {
+            "seq": seq,
+            "published_at": publishedAt,
+            "wallets": wallets,
+            "entities": entities,
+        }
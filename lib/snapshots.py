@@ -0,0 +1,165 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+from lib.cash import LOCATION_CUSTODY, LOCATION_EXOTIC
+from lib.change_feed import KIND_ENTITY
+from lib.persistent_map import PersistentMap
+
+DEFAULT_RETAIN = 16
+BULK_RATIO = 4
+
+
+@dataclass(slots=True, frozen=True)
+class StateSnapshot:
+    # read only view of the client state at one version, safe to hand
+    # to any reader without copying or locking
+    version: int
+    wallets: MappingProxyType
+    users: PersistentMap
+    sessions: tuple
+    timestamp: float = field(default_factory=time.time)
+
+    def getTotalCash(self):
+        result = {}
+        for _, balances in self.users.items():
+            for ccy in balances:
+                result[ccy] = result.get(ccy, 0) + balances[ccy]
+        return result
+
+    def toDict(self):
+        return {
+            "version": self.version,
+            "timestamp": self.timestamp,
+            "wallets": {
+                loc: {ccy: str(val) for ccy, val in cashMap.items()}
+                for loc, cashMap in self.wallets.items()
+            },
+            "users": {
+                userId: {ccy: str(val) for ccy, val in balances.items()}
+                for userId, balances in self.users.items()
+            },
+            "sessions": [dict(session) for session in self.sessions],
+        }
+
+
+class SnapshotPublisher(object):
+    def __init__(self, cashMetrics, sessionMap, retain=DEFAULT_RETAIN):
+        self.cashMetrics = cashMetrics
+        self.sessionMap = sessionMap
+        self.history = deque(maxlen=retain)
+        self.current = None
+
+        # users changed since the last publish
+        self._pendingUsers = set()
+        cashMetrics.changeFeed.subscribe(self.onDelta)
+
+        self._walletVersions = {}
+        self._sessionVersion = None
+        self._version = 0
+
+        # first snapshot carries every known user
+        self._pendingUsers.update(cashMetrics.metricsMap[LOCATION_CUSTODY].userMap)
+        self.publish()
+
+    def onDelta(self, delta):
+        if delta.kind == KIND_ENTITY:
+            self._pendingUsers.add(delta.key)
+
+    def iterWallets(self):
+        for loc, wallet in self.cashMetrics.metricsMap.items():
+            if loc == LOCATION_CUSTODY:
+                continue
+            if loc == LOCATION_EXOTIC:
+                for exoticLoc, exoticWallet in wallet.items():
+                    yield f"{LOCATION_EXOTIC}/{exoticLoc}", exoticWallet
+                continue
+            yield loc, wallet
+
+    def buildWallets(self, previous):
+        # unchanged wallets keep their frozen view from the previous snapshot
+        changed = False
+        wallets = {}
+        for loc, wallet in self.iterWallets():
+            if previous != None and self._walletVersions.get(loc) == wallet.version:
+                wallets[loc] = previous[loc]
+                continue
+            self._walletVersions[loc] = wallet.version
+            wallets[loc] = MappingProxyType(dict(wallet.cashMap))
+            changed = True
+
+        # a location went away (exotic locations are bounded)
+        if len(self._walletVersions) > len(wallets):
+            changed = True
+            for loc in set(self._walletVersions) - set(wallets):
+                del self._walletVersions[loc]
+
+        if not changed and previous != None:
+            return previous
+        return MappingProxyType(wallets)
+
+    def buildUsers(self, previous):
+        userMap = self.cashMetrics.metricsMap[LOCATION_CUSTODY].userMap
+
+        # past a certain churn a bulk rebuild beats path copying every key
+        if previous == None or len(self._pendingUsers) > len(previous) // BULK_RATIO:
+            self._pendingUsers.clear()
+            return PersistentMap.fromItems(
+                (userId, MappingProxyType(dict(userMap[userId]))) for userId in userMap
+            )
+
+        users = previous
+        for userId in self._pendingUsers:
+            if userId in userMap:
+                users = users.set(userId, MappingProxyType(dict(userMap[userId])))
+            else:
+                users = users.delete(userId)
+        self._pendingUsers.clear()
+        return users
+
+    def buildSessions(self, previous):
+        if previous != None and self._sessionVersion == self.sessionMap.version:
+            return previous
+        self._sessionVersion = self.sessionMap.version
+
+        sessions = []
+        for product, sesData in self.sessionMap.sessionMap.items():
+            for session in sesData.values():
+                sessionDict = session.toDict()
+                sessionDict["product"] = product
+                sessionDict["damaged"] = session.isDamaged()
+                sessions.append(MappingProxyType(sessionDict))
+        return tuple(sessions)
+
+    def publish(self):
+        # called once a notification has been fully applied
+        previous = self.current
+        wallets = self.buildWallets(previous.wallets if previous else None)
+        users = self.buildUsers(previous.users if previous else None)
+        sessions = self.buildSessions(previous.sessions if previous else None)
+
+        if (
+            previous != None
+            and wallets is previous.wallets
+            and users is previous.users
+            and sessions is previous.sessions
+        ):
+            return previous
+
+        self._version += 1
+        snapshot = StateSnapshot(self._version, wallets, users, sessions)
+
+        # single reference swap, readers see either the old or the new state
+        self.current = snapshot
+        self.history.append(snapshot)
+        return snapshot
+
+    def latest(self):
+        return self.current
+
+    def get(self, version):
+        for snapshot in self.history:
+            if snapshot.version == version:
+                return snapshot
+        return None
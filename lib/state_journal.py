@@ -0,0 +1,504 @@
+import asyncio
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+from lib.cash import LOCATION_CUSTODY, LOCATION_EXOTIC
+from lib.change_feed import KIND_ENTITY, KIND_WALLET
+
+## on disk layout, little endian ##
+# segment header: magic, layout version, first seq, record count
+# record: receive time, seq, kind, flags (bit 0: old value set), location
+#         (wallets only), entity id (entities only), currency, old, new as
+#         fixed point integers with 8 decimals
+# snapshots are json, the full state as of their seq
+HEADER = struct.Struct("<4sIQQ")
+RECORD = struct.Struct("<dQBB6x32sq8sqq")
+
+MAGIC = b"LVXJ"
+LAYOUT_VERSION = 1
+COUNT_OFFSET = 16
+
+KIND_CODES = {KIND_WALLET: 0, KIND_ENTITY: 1}
+KIND_LIMBO = "limbo"
+KIND_CODES[KIND_LIMBO] = 2
+KIND_NAMES = {code: kind for kind, code in KIND_CODES.items()}
+
+FLAG_HAS_OLD = 1
+
+SCALE = 10**8
+DEFAULT_SEGMENT_RECORDS = 1 << 20
+DEFAULT_FLUSH_INTERVAL = 0.2
+DEFAULT_FSYNC_INTERVAL = 1.0
+DEFAULT_COMPACT_RECORDS = 500000
+DEFAULT_RETAIN_SNAPSHOTS = 4
+
+
+def toFixed(value):
+    return int((Decimal(value) * SCALE).to_integral_value())
+
+
+def fromFixed(value):
+    return Decimal(value) / SCALE
+
+
+def parseTime(text):
+    # epoch seconds, an iso datetime or a time of day today ("14:05")
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        pass
+    for fmt in ["%H:%M", "%H:%M:%S"]:
+        try:
+            clock = datetime.strptime(text, fmt).time()
+            return datetime.combine(datetime.now().date(), clock).timestamp()
+        except ValueError:
+            pass
+    raise Exception(f"unexpected time: {text}")
+
+
+def segmentPath(directory, firstSeq):
+    return os.path.join(directory, f"journal-{firstSeq:016d}.bin")
+
+
+def snapshotPath(directory, seq):
+    return os.path.join(directory, f"snapshot-{seq:016d}.json")
+
+
+def listFiles(directory, prefix):
+    # (seq, path) sorted by seq
+    result = []
+    for path in glob.glob(os.path.join(directory, f"{prefix}-*")):
+        name = os.path.basename(path)
+        result.append((int(name.split("-")[1].split(".")[0]), path))
+    return sorted(result)
+
+
+class JournalState(object):
+    # plain dict state that records are replayed into
+    def __init__(self, seq=0, timestamp=0, wallets=None, users=None, limbo=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.wallets = wallets or {}
+        self.users = users or {}
+        self.limbo = limbo or {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        def decimals(cashMap):
+            return {ccy: Decimal(value) for ccy, value in cashMap.items()}
+
+        return cls(
+            data["seq"],
+            data["timestamp"],
+            {loc: decimals(cashMap) for loc, cashMap in data["wallets"].items()},
+            {int(entity): decimals(cashMap) for entity, cashMap in data["users"].items()},
+            decimals(data["limbo"]),
+        )
+
+    def apply(self, timestamp, seq, kind, key, ccy, new):
+        self.seq = seq
+        self.timestamp = timestamp
+        if kind == KIND_WALLET:
+            target = self.wallets.setdefault(key, {})
+        elif kind == KIND_ENTITY:
+            target = self.users.setdefault(key, {})
+        else:
+            target = self.limbo
+        target[ccy] = new
+
+    def toDict(self):
+        def strings(cashMap):
+            return {ccy: str(value) for ccy, value in cashMap.items()}
+
+        return {
+            "seq": self.seq,
+            "timestamp": self.timestamp,
+            "wallets": {loc: strings(cashMap) for loc, cashMap in self.wallets.items()},
+            "users": {str(entity): strings(cashMap) for entity, cashMap in self.users.items()},
+            "limbo": strings(self.limbo),
+        }
+
+    def save(self, path):
+        # written aside and renamed, a crash never leaves half a snapshot
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.toDict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+
+
+class Segment(object):
+    def __init__(self, path, firstSeq=None, capacity=DEFAULT_SEGMENT_RECORDS):
+        create = firstSeq != None
+        self.file = open(path, "w+b" if create else "r+b")
+        if create:
+            self.file.truncate(HEADER.size + RECORD.size * capacity)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        if create:
+            HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, firstSeq, 0)
+        magic, layout, self.firstSeq, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or layout != LAYOUT_VERSION:
+            self.close()
+            raise Exception(f"unexpected journal layout in {path}")
+        self.capacity = (len(self.map) - HEADER.size) // RECORD.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def isFull(self):
+        return self.count >= self.capacity
+
+    def append(self, timestamp, seq, kind, key, ccy, old, new):
+        location = b""
+        entityId = 0
+        if kind == KIND_ENTITY:
+            entityId = int(key)
+        elif kind == KIND_WALLET:
+            location = str(key).encode()[:32]
+
+        RECORD.pack_into(
+            self.map,
+            HEADER.size + self.count * RECORD.size,
+            timestamp,
+            seq,
+            KIND_CODES[kind],
+            FLAG_HAS_OLD if old != None else 0,
+            location,
+            entityId,
+            ccy.encode()[:8],
+            toFixed(old) if old != None else 0,
+            toFixed(new if new != None else 0),
+        )
+        self.count += 1
+
+    def commitCount(self):
+        # records past the stored count are ignored by readers
+        struct.pack_into("<Q", self.map, COUNT_OFFSET, self.count)
+
+    def flush(self):
+        self.map.flush()
+
+    def getTimestamp(self, index):
+        return struct.unpack_from("<d", self.map, HEADER.size + index * RECORD.size)[0]
+
+    def read(self, index):
+        timestamp, seq, code, flags, location, entityId, ccy, old, new = RECORD.unpack_from(
+            self.map, HEADER.size + index * RECORD.size
+        )
+        kind = KIND_NAMES[code]
+        key = entityId
+        if kind == KIND_WALLET:
+            key = location.rstrip(b"\0").decode()
+        elif kind == KIND_LIMBO:
+            key = None
+        return (
+            timestamp,
+            seq,
+            kind,
+            key,
+            ccy.rstrip(b"\0").decode(),
+            fromFixed(old) if flags & FLAG_HAS_OLD else None,
+            fromFixed(new),
+        )
+
+    def countUntil(self, timestamp):
+        # records are appended in time order, binary search the cut off
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.getTimestamp(middle) <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class StateJournal(object):
+    # the change feed callback only queues the delta, encoding, fsync and
+    # compaction happen in a background task
+    def __init__(
+        self,
+        directory,
+        cashMetrics,
+        sessionMap=None,
+        segmentRecords=DEFAULT_SEGMENT_RECORDS,
+        flushInterval=DEFAULT_FLUSH_INTERVAL,
+        fsyncInterval=DEFAULT_FSYNC_INTERVAL,
+        compactRecords=DEFAULT_COMPACT_RECORDS,
+        retainSnapshots=DEFAULT_RETAIN_SNAPSHOTS,
+    ):
+        self.directory = directory
+        self.cashMetrics = cashMetrics
+        self.sessionMap = sessionMap
+        self.segmentRecords = segmentRecords
+        self.flushInterval = flushInterval
+        self.fsyncInterval = fsyncInterval
+        self.compactRecords = compactRecords
+        self.retainSnapshots = retainSnapshots
+
+        self.pending = deque()
+        self.written = 0
+        self.fsyncs = 0
+        self.compactions = 0
+        self._task = None
+        # executor job touching the segment or the directory, if any
+        self._inFlight = None
+        # held off the loop while files are created, dropped or read back
+        self._files = threading.Lock()
+        self._lastFsync = time.monotonic()
+        self._sinceCompaction = 0
+        self._limbo = {}
+        self._sessionVersion = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.state, self.segment = self.recover()
+        self.seq = self.state.seq
+
+        # a fresh journal starts from whatever the client already holds
+        if self.seq == 0:
+            self.seedFromLive()
+        cashMetrics.changeFeed.subscribe(self.onDelta)
+
+    ## recovery ##
+    def recover(self):
+        snapshots = listFiles(self.directory, "snapshot")
+        state = JournalState()
+        if snapshots:
+            state = JournalState.load(snapshots[-1][1])
+
+        segments = listFiles(self.directory, "journal")
+        segment = None
+        for firstSeq, path in segments:
+            if segment:
+                segment.close()
+            segment = Segment(path)
+            for index in range(segment.count):
+                timestamp, seq, kind, key, ccy, _, new = segment.read(index)
+                if seq > state.seq:
+                    state.apply(timestamp, seq, kind, key, ccy, new)
+
+        if segment == None or segment.isFull():
+            if segment:
+                segment.close()
+            segment = Segment(
+                segmentPath(self.directory, state.seq + 1),
+                state.seq + 1,
+                self.segmentRecords,
+            )
+        return state, segment
+
+    def seedFromLive(self):
+        for loc, wallet in self.cashMetrics.metricsMap.items():
+            if loc == LOCATION_CUSTODY:
+                for entityId, balances in wallet.userMap.items():
+                    for ccy, value in balances.items():
+                        self.queue(KIND_ENTITY, entityId, ccy, None, value)
+            elif loc == LOCATION_EXOTIC:
+                for exoticLoc, exoticWallet in wallet.items():
+                    for ccy, value in exoticWallet.cashMap.items():
+                        self.queue(KIND_WALLET, exoticLoc, ccy, None, value)
+            else:
+                for ccy, value in wallet.cashMap.items():
+                    self.queue(KIND_WALLET, loc, ccy, None, value)
+
+    ## hot path ##
+    def queue(self, kind, key, ccy, old, new):
+        self.pending.append((time.time(), kind, key, ccy, old, new))
+
+    def onDelta(self, delta):
+        self.queue(delta.kind, delta.key, delta.currency, delta.old, delta.new)
+
+    def syncLimbo(self):
+        if self.sessionMap == None or self._sessionVersion == self.sessionMap.version:
+            return
+        self._sessionVersion = self.sessionMap.version
+        limbo = self.sessionMap.getLimboCashAggregate()
+        for ccy in set(limbo) | set(self._limbo):
+            old = self._limbo.get(ccy)
+            new = limbo.get(ccy, Decimal(0))
+            if old != new:
+                self.queue(KIND_LIMBO, None, ccy, old, new)
+        self._limbo = limbo
+
+    ## background writer ##
+    def start(self):
+        if self._task == None:
+            self._task = asyncio.ensure_future(self.writeLoop())
+
+    async def writeLoop(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            try:
+                self.syncLimbo()
+                await self.writePending()
+                if time.monotonic() - self._lastFsync >= self.fsyncInterval:
+                    await self.fsync()
+                if self._sinceCompaction >= self.compactRecords:
+                    await self.compact()
+            except Exception as e:
+                logging.error(f"state journal write failed: {e}")
+
+    async def writePending(self):
+        if not self.pending:
+            return 0
+        count = 0
+        while self.pending:
+            # rolled before taking the record, a cancelled roll loses nothing
+            if self.segment.isFull():
+                await self.rollSegment()
+            timestamp, kind, key, ccy, old, new = self.pending.popleft()
+            self.seq += 1
+            self.segment.append(timestamp, self.seq, kind, key, ccy, old, new)
+            self.state.apply(timestamp, self.seq, kind, key, ccy, new)
+            count += 1
+        self.segment.commitCount()
+        self.written += count
+        self._sinceCompaction += count
+        return count
+
+    async def runOffLoop(self, func, *args):
+        # shielded, cancelling the writer leaves the job for close to await
+        self._inFlight = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        await asyncio.shield(self._inFlight)
+
+    async def fsync(self):
+        # msync can block on a slow disk, keep it off the loop
+        self._lastFsync = time.monotonic()
+        await self.runOffLoop(self.segment.flush)
+        self.fsyncs += 1
+
+    async def rollSegment(self):
+        # flushing the full segment and creating the next one both hit the
+        # disk. shielded as a whole, the swap completes even if the writer
+        # is cancelled and close waits for it
+        self._inFlight = asyncio.ensure_future(self.swapSegment())
+        await asyncio.shield(self._inFlight)
+
+    async def swapSegment(self):
+        self.segment.commitCount()
+        self.segment = await asyncio.get_running_loop().run_in_executor(
+            None, self.openNext, self.segment, self.seq + 1
+        )
+
+    def openNext(self, full, firstSeq):
+        with self._files:
+            full.flush()
+            full.close()
+            return Segment(
+                segmentPath(self.directory, firstSeq), firstSeq, self.segmentRecords
+            )
+
+    async def compact(self):
+        # the copy is taken on the loop, writing it out and dropping what it
+        # made redundant is not
+        self._sinceCompaction = 0
+        snapshot = JournalState(
+            self.state.seq,
+            self.state.timestamp,
+            {loc: dict(cashMap) for loc, cashMap in self.state.wallets.items()},
+            {entity: dict(cashMap) for entity, cashMap in self.state.users.items()},
+            dict(self.state.limbo),
+        )
+        await self.runOffLoop(self.writeSnapshot, snapshot, self.segment.firstSeq)
+        self.compactions += 1
+
+    def writeSnapshot(self, snapshot, activeSeq):
+        with self._files:
+            self.dropSnapshots(snapshot, activeSeq)
+
+    def dropSnapshots(self, snapshot, activeSeq):
+        # older snapshots past the retention count go, with the segments
+        # only they needed
+        snapshot.save(snapshotPath(self.directory, snapshot.seq))
+
+        snapshots = listFiles(self.directory, "snapshot")
+        if len(snapshots) <= self.retainSnapshots:
+            return
+        for _, path in snapshots[: -self.retainSnapshots]:
+            os.unlink(path)
+        oldestSeq = snapshots[-self.retainSnapshots][0]
+
+        # a segment can go once the next one starts at or before the oldest snapshot
+        segments = listFiles(self.directory, "journal")
+        for (firstSeq, path), (nextSeq, _) in zip(segments, segments[1:]):
+            if nextSeq <= oldestSeq + 1 and firstSeq != activeSeq:
+                os.unlink(path)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # a flush still running in the executor would hit a closed map
+        if self._inFlight != None:
+            await asyncio.gather(self._inFlight, return_exceptions=True)
+            self._inFlight = None
+        self.syncLimbo()
+        await self.writePending()
+        self.segment.flush()
+        self.segment.close()
+
+    ## point in time ##
+    def stateAt(self, timestamp):
+        # compaction can't drop the files half way through
+        with self._files:
+            return self.readStateAt(timestamp)
+
+    def readStateAt(self, timestamp):
+        # latest snapshot at or before the time, then the records up to it.
+        # only reads committed records from disk, safe to run off the loop
+        state = None
+        for seq, path in reversed(listFiles(self.directory, "snapshot")):
+            candidate = JournalState.load(path)
+            if candidate.timestamp <= timestamp:
+                state = candidate
+                break
+
+        segments = listFiles(self.directory, "journal")
+        if state == None:
+            if segments and segments[0][0] > 1:
+                raise Exception("time is older than the retained journal")
+            state = JournalState()
+
+        for firstSeq, path in segments:
+            segment = Segment(path)
+            try:
+                if segment.count and segment.getTimestamp(0) > timestamp:
+                    break
+                for index in range(segment.countUntil(timestamp)):
+                    recordTime, seq, kind, key, ccy, _, new = segment.read(index)
+                    if seq > state.seq:
+                        state.apply(recordTime, seq, kind, key, ccy, new)
+            finally:
+                segment.close()
+        return state
+
+    def stats(self):
+        return {
+            "seq": self.seq,
+            "pending": len(self.pending),
+            "written": self.written,
+            "fsyncs": self.fsyncs,
+            "compactions": self.compactions,
+            "segment": os.path.basename(segmentPath(self.directory, self.segment.firstSeq)),
+            "segment_fill": f"{self.segment.count}/{self.segment.capacity}",
+        }
@@ -0,0 +1,136 @@
+import json
+from json.decoder import WHITESPACE, scanstring
+
+# frames at least this large are scanned instead of json.loads'ed whole
+STREAM_THRESHOLD = 1 << 16
+
+_decoder = json.JSONDecoder()
+
+
+class ArraySink(object):
+    # receives the elements of one streamed array, the array itself is
+    # replaced by its element count in the decoded frame
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.count = 0
+
+    def onItem(self, item, parent):
+        # parent holds the keys of the enclosing object decoded so far
+        self.count += 1
+        if self.callback:
+            self.callback(item)
+
+    def onEnd(self, parent):
+        # the enclosing object is complete
+        pass
+
+
+def getPrefixes(sinks):
+    prefixes = set()
+    for path in sinks:
+        for length in range(len(path)):
+            prefixes.add(path[:length])
+    return prefixes
+
+
+def skipSpace(text, index):
+    return WHITESPACE.match(text, index).end()
+
+
+## scanning path, large frames ##
+def scanFrame(text, sinks):
+    # decodes a json frame, arrays at the sink paths (tuples of keys) are
+    # decoded one element at a time and handed over instead of built
+    prefixes = getPrefixes(sinks)
+    index = skipSpace(text, 0)
+    if text[index : index + 1] != "{":
+        return json.loads(text)
+    result, index = scanObject(text, index, (), sinks, prefixes)
+    if skipSpace(text, index) != len(text):
+        raise json.JSONDecodeError("Extra data", text, index)
+    return result
+
+
+def scanObject(text, index, path, sinks, prefixes):
+    result = {}
+    streamed = []
+    index = skipSpace(text, index + 1)
+    if text[index : index + 1] == "}":
+        return result, index + 1
+
+    while True:
+        if text[index : index + 1] != '"':
+            raise json.JSONDecodeError("Expecting property name", text, index)
+        key, index = scanstring(text, index + 1)
+        index = skipSpace(text, index)
+        if text[index : index + 1] != ":":
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, index)
+        index = skipSpace(text, index + 1)
+
+        childPath = path + (key,)
+        char = text[index : index + 1]
+        if childPath in sinks and char == "[":
+            value, index = streamArray(text, index, sinks[childPath], result)
+            streamed.append(sinks[childPath])
+        elif childPath in prefixes and char == "{":
+            value, index = scanObject(text, index, childPath, sinks, prefixes)
+        else:
+            value, index = _decoder.raw_decode(text, index)
+        result[key] = value
+
+        index = skipSpace(text, index)
+        char = text[index : index + 1]
+        if char == "}":
+            for sink in streamed:
+                sink.onEnd(result)
+            return result, index + 1
+        if char != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, index)
+        index = skipSpace(text, index + 1)
+
+
+def streamArray(text, index, sink, parent):
+    count = 0
+    index = skipSpace(text, index + 1)
+    if text[index : index + 1] == "]":
+        return count, index + 1
+
+    while True:
+        item, index = _decoder.raw_decode(text, index)
+        sink.onItem(item, parent)
+        count += 1
+
+        index = skipSpace(text, index)
+        char = text[index : index + 1]
+        if char == "]":
+            return count, index + 1
+        if char != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, index)
+        index = skipSpace(text, index + 1)
+
+
+## decoded path, small frames ##
+def detachStreams(frame, sinks):
+    # same hand over on an already decoded frame, so sinks see every
+    # payload whatever its size
+    for path, sink in sinks.items():
+        parent = frame
+        for key in path[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if not isinstance(parent, dict) or not isinstance(parent.get(path[-1]), list):
+            continue
+
+        items = parent[path[-1]]
+        parent[path[-1]] = len(items)
+        for item in items:
+            sink.onItem(item, parent)
+        sink.onEnd(parent)
+    return frame
+
+
+def decodeFrame(text, sinks=None):
+    if not sinks:
+        return json.loads(text)
+    if len(text) >= STREAM_THRESHOLD:
+        return scanFrame(text, sinks)
+    return detachStreams(json.loads(text), sinks)
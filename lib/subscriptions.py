@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+# entity id 0 subscribes to every user balance
+ALL_ENTITIES = 0
+
+
+class SubscriptionManager(object):
+    # holds what every consumer wants to watch and keeps the server side
+    # subscriptions in line with the union of it, sending only the diff
+    def __init__(self, connection):
+        self.connection = connection
+        self.owners = {}
+
+        # what the server was asked for on the current connection
+        self.activeEntities = set()
+
+        self._dirty = False
+        self._applyTask = None
+
+    ## desired state ##
+    def watch(self, owner, entityIds):
+        # replaces the owner's set, returns an awaitable completing once
+        # the change went out
+        entityIds = set(entityIds)
+        if entityIds:
+            self.owners[owner] = entityIds
+        else:
+            self.owners.pop(owner, None)
+        return self.requestApply()
+
+    def add(self, owner, entityIds):
+        return self.watch(owner, self.owners.get(owner, set()) | set(entityIds))
+
+    def remove(self, owner, entityIds):
+        return self.watch(owner, self.owners.get(owner, set()) - set(entityIds))
+
+    def release(self, owner):
+        return self.watch(owner, ())
+
+    def getDesiredEntities(self):
+        desired = set()
+        for entityIds in self.owners.values():
+            desired |= entityIds
+
+        # the firehose covers every single entity subscription
+        if ALL_ENTITIES in desired:
+            return {ALL_ENTITIES}
+        return desired
+
+    ## server side ##
+    def reset(self):
+        # new websocket, nothing is subscribed on it yet
+        self.activeEntities = set()
+
+    def requestApply(self):
+        # changes made in the same tick go out as one diff
+        self._dirty = True
+        if self._applyTask == None or self._applyTask.done():
+            self._applyTask = asyncio.ensure_future(self.apply())
+        return self._applyTask
+
+    async def apply(self):
+        await asyncio.sleep(0)
+        while self._dirty:
+            self._dirty = False
+            if not self.connection.loginStatus:
+                # restored on login
+                return
+
+            desired = self.getDesiredEntities()
+            added = desired - self.activeEntities
+            removed = self.activeEntities - desired
+
+            # subscribe first so moving off the firehose leaves no gap
+            for entityId in sorted(added):
+                await self.connection.subscribeToUserBalance(entityId)
+                self.activeEntities.add(entityId)
+            for entityId in sorted(removed):
+                await self.connection.unsubscribeFromUserBalance(entityId)
+                self.activeEntities.discard(entityId)
+
+            if added or removed:
+                logging.info(
+                    f"balance subscriptions: +{len(added)} -{len(removed)}"
+                    f", {len(self.activeEntities)} active"
+                )
+
+    async def restore(self):
+        # on every login, the first one and after each reconnect
+        await self.requestApply()
+
+    def stats(self):
+        # entities is what the server was asked for, desired what it will be
+        # once logged in
+        return {
+            "owners": len(self.owners),
+            "desired": sorted(self.getDesiredEntities()),
+            "entities": sorted(self.activeEntities),
+        }
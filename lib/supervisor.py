@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import sys
+from decimal import Decimal
+
+from lib import log_pipeline
+from lib.log_pipeline import logTarget
+
+TARGET_ALL = "all"
+
+COMMAND_EXIT = "exit"
+COMMAND_HELP = "help"
+COMMAND_TARGETS = "targets"
+COMMAND_CASH = "cash"
+
+HELP_STR = """supervisor commands:
+ . @<target> <command>: runs a command on one target, @all for every target
+ . targets: lists targets and their login state
+ . cash: wallet and custody totals per target and across all of them
+ . exit: stops every target
+commands without a @ prefix go to the first target, per target commands:"""
+
+
+def makeTag(env, key):
+    # (env, key) pair as shown in the prompt and in cash views
+    if not key:
+        return env
+    keyName = os.path.splitext(os.path.basename(key))[0]
+    return f"{env}/{keyName}"
+
+
+def parseTarget(target):
+    # "env:key file", the key is optional
+    env, _, key = target.partition(":")
+    return env, key or None
+
+
+class Supervisor(object):
+    # runs one client per (env, key) on a single event loop behind one prompt
+    def __init__(self, targets, clientFactory):
+        self.clients = {}
+        self.loggedIn = {}
+        for env, key in targets:
+            tag = makeTag(env, key)
+            if tag in self.clients:
+                raise Exception(f"duplicate target: {tag}")
+            client = clientFactory(env, key)
+            client.tag = tag
+            client.supervisor = self
+            self.clients[tag] = client
+            self.loggedIn[tag] = False
+
+        if not self.clients:
+            raise Exception("no targets to supervise")
+        self.defaultTag = next(iter(self.clients))
+        self._tasks = []
+
+    ## lifetime ##
+    async def run(self):
+        self._tasks = [
+            asyncio.create_task(self.runTarget(tag, client), name=f"{tag} task")
+            for tag, client in self.clients.items()
+        ]
+        try:
+            await self.inputLoop()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def runTarget(self, tag, client):
+        # everything logged from this task and the ones it starts is tagged
+        logTarget.set(tag)
+        # one target failing leaves the others running
+        try:
+            await client.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"[{tag}] connection failed: {e}")
+        self.loggedIn[tag] = False
+
+    async def onLoginSuccess(self, client):
+        self.loggedIn[client.tag] = True
+        logging.info(f"[{client.tag}] logged in")
+
+    ## prompt ##
+    async def inputLoop(self):
+        loop = asyncio.get_running_loop()
+        keepRunning = True
+        while keepRunning:
+            print(">input a command>")
+            command = await loop.run_in_executor(None, sys.stdin.readline)
+            if not command:
+                return
+            try:
+                keepRunning = await self.route(command.strip())
+            except Exception as e:
+                logging.error(f"command failed: {e}")
+
+    def resolveTargets(self, name):
+        if name == TARGET_ALL:
+            return list(self.clients)
+        if name in self.clients:
+            return [name]
+
+        # a bare env name works as long as only one key runs on it
+        matches = [tag for tag in self.clients if tag.split("/")[0] == name]
+        if len(matches) == 1:
+            return matches
+        if matches:
+            raise Exception(f"{name} is ambiguous, pick one of {matches}")
+        raise Exception(f"unknown target: {name}")
+
+    async def route(self, request):
+        if request == COMMAND_EXIT:
+            return False
+        if request == COMMAND_TARGETS:
+            self.printTargets()
+            return True
+        if request == COMMAND_CASH:
+            await self.printCash()
+            return True
+        if request == COMMAND_HELP:
+            print(HELP_STR)
+
+        tags = [self.defaultTag]
+        if request.startswith("@"):
+            prefix, _, request = request.partition(" ")
+            tags = self.resolveTargets(prefix[1:])
+        if request.strip() == COMMAND_EXIT:
+            print("exit stops every target, run it without a @ prefix")
+            return True
+
+        for tag in tags:
+            if len(tags) > 1 or tag != self.defaultTag:
+                print(f"== {tag} ==")
+            token = logTarget.set(tag)
+            try:
+                await self.clients[tag].parseCommand(request)
+            except Exception as e:
+                logging.error(f"[{tag}] command failed: {e}")
+            finally:
+                logTarget.reset(token)
+        return True
+
+    ## views ##
+    def printTargets(self):
+        records = {}
+        if log_pipeline.pipeline != None:
+            records = log_pipeline.pipeline.policy.targets
+        for tag, client in self.clients.items():
+            state = "logged in" if self.loggedIn[tag] else "not logged in"
+            print(
+                f" . {tag}: {state}, {client.connection.reconnects} reconnects"
+                f", {records.get(tag, 0)} log records"
+            )
+
+    async def getCashView(self):
+        # read from each target's latest snapshot, custody is summed by the
+        # offloader, the totals across targets per currency
+        view = {}
+        combined = {"wallets": {}, "custody": {}}
+        for tag, client in self.clients.items():
+            snapshot = client.snapshots.latest()
+            wallets = {loc: dict(cashMap) for loc, cashMap in snapshot.wallets.items()}
+            custody = await client.offloader.getTotalCash(snapshot)
+            view[tag] = {"wallets": wallets, "custody": custody}
+
+            for loc, cashMap in wallets.items():
+                total = combined["wallets"].setdefault(loc, {})
+                for ccy, value in cashMap.items():
+                    total[ccy] = total.get(ccy, Decimal(0)) + value
+            for ccy, value in custody.items():
+                combined["custody"][ccy] = combined["custody"].get(ccy, Decimal(0)) + value
+
+        view[TARGET_ALL] = combined
+        return view
+
+    async def printCash(self):
+        view = await self.getCashView()
+        for tag, cash in view.items():
+            print(f" . {tag}:")
+            for loc, cashMap in cash["wallets"].items():
+                if cashMap:
+                    balances = " - ".join(f"{ccy}: {val}" for ccy, val in cashMap.items())
+                    print(f"    - {loc:22} = {balances}")
+            custody = " - ".join(f"{ccy}: {val}" for ccy, val in cash["custody"].items())
+            print(f"    - {'custody':22} = {custody or 'N/A'}")
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import random
+import time
+
+# refresh once this share of the token lifetime has elapsed, leaving
+# the rest of the lifetime to retry in
+DEFAULT_REFRESH_RATIO = 0.7
+# spread refreshes by up to this share of the lifetime
+DEFAULT_JITTER_RATIO = 0.05
+
+DEFAULT_BACKOFF_MIN = 1
+DEFAULT_BACKOFF_MAX = 30
+
+# never retry closer to expiry than this many seconds
+EXPIRY_MARGIN = 5
+
+
+class TokenExpiredException(Exception):
+    def __init__(self):
+        super().__init__("access token expired before it could be refreshed")
+
+
+class TokenRefresher(object):
+    def __init__(
+        self,
+        loginClient,
+        token,
+        refreshRatio=DEFAULT_REFRESH_RATIO,
+        jitterRatio=DEFAULT_JITTER_RATIO,
+        backoffMin=DEFAULT_BACKOFF_MIN,
+        backoffMax=DEFAULT_BACKOFF_MAX,
+        login=None,
+    ):
+        # one login client for the lifetime of the session rather
+        # than a fresh one every cycle
+        self.loginClient = loginClient
+        self.refreshRatio = refreshRatio
+        self.jitterRatio = jitterRatio
+        self.backoffMin = backoffMin
+        self.backoffMax = backoffMax
+        # full login once the token can't be refreshed anymore, returns
+        # a new token. without it an expired token is fatal
+        self.login = login
+
+        self.sessions = []
+        self.token = None
+        self.expiresAt = None
+        self.refreshCount = 0
+        self.failureCount = 0
+        self.reloginCount = 0
+        self.lastRefreshLatency = None
+        self.setToken(token)
+
+    def setToken(self, token):
+        self.token = token
+        self.expiresAt = time.monotonic() + token["expires_in"]
+
+    def addSession(self, session):
+        # sessions expose `async authorize(token)` and `onTokenExpired()`
+        self.sessions.append(session)
+
+    def removeSession(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    ## metrics ##
+    def timeToExpiry(self):
+        return self.expiresAt - time.monotonic()
+
+    def stats(self):
+        return {
+            "time_to_expiry": round(self.timeToExpiry(), 3),
+            "refresh_count": self.refreshCount,
+            "failure_count": self.failureCount,
+            "relogin_count": self.reloginCount,
+            "last_refresh_latency": self.lastRefreshLatency,
+            "sessions": len(self.sessions),
+        }
+
+    ## refresh loop ##
+    def nextRefreshDelay(self):
+        lifetime = self.token["expires_in"]
+        delay = lifetime * self.refreshRatio
+        delay -= random.uniform(0, lifetime * self.jitterRatio)
+        return max(0, delay)
+
+    async def fetchSuccessor(self):
+        backoff = self.backoffMin
+        while True:
+            start = time.monotonic()
+            try:
+                token = await self.loginClient.update_access_token(
+                    self.token["access_token"]
+                )
+                if token == None:
+                    raise Exception("login server returned no token")
+                self.lastRefreshLatency = round(time.monotonic() - start, 3)
+                return token
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failureCount += 1
+                remaining = self.timeToExpiry()
+                logging.warning(
+                    f"token refresh failed ({e}), {remaining:.0f}s left on current token"
+                )
+                if remaining <= 0:
+                    return await self.relogin()
+
+            # back off, but keep the last attempts ahead of expiry
+            delay = min(backoff, max(self.timeToExpiry() - EXPIRY_MARGIN, 0))
+            delay = max(delay, self.backoffMin) * random.uniform(0.5, 1)
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, self.backoffMax)
+
+    async def relogin(self):
+        # refreshing needs a live token, past its lifetime the sessions are
+        # unauthenticated until a full login replaces it
+        logging.error("access token expired before it could be refreshed")
+        for session in self.sessions:
+            session.onTokenExpired()
+        if self.login == None:
+            raise TokenExpiredException()
+
+        start = time.monotonic()
+        token = await self.login()
+        if token == None:
+            raise TokenExpiredException()
+        self.lastRefreshLatency = round(time.monotonic() - start, 3)
+        self.reloginCount += 1
+        return token
+
+    async def swap(self, token):
+        # every session sees the same token, swapped in one step
+        self.setToken(token)
+        self.refreshCount += 1
+        await asyncio.gather(*[session.authorize(token) for session in self.sessions])
+        logging.info(
+            f"access token refreshed in {self.lastRefreshLatency}s, "
+            f"expires in {self.timeToExpiry():.0f}s"
+        )
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.nextRefreshDelay())
+            token = await self.fetchSuccessor()
+            await self.swap(token)
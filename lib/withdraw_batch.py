@@ -0,0 +1,294 @@
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+
+from lib.api_connection import (
+    REPLY_WITHDRAW,
+    AmbiguousReplyException,
+    isErrorReply,
+    makeWithdrawRequest,
+    matchWithdrawReply,
+)
+
+STATE_SENT = "sent"
+STATE_ACKED = "acked"
+STATE_REJECTED = "rejected"
+# sent, but no reply could be tied to it (timeout, lost connection, reply
+# matching several rows): the payout may or may not have happened
+STATE_UNKNOWN = "unknown"
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_FSYNC_EVERY = 64
+DEFAULT_REPLY_TIMEOUT = 30
+
+CSV_COLUMNS = ["address", "currency", "amount", "entity_id"]
+
+
+class BatchValidationException(Exception):
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid withdrawal rows, first: {errors[0]}")
+        self.errors = errors
+
+
+@dataclass(slots=True, frozen=True)
+class WithdrawRow:
+    index: int
+    address: str
+    currency: str
+    amount: Decimal
+    entity_id: int
+    key: str
+
+
+@dataclass(slots=True, frozen=True)
+class SentWithdrawal:
+    reply: object
+
+
+@dataclass(slots=True)
+class BatchResult:
+    total: int = 0
+    skipped: int = 0
+    acked: int = 0
+    rejected: int = 0
+    unknown: int = 0
+
+
+def makeIdempotencyKey(batchId, index, address, currency, amount, entityId):
+    # the row index is part of the key so identical payouts within
+    # a batch stay distinct, while a resumed batch reproduces the same keys
+    payload = f"{batchId}|{index}|{address}|{currency}|{amount}|{entityId}"
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def prepareRows(batchId, rows):
+    # validate everything up front, nothing is sent if a single row is bad
+    prepared = []
+    errors = []
+    for index, row in enumerate(rows):
+        if isinstance(row, dict):
+            row = [row.get(col) for col in CSV_COLUMNS]
+        try:
+            address, currency, amount = row[0], row[1], row[2]
+            entityId = row[3] if len(row) > 3 else None
+        except (IndexError, KeyError, TypeError):
+            errors.append(f"row {index}: expected {CSV_COLUMNS}, got {row}")
+            continue
+
+        try:
+            amount = Decimal(amount)
+        except (InvalidOperation, TypeError, ValueError):
+            errors.append(f"row {index}: invalid amount {amount}")
+            continue
+        if not amount.is_finite() or amount <= 0:
+            errors.append(f"row {index}: amount must be positive, got {amount}")
+            continue
+        if not address or not currency:
+            errors.append(f"row {index}: missing address or currency")
+            continue
+        try:
+            entityId = int(entityId or 0)
+        except (TypeError, ValueError):
+            errors.append(f"row {index}: invalid entity id {entityId}")
+            continue
+
+        key = makeIdempotencyKey(batchId, index, address, currency, amount, entityId)
+        prepared.append(WithdrawRow(index, address, currency, amount, entityId, key))
+
+    if errors:
+        raise BatchValidationException(errors)
+    return prepared
+
+
+def loadRowsCsv(path):
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+class ConnectionWithdrawer(object):
+    # AdminClient.withdraw over a bare connection, what the console client
+    # hands to withdraw_many
+    def __init__(self, connection, replyTimeout=DEFAULT_REPLY_TIMEOUT):
+        self.connection = connection
+        self.replyTimeout = replyTimeout
+
+    async def withdraw(
+        self, address, currency, amount, entity_id=None, idempotency_key=None
+    ):
+        request = makeWithdrawRequest(
+            address, currency, amount, entity_id, idempotency_key
+        )
+        future = self.connection.waitReply(
+            REPLY_WITHDRAW, match=matchWithdrawReply(request)
+        )
+        try:
+            await self.connection.withdraw(
+                address, currency, amount, entity_id, idempotency_key
+            )
+        except Exception:
+            self.connection.cancelReply(REPLY_WITHDRAW, future)
+            raise
+        return SentWithdrawal(await asyncio.wait_for(future, self.replyTimeout))
+
+
+class WithdrawJournal(object):
+    # append only json lines, the last state recorded for a key wins
+    def __init__(self, path, fsyncEvery=DEFAULT_FSYNC_EVERY):
+        self.path = path
+        self.fsyncEvery = fsyncEvery
+        self.states = {}
+        self._file = None
+        self._unsynced = 0
+
+    def open(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn write from a crash, only ever the last line
+                        logging.warning(f"skipping corrupt journal line in {self.path}")
+                        continue
+                    self.states[entry["key"]] = entry["state"]
+        self._file = open(self.path, "a")
+
+    def close(self):
+        if self._file == None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def isAcked(self, key):
+        return self.states.get(key) == STATE_ACKED
+
+    def isUnknown(self, key):
+        # a crash between send and reply leaves the row at sent
+        return self.states.get(key) in (STATE_SENT, STATE_UNKNOWN)
+
+    def record(self, row, state, reply=None):
+        self.states[row.key] = state
+        entry = {"key": row.key, "index": row.index, "state": state, "ts": time.time()}
+        if reply != None:
+            entry["reply"] = reply
+        self._file.write(json.dumps(entry, default=str) + "\n")
+        self._file.flush()
+
+        # sent is what keeps a resume from paying twice, it is on disk before
+        # the request goes out. a lost outcome only leaves the row at sent,
+        # batch those fsyncs
+        if state == STATE_SENT:
+            self.sync()
+            return
+        self._unsynced += 1
+        if self._unsynced >= self.fsyncEvery:
+            self.sync()
+
+
+async def withdraw_many(
+    client,
+    rows,
+    journalPath,
+    batchId,
+    concurrency=DEFAULT_CONCURRENCY,
+    retryUnknown=False,
+):
+    # client is an AdminClient or a ConnectionWithdrawer, rows are
+    # (address, currency, amount, entity_id) tuples or dicts with those keys,
+    # loadRowsCsv reads them from a csv file with that header.
+    # withdrawal replies carry no reference, rows are sent one at a time
+    # until a reply echoes its request fields, only then up to `concurrency`
+    # run side by side. rows whose outcome is unknown are not resent unless
+    # retryUnknown is set, check them against the server first
+    prepared = prepareRows(batchId, rows)
+    journal = WithdrawJournal(journalPath)
+    journal.open()
+
+    result = BatchResult(total=len(prepared))
+    pending = iter(prepared)
+    correlated = asyncio.Event()
+
+    async def send(row):
+        request = makeWithdrawRequest(
+            row.address, row.currency, str(row.amount), row.entity_id, row.key
+        )
+        # journal before sending, a crash after this point leaves the row
+        # unknown. the idempotency key is sent on the assumption the server
+        # honours it, a resume does not rely on it
+        journal.record(row, STATE_SENT)
+        try:
+            reply = (
+                await client.withdraw(
+                    row.address,
+                    row.currency,
+                    str(row.amount),
+                    row.entity_id,
+                    idempotency_key=row.key,
+                )
+            ).reply
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, AmbiguousReplyException):
+                correlated.clear()
+            logging.error(f"withdrawal row {row.index} outcome unknown: {e!r}")
+            journal.record(row, STATE_UNKNOWN, repr(e))
+            result.unknown += 1
+            return
+
+        if matchWithdrawReply(request)(reply) == True:
+            correlated.set()
+        if isErrorReply(reply):
+            journal.record(row, STATE_REJECTED, reply)
+            result.rejected += 1
+        else:
+            journal.record(row, STATE_ACKED, reply)
+            result.acked += 1
+
+    async def worker(index):
+        while True:
+            if index > 0:
+                await correlated.wait()
+            row = next(pending, None)
+            if row == None:
+                return
+
+            if journal.isAcked(row.key):
+                result.skipped += 1
+                continue
+            if journal.isUnknown(row.key) and not retryUnknown:
+                logging.warning(
+                    f"withdrawal row {row.index} has an unknown outcome, not resent"
+                )
+                result.unknown += 1
+                continue
+            await send(row)
+
+    workers = []
+    try:
+        # workers share one iterator, at most `concurrency` rows are in flight
+        async with asyncio.TaskGroup() as tg:
+            for i in range(max(1, concurrency)):
+                task = tg.create_task(worker(i), name=f"withdraw batch worker {i}")
+                workers.append(task)
+            # the first worker finishing means the rows ran out, the others
+            # may still be parked on the correlation gate
+            await workers[0]
+            correlated.set()
+    finally:
+        journal.close()
+
+    return result
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+
+## websocket transport settings ##
+# set per environment under "transport" in the api_connection urls table,
+# anything left out keeps these defaults, the websockets library's own
+DEFAULT_TRANSPORT = {
+    # permessage-deflate, window bits trade memory and cpu for ratio (9-15)
+    "compression": True,
+    "window_bits": 15,
+    # largest incoming message and number of queued incoming messages
+    "max_size": 2**20,
+    "max_queue": 32,
+    # keepalive, None disables it
+    "ping_interval": 20,
+    "ping_timeout": 20,
+    # flush requests queued in the same loop tick with a single write
+    "write_coalesce": False,
+}
+
+
+def getTransportSettings(overrides=None):
+    settings = dict(DEFAULT_TRANSPORT)
+    if overrides:
+        unknown = set(overrides) - set(DEFAULT_TRANSPORT)
+        if unknown:
+            raise Exception(f"unknown transport settings: {sorted(unknown)}")
+        settings.update(overrides)
+    return settings
+
+
+def getConnectOptions(settings):
+    # keyword arguments for websockets.connect
+    options = {
+        "max_size": settings["max_size"],
+        "max_queue": settings["max_queue"],
+        "ping_interval": settings["ping_interval"],
+        "ping_timeout": settings["ping_timeout"],
+        "compression": None,
+    }
+    if settings["compression"]:
+        from websockets.extensions.permessage_deflate import (
+            ClientPerMessageDeflateFactory,
+        )
+
+        # at 15 the offer is the library's own, the server picks its window
+        windowBits = settings["window_bits"]
+        if windowBits == 15:
+            factory = ClientPerMessageDeflateFactory(
+                client_max_window_bits=True,
+                compress_settings={"memLevel": 5},
+            )
+        else:
+            factory = ClientPerMessageDeflateFactory(
+                server_max_window_bits=windowBits,
+                client_max_window_bits=windowBits,
+                compress_settings={"memLevel": 5},
+            )
+        options["extensions"] = [factory]
+    return options
+
+
+def isLegacyProtocol(websocket):
+    # coalescing frames by hand on the legacy implementation's transport,
+    # what websockets.connect returns up to 13.x. requirements.txt pins 11.0.3
+    try:
+        from websockets.legacy.protocol import WebSocketCommonProtocol
+    except ImportError:
+        return False
+    return isinstance(websocket, WebSocketCommonProtocol)
+
+
+class WriteCoalescer(object):
+    # requests sent within one loop tick are framed into a single buffer and
+    # handed to the transport in one write, followed by a single drain.
+    # other websockets implementations get plain sends
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.legacy = isLegacyProtocol(websocket)
+        if not self.legacy:
+            logging.warning("write coalescing needs the legacy websockets protocol, disabled")
+        self._pending = []
+        self._waiters = []
+        self._scheduled = False
+        self.batches = 0
+        self.messages = 0
+
+    async def send(self, message):
+        if not self.legacy:
+            await self.websocket.send(message)
+            self.batches += 1
+            self.messages += 1
+            return
+
+        await self.websocket.ensure_open()
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._pending.append(message)
+        self._waiters.append(waiter)
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self.flush)
+        await waiter
+
+    def flush(self):
+        from websockets.frames import OP_TEXT
+        from websockets.legacy.framing import Frame
+
+        pending, waiters = self._pending, self._waiters
+        self._pending, self._waiters = [], []
+        self._scheduled = False
+
+        chunks = []
+        try:
+            for message in pending:
+                Frame(True, OP_TEXT, message.encode()).write(
+                    chunks.append, mask=True, extensions=self.websocket.extensions
+                )
+            self.websocket.transport.write(b"".join(chunks))
+        except Exception as e:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+
+        self.batches += 1
+        self.messages += len(pending)
+        task = asyncio.ensure_future(self.websocket.drain())
+        task.add_done_callback(lambda done: self.onDrained(done, waiters))
+
+    def onDrained(self, task, waiters):
+        error = None if task.cancelled() else task.exception()
+        if error:
+            logging.error(f"websocket drain failed: {error}")
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(None)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "per_batch": round(self.messages / self.batches, 2) if self.batches else 0,
+        }